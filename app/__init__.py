@@ -1,37 +1,52 @@
 # app/__init__.py
+from app import startup  # first, so startup timing includes the imports below
 from flask import Flask, render_template
 from app.config import Config
-from app.database import init_db
+from app.ingest import UploadRequest
 from app.routes.chat import chat_bp
 from app.routes.upload import upload_bp
 from app.routes.admin import admin_bp
 from app.routes.health import health_bp
 from app.routes.github import github_bp
+from app.routes.metrics import metrics_bp
+
+startup.record('imports', startup.since_start())
 
 def create_app():
+    started = startup.since_start()
     # Explicitly set template_folder relative to the app package
     app = Flask(__name__, 
                 template_folder='../templates',  # Go up one level to find templates
                 static_folder='../static')       # Same for static files if you have them
+    # Uploaded files are parsed straight into the upload store
+    app.request_class = UploadRequest
     
     app.config.from_object(Config)
     
     # Initialize directories
     Config.init_directories()
     
-    # Initialize database
-    init_db()
-    
     # Register blueprints
     app.register_blueprint(chat_bp)
     app.register_blueprint(upload_bp)
     app.register_blueprint(admin_bp)
     app.register_blueprint(health_bp)
     app.register_blueprint(github_bp)
+    app.register_blueprint(metrics_bp)
+    
+    # Requests that need the database wait for startup (after the metrics
+    # hooks, so the wait counts towards request latency)
+    app.before_request(startup.readiness_gate)
 
     # Root route
     @app.route('/')
     def index():
         return render_template('index.html')
     
-    return app
\ No newline at end of file
+    startup.record('create_app', startup.since_start() - started)
+    
+    # Restore, migrate and start periodic backups (one worker is elected to
+    # run them); in the background with STARTUP_RESTORE=background
+    startup.start()
+    
+    return app
@@ -0,0 +1,423 @@
+# app/asgi.py
+"""ASGI serving mode (scripts/start.sh with SERVER_MODE=asgi).
+
+Under gunicorn's gthread workers every conversation waiting on Claude holds a
+thread. Here the chat and upload routes run on the event loop instead: the
+Anthropic and GitHub calls are awaited, and the blocking parts (request
+parsing, uploads, database reads and writes) run on a bounded thread pool. A
+worker can then hold hundreds of in-flight conversations, limited by
+ASYNC_LLM_MAX_CONCURRENCY and the server's connection limit rather than by
+threads.
+
+Every other route is served by the Flask app itself, called as a WSGI app on
+the same thread pool, so both modes share one implementation of them.
+
+Request bodies are read into a spooled temporary file first, except for the
+upload routes: there the pool thread parsing the request pulls the body from
+the connection as it goes (ReceiveStream), so an upload is written to disk
+once, into the upload store.
+"""
+import asyncio
+import functools
+import json
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from flask import request
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from app import create_app, startup
+from app.config import Config
+from app.context import build_context
+from app.database import get_message_count, get_session_id, save_turn
+from app.llm import get_async_client, LLMUnavailableError
+from app.metrics import REQUEST_LATENCY
+from app.routes.chat import handle_github_command_async
+from app.routes.upload import prepare_upload_content
+from app.streaming import EMPTY_REPLY_ERROR, sse_event
+
+SPOOL_MAX_MEMORY = 1024 * 1024  # request bodies above this go to a temp file
+
+class RequestTooLarge(Exception):
+    pass
+
+class ReceiveStream:
+    """wsgi.input that reads the request body from the ASGI connection as it is consumed.
+
+    read() is called on a pool thread; it waits for the event loop to
+    receive the next piece of the body.
+    """
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.buffer = b''
+        self.done = False
+
+    def _receive(self):
+        message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+        if message['type'] == 'http.disconnect':
+            raise OSError('Client disconnected while sending the request body')
+        self.buffer += message.get('body', b'')
+        self.done = not message.get('more_body')
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            self._receive()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+class FlaskResponse:
+    """Returned by request-context work to answer with a Flask response (e.g. a validation error)"""
+    def __init__(self, rv):
+        self.rv = rv
+        self.status = None
+        self.headers = None
+        self.body = None
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope and its (file-like) request body"""
+    script_name = scope.get('root_path', '').encode('utf8').decode('latin1')
+    path_info = scope['path'].encode('utf8').decode('latin1')
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+class AsyncApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(Config.ASYNC_THREADS, thread_name_prefix='asgi-sync')
+        self.routes = {
+            '/chat': functools.partial(self.chat, stream=False),
+            '/chat/stream': functools.partial(self.chat, stream=True),
+            '/upload': functools.partial(self.upload, stream=False),
+            '/upload/stream': functools.partial(self.upload, stream=True),
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        handler = self.routes.get(scope['path']) if scope['method'] == 'POST' else None
+
+        if scope['path'].startswith('/upload'):
+            # Werkzeug enforces MAX_CONTENT_LENGTH as it reads
+            environ = build_environ(scope, ReceiveStream(receive, asyncio.get_running_loop()))
+            environ['wsgi.input_terminated'] = True
+            return await self.dispatch(scope, handler, environ, receive, send)
+
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY) as body:
+            try:
+                await self.read_body(receive, body)
+            except RequestTooLarge:
+                return await self.send_json(send, {'error': 'Request too large'}, 413)
+            await self.dispatch(scope, handler, build_environ(scope, body), receive, send)
+
+    async def dispatch(self, scope, handler, environ, receive, send):
+        if handler is None:
+            # Timed by the Flask app's own request hooks
+            await self.call_flask(environ, send)
+        elif not await self.wait_until_ready():
+            await self.send_json(send, {
+                'success': False,
+                'error': 'The server is still starting; try again shortly'
+            }, 503, [('Retry-After', '5')])
+        else:
+            await self.timed(scope['path'], handler, environ, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Plumbing
+
+    async def timed(self, route, handler, environ, receive, send):
+        """Run a route handler, observing its latency as the Flask request hooks do"""
+        started = time.perf_counter()
+        status = []
+
+        async def send_and_capture(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+            await send(message)
+
+        try:
+            await handler(environ, receive, send_and_capture)
+        finally:
+            REQUEST_LATENCY.labels('POST', route, status[0] if status else 500).observe(
+                time.perf_counter() - started
+            )
+
+    async def wait_until_ready(self):
+        """The async routes' side of startup.readiness_gate: wait for the worker without holding a thread"""
+        deadline = time.monotonic() + Config.STARTUP_READY_TIMEOUT_SECONDS
+        while not startup.is_ready():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return not startup.init_failed()
+
+    async def run_sync(self, func, *args):
+        """Run blocking work (database, parsing, extraction) on the thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def read_body(self, receive, body):
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > Config.MAX_CONTENT_LENGTH:
+                raise RequestTooLarge()
+            body.write(chunk)
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+
+    def _in_request_context(self, environ, func):
+        """Run func in a Flask request context; returns (result, Set-Cookie headers)"""
+        with self.flask_app.request_context(environ) as ctx:
+            result = func()
+            if isinstance(result, FlaskResponse):
+                # Serialize while the app context is still pushed
+                response = self.flask_app.make_response(result.rv)
+                result.status = response.status_code
+                result.headers = list(response.headers.items())
+                result.body = response.get_data()
+            cookie_response = self.flask_app.response_class()
+            self.flask_app.session_interface.save_session(self.flask_app, ctx.session, cookie_response)
+            return result, [('set-cookie', c) for c in cookie_response.headers.getlist('Set-Cookie')]
+
+    async def in_request_context(self, environ, func):
+        return await self.run_sync(self._in_request_context, environ, func)
+
+    def _call_flask(self, environ):
+        captured = {}
+
+        def start_response(status, headers, exc_info=None):
+            captured['status'] = int(status.split(' ', 1)[0])
+            captured['headers'] = headers
+
+        result = self.flask_app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return captured['status'], captured['headers'], body
+
+    async def call_flask(self, environ, send):
+        status, headers, body = await self.run_sync(self._call_flask, environ)
+        await self.send_response(send, status, headers, body)
+
+    async def send_response(self, send, status, headers, body):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def send_json(self, send, payload, status=200, headers=()):
+        headers = [('Content-Type', 'application/json')] + list(headers)
+        await self.send_response(send, status, headers, json.dumps(payload).encode())
+
+    async def send_error(self, send, error, cookies, where):
+        if isinstance(error, LLMUnavailableError):
+            # Shedding load; the client should retry later
+            return await self.send_json(send, {'error': str(error)}, 503,
+                                        cookies + [('Retry-After', str(error.retry_after))])
+        if isinstance(error, RequestEntityTooLarge):
+            return await self.send_json(send, {'error': 'Request too large'}, 413, cookies)
+        if isinstance(error, HTTPException):
+            # Raised while parsing the request body, e.g. the client went away
+            return await self.send_json(send, {'error': error.description}, error.code, cookies)
+        print(f"Error in {where}: {str(error)}")
+        traceback.print_exc()
+        await self.send_json(send, {'error': str(error)}, 500, cookies)
+
+    # Routes
+
+    async def chat(self, environ, receive, send, stream):
+        def parse():
+            data = request.get_json()
+            return data.get('message', ''), get_session_id()
+
+        cookies = []
+        try:
+            (message, session_id), cookies = await self.in_request_context(environ, parse)
+            if not message:
+                return await self.send_json(send, {'error': 'No message provided'}, 400, cookies)
+
+            # Check for GitHub commands
+            github_response = await handle_github_command_async(message)
+            if github_response:
+                message = f"{github_response}\n\nUser's question: {message}"
+
+            system, messages = await self.run_sync(build_context, session_id, message)
+
+            if stream:
+                return await self.stream_reply(receive, send, cookies, session_id, system, messages, message)
+
+            response = await get_async_client().messages.create(
+                model="claude-3-7-sonnet-20250219",
+                max_tokens=4096,
+                system=system,
+                messages=messages
+            )
+            await self.run_sync(save_turn, session_id, message, response.content[0].text)
+            await self.send_json(send, {
+                'response': response.content[0].text,
+                'conversation_length': await self.run_sync(get_message_count, session_id)
+            }, 200, cookies)
+        except Exception as e:
+            await self.send_error(send, e, cookies, 'async chat endpoint')
+
+    async def upload(self, environ, receive, send, stream):
+        def prepare():
+            session_id = get_session_id()
+            user_content, filename, has_file, error_response = prepare_upload_content()
+            if error_response:
+                return FlaskResponse(error_response)
+            system, messages = build_context(session_id, user_content)
+            return session_id, user_content, filename, has_file, system, messages
+
+        cookies = []
+        try:
+            result, cookies = await self.in_request_context(environ, prepare)
+            if isinstance(result, FlaskResponse):
+                return await self.send_response(send, result.status, result.headers + cookies, result.body)
+            session_id, user_content, filename, has_file, system, messages = result
+
+            if stream:
+                return await self.stream_reply(
+                    receive, send, cookies, session_id, system, messages, user_content,
+                    start_data={'filename': filename, 'has_file': has_file}
+                )
+
+            response = await get_async_client().messages.create(
+                model="claude-3-7-sonnet-20250219",
+                max_tokens=4096,
+                system=system,
+                messages=messages
+            )
+            await self.run_sync(save_turn, session_id, user_content, response.content[0].text)
+            await self.send_json(send, {
+                'success': True,
+                'analysis': response.content[0].text,
+                'filename': filename if filename else None,
+                'has_file': has_file,
+                'conversation_length': await self.run_sync(get_message_count, session_id)
+            }, 200, cookies)
+        except Exception as e:
+            await self.send_error(send, e, cookies, 'async upload route')
+
+    async def stream_reply(self, receive, send, cookies, session_id, system, messages, user_content, start_data=None):
+        """Async counterpart of app.streaming.stream_claude_response"""
+        client = get_async_client()
+        # Fail with a 503 now rather than as an error event after the response has started
+        client.check_available()
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ] + [(k.encode('latin1'), v.encode('latin1')) for k, v in cookies]
+        })
+
+        async def send_event(event, data):
+            await send({'type': 'http.response.body', 'body': sse_event(event, data).encode(), 'more_body': True})
+
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.create_task(watch_disconnect())
+        chunks = []
+        saved = False
+        try:
+            async with client.messages.stream(
+                model="claude-3-7-sonnet-20250219",
+                max_tokens=4096,
+                system=system,
+                messages=messages
+            ) as claude_stream:
+                await send_event('start', start_data or {})
+                async for text in claude_stream.text_stream:
+                    if disconnected.is_set():
+                        print(f"Client disconnected from stream for session {session_id}")
+                        break
+                    chunks.append(text)
+                    await send_event('delta', {'text': text})
+
+            reply = ''.join(chunks)
+            if not disconnected.is_set() and not reply.strip():
+                await send_event('error', {'error': EMPTY_REPLY_ERROR})
+            elif not disconnected.is_set():
+                # Save before telling the client we're done so a follow-up request sees the turn
+                await self.run_sync(save_turn, session_id, user_content, reply)
+                saved = True
+                await send_event('done', {
+                    'conversation_length': await self.run_sync(get_message_count, session_id)
+                })
+        except Exception as e:
+            print(f"Error while streaming response: {str(e)}")
+            traceback.print_exc()
+            if not disconnected.is_set():
+                await send_event('error', {'error': str(e)})
+        finally:
+            watcher.cancel()
+            # Keep a partial reply, as the WSGI stream does
+            if not saved and ''.join(chunks).strip():
+                await self.run_sync(save_turn, session_id, user_content, ''.join(chunks))
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+
+def create_asgi_app():
+    return AsyncApp(create_app())
@@ -0,0 +1,78 @@
+# app/attachments.py
+"""Out-of-line storage for binary message content.
+
+Images are stored once in the attachments table (raw bytes, keyed by SHA256)
+and messages keep a small reference block in their place:
+
+    {"type": "image", "source": {"type": "attachment", "attachment_id": ..., "media_type": ...}}
+
+History reads and listings only ever see the reference; the base64 data is put
+back by attach_data() when a payload is built for the API.
+"""
+import base64
+import hashlib
+
+def is_attachment_ref(block):
+    return (isinstance(block, dict)
+            and isinstance(block.get('source'), dict)
+            and block['source'].get('type') == 'attachment')
+
+def detach_content(content):
+    """Replace inline base64 images with attachment references.
+
+    Returns (content, attachments) where attachments is a list of
+    (attachment_id, media_type, raw_bytes). The input is not modified.
+    """
+    if not isinstance(content, list):
+        return content, []
+
+    detached = []
+    attachments = []
+    for block in content:
+        source = block.get('source') if isinstance(block, dict) else None
+        if (isinstance(block, dict) and block.get('type') == 'image'
+                and isinstance(source, dict) and source.get('type') == 'base64'):
+            raw = base64.b64decode(source['data'])
+            attachment_id = hashlib.sha256(raw).hexdigest()
+            attachments.append((attachment_id, source['media_type'], raw))
+            detached.append({
+                'type': 'image',
+                'source': {
+                    'type': 'attachment',
+                    'attachment_id': attachment_id,
+                    'media_type': source['media_type']
+                }
+            })
+        else:
+            detached.append(block)
+    return detached, attachments
+
+def attachment_ids(content):
+    """Attachment ids referenced by a message's content"""
+    if not isinstance(content, list):
+        return []
+    return [block['source']['attachment_id'] for block in content if is_attachment_ref(block)]
+
+def attach_data(content, data_by_id):
+    """Return content with attachment references replaced by inline base64 blocks.
+
+    data_by_id maps attachment_id to its base64 string. The input is not modified.
+    """
+    if not isinstance(content, list) or not any(is_attachment_ref(b) for b in content):
+        return content
+
+    attached = []
+    for block in content:
+        if is_attachment_ref(block):
+            attachment_id = block['source']['attachment_id']
+            attached.append({
+                'type': 'image',
+                'source': {
+                    'type': 'base64',
+                    'media_type': block['source']['media_type'],
+                    'data': data_by_id[attachment_id]
+                }
+            })
+        else:
+            attached.append(block)
+    return attached
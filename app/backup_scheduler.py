@@ -0,0 +1,305 @@
+# app/backup_scheduler.py
+"""Background database backups.
+
+Every gunicorn worker starts a BackupScheduler, but only the worker holding an
+exclusive flock on backup.leader runs the periodic loop; the others keep
+retrying so a replacement takes over when the leader exits. Any backup, from
+the scheduler, an admin request or shutdown, runs under a second flock on
+backup.lock so two backups never overlap. Progress and the last result are
+kept in backup_status.json in the data directory so every worker can report
+them.
+
+The leader also runs retention (app.retention) every
+RETENTION_INTERVAL_SECONDS when RETENTION_ENABLED is set. It takes the same
+backup lock: archiving and vacuuming rewrite pages, which would make a
+snapshot in progress start over.
+"""
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from app.config import Config
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+class BackupScheduler:
+    def __init__(self):
+        self.is_leader = False
+        self._leader_fd = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def leader_lock_path(self):
+        return Config.DATA_DIR / 'backup.leader'
+
+    @property
+    def backup_lock_path(self):
+        return Config.DATA_DIR / 'backup.lock'
+
+    @property
+    def status_path(self):
+        return Config.DATA_DIR / 'backup_status.json'
+
+    @property
+    def request_path(self):
+        return Config.DATA_DIR / 'backup.request'
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the scheduler thread for this process and register the shutdown flush"""
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    # Status shared between workers
+
+    def get_status(self):
+        try:
+            with open(self.status_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'state': 'idle'}
+
+    def _update_status(self, **changes):
+        status = self.get_status()
+        status.update(changes)
+        tmp_path = self.status_path.with_name(f'{self.status_path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp_path, self.status_path)
+        return status
+
+    # Leader election
+
+    def _try_become_leader(self):
+        fd = os.open(self.leader_lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # Keep the fd open for the life of the process; the kernel releases the
+        # lock if this worker dies or is recycled
+        self._leader_fd = fd
+        self.is_leader = True
+        self._update_status(leader_pid=os.getpid(), leader_since=_now())
+        print(f"Backup scheduler: worker {os.getpid()} is the backup leader")
+        return True
+
+    # Requests
+
+    def request_backup(self):
+        """Ask the leader to run a backup soon; repeated requests coalesce into one"""
+        requested_at = time.time()
+        self.request_path.touch()
+        os.utime(self.request_path, (requested_at, requested_at))
+        self._update_status(requested_at=_now())
+        self._wake.set()
+        return requested_at
+
+    def _pending_request_time(self):
+        try:
+            return os.path.getmtime(self.request_path)
+        except FileNotFoundError:
+            return None
+
+    def wait_for_backup(self, requested_at, timeout):
+        """Wait for a backup that started after requested_at; returns its status or None"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            status = self.get_status()
+            if status.get('state') != 'running' and status.get('last_started_ts', 0) >= requested_at:
+                return status
+            time.sleep(0.5)
+        return None
+
+    # Running backups
+
+    @contextmanager
+    def _backup_lock(self, blocking):
+        """Hold the cross-process backup lock; yields False if not blocking and it is taken"""
+        fd = os.open(self.backup_lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
+
+    def run_backup(self, reason, blocking=True):
+        """Run one backup under the cross-process backup lock.
+
+        Returns the cloud_storage result dict, or None if blocking is False
+        and another backup is already running.
+        """
+        from app.cloud_storage import run_backup
+
+        with self._backup_lock(blocking) as locked:
+            if not locked:
+                return None
+
+            started = time.time()
+            # Requests made before this point are covered by this backup
+            try:
+                if (self._pending_request_time() or 0) <= started:
+                    self.request_path.unlink()
+            except FileNotFoundError:
+                pass
+            self._update_status(
+                state='running', reason=reason, pid=os.getpid(),
+                started_at=_now(), last_started_ts=started,
+                phase='starting', done=0, total=0
+            )
+
+            def progress(phase, done, total):
+                self._update_status(phase=phase, done=done, total=total)
+
+            try:
+                result = run_backup(progress)
+            except Exception as e:
+                traceback.print_exc()
+                result = {'result': 'failed', 'message': str(e)}
+
+            duration = round(time.time() - started, 3)
+            changes = dict(
+                state='idle', phase=None,
+                last_finished_at=_now(), last_result=result['result'],
+                last_message=result['message'], last_duration_seconds=duration
+            )
+            if result['result'] == 'success':
+                changes.update(
+                    last_success_at=_now(),
+                    last_uploaded_bytes=result['manifest']['uploaded_bytes'],
+                    last_database_bytes=result['manifest']['size']
+                )
+            self._update_status(**changes)
+            return result
+
+    def run_retention(self, reason, blocking=True, dry_run=False):
+        """Run one retention pass under the backup lock.
+
+        Returns the app.retention result dict, or None if blocking is False
+        and a backup or retention run holds the lock.
+        """
+        from app.retention import run_retention
+
+        with self._backup_lock(blocking) as locked:
+            if not locked:
+                return None
+            try:
+                result = run_retention(dry_run=dry_run)
+            except Exception as e:
+                traceback.print_exc()
+                result = {'result': 'failed', 'message': str(e)}
+            if not dry_run:
+                self._update_status(retention={
+                    'reason': reason, 'finished_at': _now(), 'pid': os.getpid(), **result
+                })
+            print(f"Retention ({reason}): {result['message']}")
+            return result
+
+    def _backup_due(self, last_run):
+        from app.cloud_storage import get_last_backup_info
+        from app.database import get_change_counter
+
+        request_time = self._pending_request_time()
+        if request_time is not None:
+            return 'requested'
+
+        # Databases never backed up with a counter count every write since creation
+        backup_info = get_last_backup_info()
+        baseline = backup_info['change_counter'] if backup_info else None
+        writes = get_change_counter() - (baseline or 0)
+        if writes <= 0 and baseline is not None:
+            return None
+        if writes >= Config.BACKUP_AFTER_WRITES:
+            return 'writes'
+        if time.time() - last_run >= Config.BACKUP_INTERVAL_SECONDS:
+            return 'interval'
+        return None
+
+    def _run(self):
+        last_run = last_retention = time.time()
+        while not self._stopping.is_set():
+            try:
+                if not self.is_leader and not self._try_become_leader():
+                    self._stopping.wait(Config.BACKUP_LEADER_RETRY_SECONDS)
+                    continue
+
+                reason = self._backup_due(last_run)
+                if reason:
+                    self.run_backup(reason, blocking=False)
+                    last_run = time.time()
+
+                if (Config.RETENTION_ENABLED
+                        and time.time() - last_retention >= Config.RETENTION_INTERVAL_SECONDS):
+                    self.run_retention('interval', blocking=False)
+                    last_retention = time.time()
+            except Exception as e:
+                print(f"Backup scheduler error: {str(e)}")
+                traceback.print_exc()
+
+            self._wake.wait(Config.BACKUP_CHECK_SECONDS)
+            self._wake.clear()
+
+    def shutdown(self):
+        """Bounded final backup when the worker exits.
+
+        Runs in the atexit handler itself: new threads can't be started at
+        interpreter shutdown (Python 3.12+), so the deadline is enforced by
+        the backup store's operations instead (storage_deadline).
+        """
+        self._stopping.set()
+        self._wake.set()
+
+        from app.backup_storage import storage_deadline
+        from app.cloud_storage import has_database_changed
+        from app.database import flush_pending_writes
+
+        # Every worker tries, not just the leader: whichever exits last catches
+        # the writes of the others. The backup lock and change check make the
+        # extra attempts cheap no-ops.
+        deadline = time.monotonic() + Config.BACKUP_SHUTDOWN_TIMEOUT_SECONDS
+        try:
+            flush_pending_writes(Config.DB_WRITE_BEHIND_SHUTDOWN_TIMEOUT)
+            if not has_database_changed():
+                return
+        except Exception as e:
+            print(f"Skipping shutdown backup: {str(e)}")
+            return
+
+        with storage_deadline(max(0, deadline - time.monotonic())):
+            # Wait for a backup already running (here or in another worker)
+            # without blocking past the deadline on its lock
+            while self.run_backup('shutdown', blocking=False) is None:
+                if time.monotonic() >= deadline:
+                    print("Shutdown backup did not finish in time; the next backup will pick up the changes")
+                    return
+                time.sleep(0.1)
+
+backup_scheduler = BackupScheduler()
+
+def start_backup_scheduler():
+    """Start background backups if they are enabled and storage is configured"""
+    from app.backup_storage import get_backup_storage
+
+    if not Config.BACKUP_SCHEDULER_ENABLED or get_backup_storage() is None:
+        print("Backup scheduler disabled")
+        return
+    backup_scheduler.start()
@@ -0,0 +1,212 @@
+# app/backup_storage.py
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from app.config import Config
+
+# Per thread: monotonic time by which store operations must finish (see storage_deadline)
+_local = threading.local()
+
+class BackupStorageError(Exception):
+    """Raised when the backup store cannot be read or written"""
+    pass
+
+class BackupNotFoundError(BackupStorageError):
+    """Raised when a requested object does not exist in the backup store"""
+    pass
+
+@contextmanager
+def storage_deadline(seconds):
+    """Make this thread's store operations in the block fail with BackupStorageError once seconds have passed.
+
+    Blocks nest; an inner block can only shorten the deadline.
+    """
+    outer = getattr(_local, 'deadline', None)
+    deadline = time.monotonic() + seconds
+    _local.deadline = deadline if outer is None else min(outer, deadline)
+    try:
+        yield
+    finally:
+        _local.deadline = outer
+
+def _remaining_time():
+    """Seconds left before this thread's storage deadline, or None without one"""
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise BackupStorageError('Backup storage deadline passed')
+    return remaining
+
+class BackupStorage:
+    """Minimal object store used for backups. Keys are '/'-separated paths."""
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def list_keys(self, prefix):
+        """Return the set of keys starting with prefix"""
+        raise NotImplementedError
+
+    def put_bytes(self, key, data):
+        raise NotImplementedError
+
+    def get_bytes(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Delete an object; a missing one is not an error"""
+        raise NotImplementedError
+
+    def put_files(self, prefix, paths):
+        """Upload local files to prefix + basename(path)"""
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.put_bytes(prefix + os.path.basename(path), f.read())
+
+    def get_files(self, keys, dest_dir):
+        """Download keys into dest_dir, each saved under its basename"""
+        for key in keys:
+            with open(os.path.join(dest_dir, os.path.basename(key)), 'wb') as f:
+                f.write(self.get_bytes(key))
+
+    def describe(self):
+        raise NotImplementedError
+
+class LocalBackupStorage(BackupStorage):
+    """Backup store on the local filesystem, used for development and offline testing"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        return self.root / key
+
+    def exists(self, key):
+        return self._path(key).exists()
+
+    def list_keys(self, prefix):
+        base = self._path(prefix) if prefix.endswith('/') else self._path(prefix).parent
+        if not base.exists():
+            return set()
+        keys = set()
+        for path in base.rglob('*'):
+            if path.is_file() and not path.name.endswith('.tmp'):
+                key = path.relative_to(self.root).as_posix()
+                if key.startswith(prefix):
+                    keys.add(key)
+        return keys
+
+    def put_bytes(self, key, data):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so readers never see a partial object
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get_bytes(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise BackupNotFoundError(key)
+
+    def delete(self, key):
+        self._path(key).unlink(missing_ok=True)
+
+    def put_files(self, prefix, paths):
+        for path in paths:
+            dest = self._path(prefix + os.path.basename(path))
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = dest.with_name(dest.name + '.tmp')
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, dest)
+
+    def describe(self):
+        return f'file://{self.root}'
+
+class GCSBackupStorage(BackupStorage):
+    """Backup store in a Cloud Storage bucket, driven through gsutil"""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def _url(self, key):
+        return f'gs://{self.bucket}/{key}'
+
+    def _run(self, args, key=None, **kwargs):
+        try:
+            return subprocess.run(['gsutil'] + args, check=True, capture_output=True,
+                                  timeout=_remaining_time(), **kwargs)
+        except subprocess.TimeoutExpired:
+            raise BackupStorageError(f"gsutil {' '.join(args[:2])} timed out")
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode(errors='replace') if isinstance(e.stderr, bytes) else str(e.stderr)
+            if 'No URLs matched' in stderr or 'NotFound' in stderr or 'No such object' in stderr:
+                raise BackupNotFoundError(key or ' '.join(args))
+            raise BackupStorageError(f"gsutil {' '.join(args[:2])} failed: {stderr.strip()}")
+
+    def exists(self, key):
+        try:
+            self._run(['-q', 'stat', self._url(key)], key)
+            return True
+        except BackupStorageError:
+            return False
+
+    def list_keys(self, prefix):
+        try:
+            result = self._run(['ls', self._url(prefix) + '**'], prefix)
+        except BackupNotFoundError:
+            return set()
+        base = f'gs://{self.bucket}/'
+        return {
+            line[len(base):]
+            for line in result.stdout.decode().splitlines()
+            if line.startswith(base)
+        }
+
+    def put_bytes(self, key, data):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            self._run(['cp', f.name, self._url(key)], key)
+
+    def get_bytes(self, key):
+        return self._run(['cat', self._url(key)], key).stdout
+
+    def delete(self, key):
+        try:
+            self._run(['-q', 'rm', self._url(key)], key)
+        except BackupNotFoundError:
+            pass
+
+    def put_files(self, prefix, paths):
+        # One parallel gsutil invocation instead of a process per file
+        if paths:
+            self._run(['-m', 'cp', '-I', self._url(prefix)], prefix,
+                      input='\n'.join(str(p) for p in paths).encode())
+
+    def get_files(self, keys, dest_dir):
+        if keys:
+            self._run(['-m', 'cp', '-I', str(dest_dir)],
+                      input='\n'.join(self._url(k) for k in keys).encode())
+
+    def describe(self):
+        return f'gs://{self.bucket}'
+
+def get_backup_storage():
+    """Return the configured backup store, or None if backups are not configured"""
+    if Config.BACKUP_STORAGE == 'local':
+        return LocalBackupStorage(Config.BACKUP_LOCAL_DIR)
+    if Config.BACKUP_STORAGE == 'gcs' and Config.GCS_BUCKET_NAME:
+        return GCSBackupStorage(Config.GCS_BUCKET_NAME)
+    return None
@@ -0,0 +1,118 @@
+# app/cache.py
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by an estimated total size in bytes.
+
+    Values are stored with a caller-supplied size estimate; the least recently
+    used entries are evicted once the total exceeds max_bytes. Cached values are
+    shared with callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_bytes, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None, validate=None):
+        """Return the cached value and mark it most recently used.
+
+        If validate is given it is called (outside the lock) with the cached
+        value; a falsy result drops the entry and counts as a miss.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+
+        if validate is not None and not validate(item[0]):
+            with self._lock:
+                if self._data.get(key) is item:
+                    del self._data[key]
+                    self._size -= item[1]
+                self.misses += 1
+            return default
+
+        with self._lock:
+            if self._data.get(key) is item:
+                self._data.move_to_end(key)
+            self.hits += 1
+        return item[0]
+
+    def peek(self, key, default=None):
+        """Return the cached value without touching LRU order or counters"""
+        with self._lock:
+            item = self._data.get(key)
+            return default if item is None else item[0]
+
+    def set(self, key, value, size):
+        """Store a value with its estimated size, evicting old entries as needed"""
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            if size > self.max_bytes:
+                # Too big to ever fit; caching it would just flush everything else
+                return
+            self._data[key] = (value, size)
+            self._size += size
+            self._evict()
+
+    def update(self, key, func):
+        """Atomically replace a cached value with func(value) -> (value, size).
+
+        Does nothing if the key is not cached. If func returns None the entry
+        is dropped.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return
+            result = func(item[0])
+            self._size -= item[1]
+            if result is None:
+                del self._data[key]
+                return
+            value, size = result
+            self._data[key] = (value, size)
+            self._size += size
+            self._data.move_to_end(key)
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self._size -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def _evict(self):
+        while self._data and (self._size > self.max_bytes or
+                              (self.max_entries and len(self._data) > self.max_entries)):
+            _, (_, size) = self._data.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'size_bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None
+            }
@@ -1,105 +1,278 @@
 # app/cloud_storage.py
 import hashlib
-import subprocess
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import zlib
 from datetime import datetime
+from app.backup_storage import get_backup_storage, BackupStorageError, BackupNotFoundError
 from app.config import Config
-from app.database import get_db
+from app.database import get_db, checkpoint_database, reset_connections, clear_history_cache, get_change_counter
+from app.metrics import BACKUP_LATENCY, BACKUP_SNAPSHOT_BYTES, BACKUP_UPLOADED_BYTES
+
+# Only used once per backup, so read in large blocks
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Layout of the backup store
+CHUNK_PREFIX = 'chunks/'
+MANIFEST_PREFIX = 'manifests/'
+LATEST_MANIFEST_KEY = 'manifests/latest.json'
+LEGACY_BACKUP_KEY = 'chat_history.db'
+
+class RestoreError(BackupStorageError):
+    """Raised when a backup exists but could not be restored"""
+    pass
 
 def get_database_hash():
     """Calculate SHA256 hash of the database file"""
     if not Config.DATABASE_PATH.exists():
         return None
     
+    # Recent commits live in the WAL until checkpointed into the main file
+    checkpoint_database()
+    
     sha256_hash = hashlib.sha256()
     with open(Config.DATABASE_PATH, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b""):
             sha256_hash.update(chunk)
     return sha256_hash.hexdigest()
 
+def get_last_backup_info():
+    """Return the most recent backup metadata row, or None"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT last_backup_hash, last_backup_timestamp, change_counter
+            FROM db_metadata
+            ORDER BY id DESC
+            LIMIT 1
+        ''')
+        return cursor.fetchone()
+
 def has_database_changed():
     """Check if database has changed since last backup"""
-    current_hash = get_database_hash()
-    if not current_hash:
+    if not Config.DATABASE_PATH.exists():
         return False
     
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT last_backup_hash FROM db_metadata ORDER BY id DESC LIMIT 1')
-        result = cursor.fetchone()
-        
-        if not result or result['last_backup_hash'] != current_hash:
-            return True
-    return False
+    # O(1): compare the trigger-maintained write counter with the one recorded at
+    # the last backup instead of hashing the whole file
+    backup_info = get_last_backup_info()
+    if not backup_info or backup_info['change_counter'] is None:
+        return True
+    return get_change_counter() != backup_info['change_counter']
 
-def update_backup_metadata(db_hash=None):
-    """Update the backup metadata with new hash"""
+def update_backup_metadata(db_hash=None, change_counter=None):
+    """Update the backup metadata with new hash and write counter"""
+    if change_counter is None:
+        change_counter = get_change_counter()
     if db_hash is None:
         db_hash = get_database_hash()
     
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO db_metadata (last_backup_hash)
-            VALUES (?)
-        ''', (db_hash,))
+            INSERT INTO db_metadata (last_backup_hash, change_counter)
+            VALUES (?, ?)
+        ''', (db_hash, change_counter))
         conn.commit()
 
-def upload_database():
-    """Upload database to Cloud Storage with change detection"""
-    if not Config.GCS_BUCKET_NAME:
-        print("GCS_BUCKET_NAME not set. Skipping database upload.")
-        return False
+def create_snapshot(dest_path):
+    """Write a consistent copy of the live database using SQLite's online backup API"""
+    dest = sqlite3.connect(str(dest_path))
+    try:
+        with get_db() as conn:
+            # A single step copies every page inside one read transaction, so the
+            # snapshot is consistent and writers are not blocked in WAL mode
+            conn.backup(dest, pages=-1)
+    finally:
+        dest.close()
+
+def _chunk_key(chunk_hash):
+    return f'{CHUNK_PREFIX}{chunk_hash}.z'
+
+def upload_snapshot(storage, snapshot_path, staging_dir, progress=None):
+    """Split a snapshot into content-addressed chunks and upload the ones the store lacks.
+    
+    Returns the manifest describing the snapshot. progress(phase, done, total)
+    is called as chunks are processed.
+    """
+    existing = storage.list_keys(CHUNK_PREFIX)
+    total_chunks = -(-os.path.getsize(snapshot_path) // Config.BACKUP_CHUNK_SIZE)
+    file_hash = hashlib.sha256()
+    chunk_hashes = []
+    new_chunks = []
+    uploaded_bytes = 0
+    
+    with open(snapshot_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(Config.BACKUP_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+            chunk_hash = hashlib.sha256(chunk).hexdigest()
+            chunk_hashes.append(chunk_hash)
+            if progress:
+                progress('chunking', len(chunk_hashes), total_chunks)
+            
+            key = _chunk_key(chunk_hash)
+            if key in existing:
+                continue
+            existing.add(key)
+            
+            compressed = zlib.compress(chunk, 6)
+            chunk_path = os.path.join(staging_dir, os.path.basename(key))
+            with open(chunk_path, 'wb') as out:
+                out.write(compressed)
+            new_chunks.append(chunk_path)
+            uploaded_bytes += len(compressed)
+    
+    if progress:
+        progress('uploading', 0, len(new_chunks))
+    storage.put_files(CHUNK_PREFIX, new_chunks)
+    
+    return {
+        'format': 1,
+        'created_at': datetime.now().strftime('%Y%m%d_%H%M%S'),
+        'size': os.path.getsize(snapshot_path),
+        'sha256': file_hash.hexdigest(),
+        'chunk_size': Config.BACKUP_CHUNK_SIZE,
+        'chunks': chunk_hashes,
+        'uploaded_chunks': len(new_chunks),
+        'uploaded_bytes': uploaded_bytes
+    }
+
+def run_backup(progress=None):
+    """Back up the database if it changed and return a result dict.
+    
+    Takes an online snapshot, uploads only the chunks that are not already in
+    the store, then publishes a timestamped manifest and moves manifests/latest.json.
+    The result has 'result' ('success', 'skipped' or 'failed'), 'message' and,
+    on success, 'manifest'.
+    """
+    started = time.perf_counter()
+    result = _run_backup(progress)
+    BACKUP_LATENCY.labels(result['result']).observe(time.perf_counter() - started)
+    if result['result'] == 'success':
+        BACKUP_SNAPSHOT_BYTES.set(result['manifest']['size'])
+        BACKUP_UPLOADED_BYTES.inc(result['manifest']['uploaded_bytes'])
+    return result
+
+def _run_backup(progress):
+    """run_backup() without the metrics"""
+    storage = get_backup_storage()
+    if storage is None:
+        print("Backup storage not configured. Skipping database upload.")
+        return {'result': 'skipped', 'message': 'Backup storage not configured'}
     
     if not has_database_changed():
         print("Database unchanged since last backup. Skipping upload.")
-        return False
+        return {'result': 'skipped', 'message': 'No changes since last backup'}
     
-    # Get current hash before upload
-    current_hash = get_database_hash()
+    # Read the counter before the snapshot; anything written after this point
+    # is picked up by the next backup
+    change_counter = get_change_counter()
     
-    # Upload to Cloud Storage
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     try:
-        # Upload current database
-        subprocess.run([
-            'gsutil', 'cp', str(Config.DATABASE_PATH),
-            f'gs://{Config.GCS_BUCKET_NAME}/chat_history.db'
-        ], check=True)
+        with tempfile.TemporaryDirectory(dir=Config.DATA_DIR) as staging_dir:
+            snapshot_path = os.path.join(staging_dir, 'snapshot.db')
+            if progress:
+                progress('snapshot', 0, 1)
+            create_snapshot(snapshot_path)
+            manifest = upload_snapshot(storage, snapshot_path, staging_dir, progress)
         
-        # Upload timestamped backup
-        subprocess.run([
-            'gsutil', 'cp', str(Config.DATABASE_PATH),
-            f'gs://{Config.GCS_BUCKET_NAME}/backups/chat_history_{timestamp}.db'
-        ], check=True)
+        if progress:
+            progress('manifest', 0, 1)
+        manifest['change_counter'] = change_counter
+        manifest_data = json.dumps(manifest).encode()
+        storage.put_bytes(f"{MANIFEST_PREFIX}chat_history_{manifest['created_at']}.json", manifest_data)
+        storage.put_bytes(LATEST_MANIFEST_KEY, manifest_data)
         
         # Update metadata on successful upload
-        update_backup_metadata(current_hash)
-        print(f"Database backed up successfully at {timestamp}")
-        return True
+        update_backup_metadata(manifest['sha256'], change_counter)
+        message = (f"{manifest['uploaded_chunks']}/{len(manifest['chunks'])} chunks, "
+                   f"{manifest['uploaded_bytes']} bytes uploaded")
+        print(f"Database backed up successfully at {manifest['created_at']}: {message}")
+        return {'result': 'success', 'message': message, 'manifest': manifest}
         
-    except subprocess.CalledProcessError as e:
+    except (BackupStorageError, sqlite3.Error, OSError) as e:
         print(f"Error uploading database: {e}")
-        return False
+        return {'result': 'failed', 'message': str(e)}
+
+def upload_database():
+    """Back up the database with change detection; True if a backup was written"""
+    return run_backup()['result'] == 'success'
+
+def _restore_from_manifest(storage, manifest, dest_path, staging_dir):
+    """Reassemble a snapshot from its chunks, verifying the whole-file hash"""
+    keys = sorted({_chunk_key(h) for h in manifest['chunks']})
+    storage.get_files(keys, staging_dir)
+    
+    file_hash = hashlib.sha256()
+    with open(dest_path, 'wb') as out:
+        for chunk_hash in manifest['chunks']:
+            with open(os.path.join(staging_dir, os.path.basename(_chunk_key(chunk_hash))), 'rb') as f:
+                try:
+                    chunk = zlib.decompress(f.read())
+                except zlib.error:
+                    raise BackupStorageError(f"Chunk {chunk_hash} is corrupt")
+            if hashlib.sha256(chunk).hexdigest() != chunk_hash:
+                raise BackupStorageError(f"Chunk {chunk_hash} is corrupt")
+            file_hash.update(chunk)
+            out.write(chunk)
+    
+    if file_hash.hexdigest() != manifest['sha256']:
+        raise BackupStorageError("Restored database does not match the manifest hash")
 
 def download_database():
-    """Download database from Cloud Storage"""
-    if not Config.GCS_BUCKET_NAME:
-        print("GCS_BUCKET_NAME not set. Skipping database download.")
+    """Restore the database from the latest backup.
+    
+    Returns True once restored, or False when there is nothing to restore
+    (no backup store, or no backup in it). Raises RestoreError when a backup
+    exists but can't be restored, e.g. a chunk is missing or corrupt; callers
+    must not then back up the fresh database over it.
+    """
+    storage = get_backup_storage()
+    if storage is None:
+        print("Backup storage not configured. Skipping database download.")
         return False
     
+    # Download next to the live file and swap it in, so open connections keep
+    # reading the old file instead of seeing a partially written one
+    download_path = Config.DATABASE_PATH.with_suffix('.db.download')
     try:
-        subprocess.run([
-            'gsutil', 'cp',
-            f'gs://{Config.GCS_BUCKET_NAME}/chat_history.db',
-            str(Config.DATABASE_PATH)
-        ], check=True)
+        with tempfile.TemporaryDirectory(dir=Config.DATA_DIR) as staging_dir:
+            try:
+                manifest_data = storage.get_bytes(LATEST_MANIFEST_KEY)
+            except BackupNotFoundError:
+                manifest_data = None
+            
+            if manifest_data is not None:
+                _restore_from_manifest(storage, json.loads(manifest_data), download_path, staging_dir)
+            else:
+                # Backups taken before chunked backups were a single database file
+                try:
+                    legacy_data = storage.get_bytes(LEGACY_BACKUP_KEY)
+                except BackupNotFoundError:
+                    print("No existing database found in backup storage. Starting fresh.")
+                    return False
+                with open(download_path, 'wb') as out:
+                    out.write(legacy_data)
+        
+        checkpoint_database()
+        reset_connections()
+        for suffix in ('-wal', '-shm'):
+            stale = f'{Config.DATABASE_PATH}{suffix}'
+            if os.path.exists(stale):
+                os.remove(stale)
+        os.replace(download_path, Config.DATABASE_PATH)
+        clear_history_cache()
         
         print("Database downloaded successfully")
         return True
         
-    except subprocess.CalledProcessError as e:
-        if 'No URLs matched' not in str(e):
-            print(f"Error downloading database: {e}")
-        else:
-            print("No existing database found in Cloud Storage. Starting fresh.")
-        return False
\ No newline at end of file
+    except (BackupStorageError, OSError, ValueError) as e:
+        # BackupNotFoundError here is a chunk the manifest lists
+        problem = f"missing {e}" if isinstance(e, BackupNotFoundError) else str(e)
+        print(f"Error downloading database: {problem}")
+        if download_path.exists():
+            download_path.unlink()
+        raise RestoreError(problem)
@@ -11,8 +11,8 @@ class Config:
     GCS_BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME')
     GOOGLE_APPLICATION_CREDENTIALS = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
     
-    # Paths
-    BASE_DIR = Path('/app')
+    # Paths (APP_BASE_DIR moves them, e.g. for the benchmark server in bench/)
+    BASE_DIR = Path(os.environ.get('APP_BASE_DIR', '/app'))
     DATA_DIR = BASE_DIR / 'data'
     UPLOADS_DIR = BASE_DIR / 'uploads'
     DATABASE_PATH = DATA_DIR / 'chat_history.db'
@@ -21,15 +21,163 @@ class Config:
     FLASK_ENV = os.environ.get('FLASK_ENV', 'production')
     MAX_CONTENT_LENGTH = 32 * 1024 * 1024  # 32MB
     
+    # Resumable uploads (POST /uploads) allow larger files, sent in pieces of
+    # at most MAX_CONTENT_LENGTH; unfinished ones are removed after the expiry
+    RESUMABLE_UPLOAD_MAX_BYTES = int(os.environ.get('RESUMABLE_UPLOAD_MAX_BYTES', 256 * 1024 * 1024))
+    RESUMABLE_UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024  # piece size suggested to clients
+    RESUMABLE_UPLOAD_EXPIRY_HOURS = int(os.environ.get('RESUMABLE_UPLOAD_EXPIRY_HOURS', 24))
+    
     # File processing
     ALLOWED_EXTENSIONS = {
         'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 
         'csv', 'json', 'py', 'js', 'html', 'css', 
-        'md', 'docx', 'doc'
+        'md', 'docx', 'doc', 'webp'
     }
     
+    # Uploaded images are downscaled to what the model actually looks at (long
+    # edge and pixel count; larger images are resized by the API anyway),
+    # stripped of metadata and re-encoded before they are stored and sent
+    IMAGE_PREPARE_ENABLED = os.environ.get('IMAGE_PREPARE_ENABLED', 'true').lower() == 'true'
+    IMAGE_MAX_EDGE_PX = int(os.environ.get('IMAGE_MAX_EDGE_PX', 1568))
+    IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 1150000))  # about 1,600 input tokens
+    IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 85))  # JPEG / WebP
+    
+    # Database connection settings
+    DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+    DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 64 * 1024 * 1024))  # 64MB
+    DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16 * 1024))  # 16MB per connection
+    
+    # Per-process cache of recent conversation history
+    HISTORY_CACHE_MAX_BYTES = int(os.environ.get('HISTORY_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # 64MB
+    HISTORY_CACHE_WINDOW = 50  # messages kept per cached session
+    # Other gunicorn workers can write the same session, so cache hits are
+    # checked with a single indexed lookup; set to false with a single worker
+    HISTORY_CACHE_VALIDATE = os.environ.get('HISTORY_CACHE_VALIDATE', 'true').lower() == 'true'
+    
+    # Write-behind: queue chat turns and group-commit them from a background
+    # thread. Cuts fsyncs under load, but a crash loses the last few queued turns
+    DB_WRITE_BEHIND = os.environ.get('DB_WRITE_BEHIND', 'false').lower() == 'true'
+    DB_WRITE_BEHIND_MAX_BATCH = int(os.environ.get('DB_WRITE_BEHIND_MAX_BATCH', 100))
+    DB_WRITE_BEHIND_MAX_DELAY_MS = int(os.environ.get('DB_WRITE_BEHIND_MAX_DELAY_MS', 50))
+    DB_WRITE_BEHIND_SHUTDOWN_TIMEOUT = 5  # seconds
+    
+    # Cache of parsed uploads (text / encoded images) by content hash, per process
+    EXTRACTION_CACHE_MAX_BYTES = int(os.environ.get('EXTRACTION_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # 64MB
+    
+    # Attachment data held in memory for rebuilding API payloads, per worker process
+    ATTACHMENT_CACHE_MAX_BYTES = int(os.environ.get('ATTACHMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024))  # 32MB
+    
+    # Document extraction runs in a per-worker process pool with limits
+    EXTRACTION_POOL_ENABLED = os.environ.get('EXTRACTION_POOL_ENABLED', 'true').lower() == 'true'
+    EXTRACTION_WORKERS = int(os.environ.get('EXTRACTION_WORKERS', 2))
+    EXTRACTION_TIMEOUT_SECONDS = int(os.environ.get('EXTRACTION_TIMEOUT_SECONDS', 60))  # per file
+    EXTRACTION_MEMORY_LIMIT_MB = int(os.environ.get('EXTRACTION_MEMORY_LIMIT_MB', 1024))  # per pool process
+    EXTRACTION_PDF_PAGES_PER_TASK = 25  # large PDFs are split into ranges of this many pages
+    EXTRACTION_TASKS_PER_PROCESS = 50  # recycle pool processes to release parser memory
+    
+    # Startup. With STARTUP_RESTORE=background (the default in scripts/start.sh)
+    # the server listens at once and each worker restores the database and
+    # runs migrations in the background; requests that need the database wait
+    # up to STARTUP_READY_TIMEOUT_SECONDS for that. 'blocking' restores in
+    # start.sh before the server starts; 'off' doesn't restore
+    STARTUP_RESTORE = os.environ.get('STARTUP_RESTORE', 'off')
+    STARTUP_READY_TIMEOUT_SECONDS = int(os.environ.get('STARTUP_READY_TIMEOUT_SECONDS', 30))
+    # A failed restore is retried with backoff; if it still fails the worker
+    # serves a fresh database with backups off, so the backup isn't overwritten
+    STARTUP_RESTORE_ATTEMPTS = int(os.environ.get('STARTUP_RESTORE_ATTEMPTS', 3))
+    STARTUP_RESTORE_RETRY_SECONDS = 2  # doubled after each failed attempt
+    # Import the Anthropic SDK and create clients in the background once ready,
+    # so the first chat doesn't pay for it
+    STARTUP_PREWARM = os.environ.get('STARTUP_PREWARM', 'true').lower() == 'true'
+    
     # Backup settings
+    BACKUP_SCHEDULER_ENABLED = os.environ.get('BACKUP_SCHEDULER_ENABLED', 'true').lower() == 'true'
     BACKUP_INTERVAL_SECONDS = 300  # 5 minutes
+    BACKUP_AFTER_WRITES = int(os.environ.get('BACKUP_AFTER_WRITES', 1000))  # or sooner after this many row changes
+    BACKUP_CHECK_SECONDS = 5  # how often the leader checks whether a backup is due
+    BACKUP_LEADER_RETRY_SECONDS = 30  # how often other workers try to take over as leader
+    BACKUP_REQUEST_TIMEOUT_SECONDS = 120  # max wait for POST /admin/backup_db?wait=true
+    BACKUP_SHUTDOWN_TIMEOUT_SECONDS = 8  # Cloud Run allows 10s after SIGTERM
+    # Where backups go: 'gcs' (requires GCS_BUCKET_NAME) or 'local' for offline use
+    BACKUP_STORAGE = os.environ.get('BACKUP_STORAGE', 'gcs')
+    BACKUP_LOCAL_DIR = Path(os.environ.get('BACKUP_LOCAL_DIR', '/app/backups'))
+    # Snapshots are split into fixed-size chunks; only changed chunks are uploaded
+    BACKUP_CHUNK_SIZE = 1024 * 1024  # 1MB
+    
+    # Retention: the backup leader moves cold sessions out of the database into
+    # compressed archives in the backup store, restored when a session is
+    # reopened. A session is cold if it matches any enabled policy (0 disables)
+    RETENTION_ENABLED = os.environ.get('RETENTION_ENABLED', 'false').lower() == 'true'
+    RETENTION_INACTIVE_DAYS = int(os.environ.get('RETENTION_INACTIVE_DAYS', 90))  # no messages for this long
+    RETENTION_MAX_AGE_DAYS = int(os.environ.get('RETENTION_MAX_AGE_DAYS', 0))  # started this long ago
+    RETENTION_MAX_SESSION_BYTES = int(os.environ.get('RETENTION_MAX_SESSION_BYTES', 0))  # larger than this
+    RETENTION_MIN_IDLE_HOURS = 24  # the age and size policies skip sessions used more recently
+    RETENTION_INTERVAL_SECONDS = int(os.environ.get('RETENTION_INTERVAL_SECONDS', 3600))
+    RETENTION_BATCH_SESSIONS = 200  # most sessions archived per run
+    # Pages freed per incremental_vacuum step; writers get in between steps
+    VACUUM_PAGES_PER_STEP = 2000
+    
+    # Claude API calls, per worker process. Calls beyond LLM_MAX_CONCURRENCY wait
+    # up to LLM_QUEUE_TIMEOUT_SECONDS for a slot and then get a 503
+    LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 8))
+    LLM_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('LLM_QUEUE_TIMEOUT_SECONDS', 5))
+    LLM_CONNECT_TIMEOUT_SECONDS = 5
+    LLM_READ_TIMEOUT_SECONDS = float(os.environ.get('LLM_READ_TIMEOUT_SECONDS', 60))  # max gap between bytes
+    LLM_REQUEST_DEADLINE_SECONDS = float(os.environ.get('LLM_REQUEST_DEADLINE_SECONDS', 240))  # under gunicorn's 300s
+    LLM_KEEPALIVE_SECONDS = 30
+    LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 3))  # on 429 / 529 only
+    LLM_BACKOFF_BASE_SECONDS = 0.5
+    LLM_BACKOFF_MAX_SECONDS = 8
+    LLM_BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', 5))  # consecutive, to open the breaker
+    LLM_BREAKER_RESET_SECONDS = int(os.environ.get('LLM_BREAKER_RESET_SECONDS', 30))
+    
+    # ASGI mode (SERVER_MODE=asgi): conversations wait on Claude in the event
+    # loop, so the in-flight limit can be far higher than the thread count.
+    # Database, upload and Flask route work runs on ASYNC_THREADS threads
+    ASYNC_LLM_MAX_CONCURRENCY = int(os.environ.get('ASYNC_LLM_MAX_CONCURRENCY', 256))
+    ASYNC_THREADS = int(os.environ.get('ASYNC_THREADS', 16))
+    
+    # Largest page /admin/sessions will return
+    SESSIONS_PAGE_MAX = 500
+    # Largest page /get_history and /admin/get_history will return
+    HISTORY_PAGE_MAX = 500
+    # Most results one search request will return
+    SEARCH_PAGE_MAX = 100
+    
+    # GitHub API
+    GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
+    GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+    GITHUB_TIMEOUT = (5, 15)  # connect, read (seconds)
+    GITHUB_POOL_SIZE = 10
+    GITHUB_CACHE_MAX_BYTES = int(os.environ.get('GITHUB_CACHE_MAX_BYTES', 16 * 1024 * 1024))  # 16MB
+    GITHUB_CACHE_TTL_SECONDS = int(os.environ.get('GITHUB_CACHE_TTL_SECONDS', 60))  # then revalidated by ETag
+    GITHUB_MAX_PAGES = 10  # of 100 items each
+    GITHUB_MAX_RETRIES = 2
+    GITHUB_RATE_LIMIT_MAX_WAIT_SECONDS = 10  # longer waits fail (or serve stale) instead
+    
+    # Context sent to Claude: history is trimmed to a token budget. Trims drop
+    # history down to CONTEXT_TRIM_TARGET of the budget at once, so the prefix
+    # stays the same (and cacheable) for the turns in between
+    CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 100000))  # estimated input tokens
+    CONTEXT_MAX_MESSAGES = int(os.environ.get('CONTEXT_MAX_MESSAGES', 50))
+    CONTEXT_TRIM_TARGET = 0.6
+    PROMPT_CACHING_ENABLED = os.environ.get('PROMPT_CACHING_ENABLED', 'true').lower() == 'true'
+    # Summarize trimmed turns into a rolling summary kept with the session
+    CONTEXT_SUMMARY_ENABLED = os.environ.get('CONTEXT_SUMMARY_ENABLED', 'false').lower() == 'true'
+    CONTEXT_SUMMARY_MODEL = os.environ.get('CONTEXT_SUMMARY_MODEL', 'claude-3-5-haiku-20241022')
+    CONTEXT_SUMMARY_MAX_TOKENS = 1024
+    
+    # Retrieval: uploaded documents with more text than this are indexed in
+    # chunks for the session, and each turn sends the chunks that best match
+    # the message instead of the whole text. The turn that uploads one gets
+    # the full text if it isn't over RETRIEVAL_FULL_TEXT_MAX_CHARS
+    RETRIEVAL_ENABLED = os.environ.get('RETRIEVAL_ENABLED', 'true').lower() == 'true'
+    RETRIEVAL_MIN_DOCUMENT_CHARS = int(os.environ.get('RETRIEVAL_MIN_DOCUMENT_CHARS', 20000))
+    RETRIEVAL_FULL_TEXT_MAX_CHARS = int(os.environ.get('RETRIEVAL_FULL_TEXT_MAX_CHARS', 200000))
+    RETRIEVAL_CHUNK_CHARS = 2000
+    RETRIEVAL_CHUNK_OVERLAP_CHARS = 200
+    RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', 8))
+    RETRIEVAL_BUDGET_CHARS = int(os.environ.get('RETRIEVAL_BUDGET_CHARS', 12000))  # per turn, ~3k tokens
     
     @staticmethod
     def init_directories():
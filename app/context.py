@@ -0,0 +1,196 @@
+# app/context.py
+"""Builds the system prompt and message list sent to Claude for a turn.
+
+History is packed into a token budget instead of a fixed number of rows. The
+window start is stored per session and only moves when the window outgrows
+the budget, and then it moves far enough to leave headroom. Between trims the
+prompt prefix is identical from turn to turn, so the cache breakpoints on the
+system prompt and the latest message let the API serve it from its prompt
+cache. Turns that fall out of the window can be folded into a rolling summary,
+generated in the background and stored with the session.
+
+Large uploaded documents are stored as references (see app.documents); the
+new message carries the excerpts that match it, and older messages a
+stand-in, so the document text isn't resent with every turn.
+"""
+import threading
+import traceback
+from app.attachments import is_attachment_ref
+from app.config import Config
+from app.documents import collapse_document_refs, expand_new_message, is_document_ref
+from app.llm import get_client
+from app.database import (
+    get_history_rows, hydrate_attachments, flush_pending_writes,
+    get_context_state, save_context_start, save_context_summary
+)
+
+SYSTEM_MESSAGE = """You are a helpful assistant that analyzes files and answers questions. 
+
+IMPORTANT: When you provide code modifications or updates, ALWAYS:
+1. Comment where you make changes with markers like "# NEW", "# CHANGED", or "# UPDATED"
+2. If the change is substantial, include a brief comment explaining what was changed
+3. Make it easy for the user to spot the differences from the original code
+"""
+
+SUMMARY_PROMPT = """Summarize the earlier part of a conversation between a user and an assistant so the assistant can continue it without the full transcript. Keep facts, decisions, open questions, file names and code identifiers; drop pleasantries. Write at most a few short paragraphs.
+
+{previous}Conversation to summarize:
+
+{transcript}"""
+
+# Rough token estimates; the budget only needs to be approximately right
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1600  # images are resized to at most ~1.15 megapixels by the API
+SUMMARY_MESSAGE_CHARS = 4000  # per message sent for summarization
+
+_CACHE_CONTROL = {'type': 'ephemeral'}
+
+_summaries_running = set()
+_summaries_lock = threading.Lock()
+
+def estimate_tokens(content):
+    """Estimate the input tokens of message content (text or a list of blocks)"""
+    if isinstance(content, str):
+        return len(content) // CHARS_PER_TOKEN + 1
+    tokens = 0
+    for block in content if isinstance(content, list) else [content]:
+        if not isinstance(block, dict):
+            tokens += len(str(block)) // CHARS_PER_TOKEN + 1
+        elif block.get('type') == 'image':
+            tokens += IMAGE_TOKENS
+        else:
+            tokens += len(block.get('text', '')) // CHARS_PER_TOKEN + 1
+    return tokens
+
+def _with_cache_control(content):
+    """Copy of content with a cache breakpoint on its last block"""
+    if isinstance(content, str):
+        return [{'type': 'text', 'text': content, 'cache_control': _CACHE_CONTROL}]
+    blocks = list(content)
+    blocks[-1] = {**blocks[-1], 'cache_control': _CACHE_CONTROL}
+    return blocks
+
+def _trim_start(rows, reserved_tokens):
+    """Pick a new window start that leaves headroom under the budget and message cap"""
+    target_tokens = Config.CONTEXT_TOKEN_BUDGET * Config.CONTEXT_TRIM_TARGET - reserved_tokens
+    target_messages = max(2, int(Config.CONTEXT_MAX_MESSAGES * Config.CONTEXT_TRIM_TARGET))
+
+    start = len(rows)
+    tokens = 0
+    while start > 0 and len(rows) - start < target_messages:
+        tokens += estimate_tokens(rows[start - 1]['content'])
+        if tokens > target_tokens:
+            break
+        start -= 1
+
+    # The window has to open on a user message
+    while start < len(rows) and rows[start]['role'] != 'user':
+        start += 1
+
+    return start
+
+def build_context(session_id, user_content):
+    """Return (system, messages) for a new user turn in this session.
+
+    messages is the packed history plus the new user message, with attachments
+    hydrated. Nothing returned is shared with the history cache.
+    """
+    state = get_context_state(session_id)
+    rows = get_history_rows(session_id, Config.CONTEXT_MAX_MESSAGES)
+    new_content, expanded = expand_new_message(session_id, user_content)
+
+    # Queued write-behind rows have no id yet; they are always the newest
+    window = [r for r in rows if r['id'] is None or r['id'] >= state['start_id']]
+    reserved_tokens = estimate_tokens(SYSTEM_MESSAGE) + estimate_tokens(new_content)
+    if state['summary']:
+        reserved_tokens += estimate_tokens(state['summary'])
+    history_tokens = sum(estimate_tokens(r['content']) for r in window)
+
+    if (len(window) >= Config.CONTEXT_MAX_MESSAGES
+            or history_tokens + reserved_tokens > Config.CONTEXT_TOKEN_BUDGET):
+        if any(r['id'] is None for r in window):
+            # Queued write-behind rows get their ids when they are committed
+            flush_pending_writes()
+        start = _trim_start(window, reserved_tokens)
+        evicted, window = window[:start], window[start:]
+        if window and window[0]['id'] is not None:
+            save_context_start(session_id, window[0]['id'])
+        elif evicted:
+            # Everything was evicted: start after the last evicted row
+            save_context_start(session_id, evicted[-1]['id'] + 1)
+        if evicted and Config.CONTEXT_SUMMARY_ENABLED:
+            _summarize_in_background(session_id, evicted, state)
+
+    # The new message can refer to an uploaded image too
+    messages = hydrate_attachments(
+        [{'role': r['role'], 'content': collapse_document_refs(r['content'])} for r in window]
+        + [{'role': 'user', 'content': new_content}]
+    )
+
+    system = [{'type': 'text', 'text': SYSTEM_MESSAGE}]
+    if state['summary']:
+        system.append({
+            'type': 'text',
+            'text': f"Summary of the earlier conversation, which is no longer shown:\n\n{state['summary']}"
+        })
+
+    if Config.PROMPT_CACHING_ENABLED:
+        system[-1] = {**system[-1], 'cache_control': _CACHE_CONTROL}
+        if expanded and len(messages) > 1:
+            # The new message is stored without its excerpts, so next turn's
+            # prefix only matches up to the message before it
+            messages[-2] = {**messages[-2], 'content': _with_cache_control(messages[-2]['content'])}
+        messages[-1] = {**messages[-1], 'content': _with_cache_control(messages[-1]['content'])}
+
+    return system, messages
+
+def _transcript_text(content):
+    if isinstance(content, str):
+        text = content
+    else:
+        parts = []
+        for block in content if isinstance(content, list) else [content]:
+            if isinstance(block, dict) and (block.get('type') == 'image' or is_attachment_ref(block)):
+                parts.append('[image]')
+            elif is_document_ref(block):
+                parts.append(f"[document {block['filename']}]")
+            elif isinstance(block, dict):
+                parts.append(block.get('text', ''))
+        text = '\n'.join(parts)
+    if len(text) > SUMMARY_MESSAGE_CHARS:
+        text = text[:SUMMARY_MESSAGE_CHARS] + ' [...]'
+    return text
+
+def _summarize(session_id, evicted, state):
+    # Rows already covered by the stored summary are skipped
+    rows = [r for r in evicted if r['id'] > state['summary_through_id']]
+    if not rows:
+        return
+    transcript = '\n\n'.join(f"{r['role'].upper()}: {_transcript_text(r['content'])}" for r in rows)
+    previous = f"Summary so far:\n\n{state['summary']}\n\n" if state['summary'] else ''
+
+    response = get_client().messages.create(
+        model=Config.CONTEXT_SUMMARY_MODEL,
+        max_tokens=Config.CONTEXT_SUMMARY_MAX_TOKENS,
+        messages=[{'role': 'user', 'content': SUMMARY_PROMPT.format(previous=previous, transcript=transcript)}]
+    )
+    save_context_summary(session_id, response.content[0].text, rows[-1]['id'])
+
+def _summarize_in_background(session_id, evicted, state):
+    """Fold evicted turns into the session summary without delaying this request"""
+    with _summaries_lock:
+        if session_id in _summaries_running:
+            return
+        _summaries_running.add(session_id)
+
+    def run():
+        try:
+            _summarize(session_id, evicted, state)
+        except Exception as e:
+            print(f"Error summarizing context for session {session_id}: {str(e)}")
+            traceback.print_exc()
+        finally:
+            with _summaries_lock:
+                _summaries_running.discard(session_id)
+
+    threading.Thread(target=run, name='context-summary', daemon=True).start()
@@ -1,47 +1,211 @@
 # app/database.py
 import sqlite3
+import atexit
+import base64
 import json
+import os
+import threading
+import time
 import uuid
+import weakref
 from contextlib import contextmanager
+from datetime import datetime, timezone
 from flask import session
+from app.attachments import attach_data, attachment_ids, detach_content, is_attachment_ref
+from app.cache import LRUCache
 from app.config import Config
+from app.metrics import DB_CONNECTION_HOLD, observe_db_query
+from app.migrations import run_migrations
+from app.write_behind import WriteBehindQueue
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records statement latency in the db_query metrics"""
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe_db_query(sql, time.perf_counter() - started)
+    
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observe_db_query(sql, time.perf_counter() - started)
+
+class PooledConnection(sqlite3.Connection):
+    """SQLite connection owned by a single thread of a single process.
+    
+    Statements and commits are timed for the db_query metrics, whether they
+    run through the connection or one of its cursors.
+    """
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            observe_db_query('COMMIT', time.perf_counter() - started)
+
+# Each thread keeps one open connection per process; gthread workers reuse their
+# threads, so connection setup and pragma costs are paid once per thread
+_local = threading.local()
+_pool_lock = threading.Lock()
+_open_connections = weakref.WeakSet()
+_pool_generation = 0
+_pool_stats = {
+    'connections_opened': 0,
+    'connections_closed': 0,
+    'checkouts': 0,
+    'rollbacks': 0
+}
+
+# Parsed recent history per session, written through by this process. Entries
+# hold up to HISTORY_CACHE_WINDOW rows; 'complete' means the whole session fits
+history_cache = LRUCache(Config.HISTORY_CACHE_MAX_BYTES)
+_history_write_seq = 0
+# Turns queued for write-behind but not yet committed, by session
+_pending_writes = {}
+# Held over a write-behind commit and the matching _pending_writes update, so
+# get_message_count() never sees a turn both committed and still pending
+_message_count_lock = threading.Lock()
+_ROW_OVERHEAD_BYTES = 200
+
+# Base64 attachment data by id, so images resent every turn aren't re-read and
+# re-encoded from SQLite each time
+attachment_cache = LRUCache(Config.ATTACHMENT_CACHE_MAX_BYTES)
+ATTACHMENT_WRITE_CHUNK = 1024 * 1024  # stored files are copied into the row in pieces this size
+
+# History versions (for ETags) by session; only used when this process sees
+# every write, i.e. with HISTORY_CACHE_VALIDATE off
+history_versions = LRUCache(1024 * 1024)
+
+def _bump_stat(name):
+    with _pool_lock:
+        _pool_stats[name] += 1
+
+def _open_connection():
+    """Open a new connection and apply the per-connection pragmas once"""
+    conn = sqlite3.connect(
+        str(Config.DATABASE_PATH),
+        timeout=Config.DB_BUSY_TIMEOUT_MS / 1000,
+        factory=PooledConnection
+    )
+    conn.row_factory = sqlite3.Row
+    # Only takes effect on a new database (before its first page is written) or
+    # at the next VACUUM; app.retention converts existing files that way
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={int(Config.DB_BUSY_TIMEOUT_MS)}')
+    conn.execute(f'PRAGMA mmap_size={int(Config.DB_MMAP_SIZE)}')
+    conn.execute(f'PRAGMA cache_size=-{int(Config.DB_CACHE_SIZE_KB)}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.opened_at = time.time()
+    with _pool_lock:
+        _open_connections.add(conn)
+        _pool_stats['connections_opened'] += 1
+    return conn
+
+def _close_connection(conn):
+    try:
+        conn.close()
+    finally:
+        _bump_stat('connections_closed')
+
+def _database_inode():
+    try:
+        return os.stat(Config.DATABASE_PATH).st_ino
+    except FileNotFoundError:
+        return None
+
+def _get_thread_connection():
+    """Return this thread's connection, reopening it after a fork, pool reset or file swap"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        if _local.pid != os.getpid():
+            # Inherited across fork; the parent still owns it, so just drop it
+            conn = None
+        elif (_local.generation != _pool_generation
+              or _local.path != str(Config.DATABASE_PATH)
+              or _local.inode != _database_inode()):
+            # The database was restored (possibly by another worker process)
+            _close_connection(conn)
+            conn = None
+    
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.generation = _pool_generation
+        _local.path = str(Config.DATABASE_PATH)
+        _local.inode = _database_inode()
+        _local.depth = 0
+    return conn
 
 @contextmanager
 def get_db():
-    """Get database connection with context manager"""
-    conn = sqlite3.connect(str(Config.DATABASE_PATH))
-    conn.row_factory = sqlite3.Row
+    """Get this thread's pooled database connection with context manager"""
+    conn = _get_thread_connection()
+    _bump_stat('checkouts')
+    _local.depth += 1
+    started = time.perf_counter()
     try:
         yield conn
     finally:
-        conn.close()
+        _local.depth -= 1
+        if _local.depth == 0:
+            DB_CONNECTION_HOLD.observe(time.perf_counter() - started)
+        # Never hand an open transaction to the next user of this connection;
+        # this matches the old behaviour of closing (and rolling back) per call
+        if _local.depth == 0 and conn.in_transaction:
+            conn.rollback()
+            _bump_stat('rollbacks')
+
+def reset_connections():
+    """Invalidate all pooled connections, e.g. after the database file is replaced"""
+    global _pool_generation
+    with _pool_lock:
+        _pool_generation += 1
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        _close_connection(conn)
+    _local.conn = None
+
+def checkpoint_database():
+    """Fold the WAL back into the main database file so it can be copied on its own"""
+    with get_db() as conn:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+def get_change_counter():
+    """Return the write counter bumped by triggers on every conversation change"""
+    with get_db() as conn:
+        row = conn.execute('SELECT value FROM change_counter WHERE id = 1').fetchone()
+    return row['value'] if row else 0
+
+def get_pool_stats():
+    """Return connection pool statistics for this process"""
+    with _pool_lock:
+        stats = dict(_pool_stats)
+        stats['open_connections'] = len(_open_connections)
+        stats['generation'] = _pool_generation
+    stats['pid'] = os.getpid()
+    return stats
 
 def init_db():
-    """Initialize the database"""
+    """Initialize the database and bring its schema up to date"""
     with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                message_type TEXT DEFAULT 'text'
-            )
-        ''')
-        
-        # NEW: Add a table to track database changes
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS db_metadata (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                last_backup_hash TEXT,
-                last_backup_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-    print(f"Database initialized: {Config.DATABASE_PATH}")
+        version = run_migrations(conn)
+    print(f"Database initialized: {Config.DATABASE_PATH} (schema version {version})")
 
 def get_session_id():
     """Get or create a session ID for the user"""
@@ -49,56 +213,584 @@ def get_session_id():
         session['session_id'] = str(uuid.uuid4())
     return session['session_id']
 
+def _parse_content(content_str):
+    """Decode stored content; structured content is a JSON list/dict, anything else is plain text"""
+    try:
+        content = json.loads(content_str)
+    except ValueError:
+        return content_str
+    # A plain message such as "42" or "true" is valid JSON but is still text
+    return content if isinstance(content, (dict, list)) else content_str
+
+def _make_row(row_id, role, content_str, message_type, created_at):
+    return {
+        'id': row_id,
+        'role': role,
+        'content': _parse_content(content_str),
+        'message_type': message_type,
+        'created_at': created_at,
+        'size': len(content_str) + _ROW_OVERHEAD_BYTES
+    }
+
+def _cache_entry(rows, complete):
+    """Build a history cache entry and its estimated size"""
+    size = _ROW_OVERHEAD_BYTES + sum(row['size'] for row in rows)
+    return {'rows': rows, 'complete': complete}, size
+
+def _bump_history_writes():
+    global _history_write_seq
+    with _pool_lock:
+        _history_write_seq += 1
+
+def _latest_message_id(session_id):
+    with get_db() as conn:
+        row = conn.execute('''
+            SELECT id FROM conversations
+            WHERE session_id = ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        ''', (session_id,)).fetchone()
+    return row['id'] if row else None
+
+def _is_cache_entry_current(session_id, entry):
+    """Check a cached entry against writes made by other worker processes"""
+    if not Config.HISTORY_CACHE_VALIDATE or _pending_writes.get(session_id):
+        # Queued writes exist only in this process's cache until they are flushed
+        return True
+    rows = entry['rows']
+    return _latest_message_id(session_id) == (rows[-1]['id'] if rows else None)
+
+def _new_message(role, content, message_type):
+    """Serialize a message and build its history row (id is set once written).
+
+    Inline images are split off into attachments so the row, and the cached
+    history, only carry a reference to them.
+    """
+    content, attachments = detach_content(content)
+    for attachment_id, _, data in attachments:
+        encoded = base64.b64encode(data).decode()
+        attachment_cache.set(attachment_id, encoded, len(encoded))
+    
+    # Convert content to JSON string if it's a complex object
+    if isinstance(content, (dict, list)):
+        content_str = json.dumps(content)
+    else:
+        content_str = str(content)
+    created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    return _make_row(None, role, content_str, message_type, created_at), content_str, attachments
+
+def _insert_messages(cursor, session_id, messages):
+    for row, content_str, attachments in messages:
+        if attachments:
+            cursor.executemany('''
+                INSERT OR IGNORE INTO attachments (id, media_type, data, size)
+                VALUES (?, ?, ?, ?)
+            ''', [(a_id, media_type, data, len(data)) for a_id, media_type, data in attachments])
+        cursor.execute('''
+            INSERT INTO conversations (session_id, role, content, message_type, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (session_id, row['role'], content_str, row['message_type'], row['created_at']))
+        row['id'] = cursor.lastrowid
+
+def _write_messages(session_id, messages):
+    """Write messages in a single transaction and update the history cache"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        try:
+            _insert_messages(cursor, session_id, messages)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    _cache_append(session_id, [message[0] for message in messages])
+
+def _cache_append(session_id, rows):
+    """Write new rows through to the cached history so the next turn doesn't re-read it"""
+    _bump_history_writes()
+    history_versions.delete(session_id)
+    
+    def append(entry):
+        new_rows = entry['rows'] + rows
+        complete = entry['complete']
+        if len(new_rows) > Config.HISTORY_CACHE_WINDOW:
+            new_rows = new_rows[-Config.HISTORY_CACHE_WINDOW:]
+            complete = False
+        return _cache_entry(new_rows, complete)
+    
+    history_cache.update(session_id, append)
+
+def _flush_queued_turns(batch):
+    """Group commit for the write-behind queue: every queued turn in one transaction"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        try:
+            for session_id, messages in batch:
+                _insert_messages(cursor, session_id, messages)
+            with _message_count_lock:
+                conn.commit()
+                _forget_queued_turns(batch)
+        except Exception:
+            conn.rollback()
+            raise
+
+def _queued_turns_done(batch, written):
+    # Written batches were forgotten as they were committed
+    if not written:
+        _forget_queued_turns(batch)
+
+def _forget_queued_turns(batch):
+    with _pool_lock:
+        for session_id, _ in batch:
+            _pending_writes[session_id] -= 1
+            if _pending_writes[session_id] <= 0:
+                del _pending_writes[session_id]
+
+write_queue = WriteBehindQueue(
+    _flush_queued_turns,
+    done_func=_queued_turns_done,
+    max_batch=Config.DB_WRITE_BEHIND_MAX_BATCH,
+    max_delay=Config.DB_WRITE_BEHIND_MAX_DELAY_MS / 1000
+)
+
+def flush_pending_writes(timeout=None):
+    """Wait for queued write-behind turns to be committed"""
+    return write_queue.flush(timeout)
+
+# Give queued turns a bounded chance to reach the database when the worker exits
+atexit.register(lambda: flush_pending_writes(Config.DB_WRITE_BEHIND_SHUTDOWN_TIMEOUT))
+
+def _flush_session_writes(session_id):
+    # Make this process's queued writes visible before reading or deleting from SQLite
+    if _pending_writes.get(session_id):
+        flush_pending_writes()
+
 def save_message_to_db(session_id, role, content, message_type='text'):
     """Save a message to the database"""
+    _write_messages(session_id, [_new_message(role, content, message_type)])
+
+def save_turn(session_id, user_content, assistant_content, message_type='text'):
+    """Save a user message and the assistant reply together.
+    
+    Both rows are written in one transaction so a crash can never leave a user
+    message without its reply. With DB_WRITE_BEHIND enabled the turn is queued
+    and committed with other turns by a background writer instead.
+    """
+    messages = [
+        _new_message('user', user_content, message_type),
+        _new_message('assistant', assistant_content, message_type)
+    ]
+    
+    if not Config.DB_WRITE_BEHIND:
+        _write_messages(session_id, messages)
+        return
+    
+    with _pool_lock:
+        _pending_writes[session_id] = _pending_writes.get(session_id, 0) + 1
+    _cache_append(session_id, [message[0] for message in messages])
+    write_queue.put((session_id, messages))
+
+def get_history_rows(session_id, limit=50):
+    """Get the most recent message rows for a session, oldest first.
+    
+    Rows are dicts with id, role, content (parsed), message_type and
+    created_at. They are shared with the history cache; do not modify them.
+    """
+    if limit <= 0:
+        return []
+    
+    entry = history_cache.get(
+        session_id,
+        validate=lambda e: (e['complete'] or len(e['rows']) >= limit) and _is_cache_entry_current(session_id, e)
+    )
+    if entry is not None:
+        return entry['rows'][-limit:]
+    
+    _flush_session_writes(session_id)
+    
+    # Read a full cache window so later, smaller requests are served from memory
+    window = max(limit, Config.HISTORY_CACHE_WINDOW)
+    write_seq = _history_write_seq
     with get_db() as conn:
         cursor = conn.cursor()
-        # Convert content to JSON string if it's a complex object
-        if isinstance(content, (dict, list)):
-            content_str = json.dumps(content)
-        else:
-            content_str = str(content)
-        
         cursor.execute('''
-            INSERT INTO conversations (session_id, role, content, message_type)
-            VALUES (?, ?, ?, ?)
-        ''', (session_id, role, content_str, message_type))
-        conn.commit()
+            SELECT id, role, content, message_type, created_at
+            FROM conversations
+            WHERE session_id = ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (session_id, window))
+        
+        # Reverse to get chronological order
+        rows = [
+            _make_row(r['id'], r['role'], r['content'], r['message_type'], r['created_at'])
+            for r in reversed(cursor.fetchall())
+        ]
+    
+    if not rows and _restore_if_archived(session_id):
+        return get_history_rows(session_id, limit)
+    
+    # Skip caching if this process wrote while we were reading; the rows may be stale
+    if write_seq == _history_write_seq:
+        # Complete only if the whole session fits in the cached window, not just in this read
+        complete = len(rows) < window and len(rows) <= Config.HISTORY_CACHE_WINDOW
+        value, size = _cache_entry(rows[-Config.HISTORY_CACHE_WINDOW:], complete)
+        history_cache.set(session_id, value, size)
+    
+    return rows[-limit:]
 
 def get_conversation_history(session_id, limit=50):
-    """Get conversation history from database"""
+    """Get conversation history in the format expected by Claude API"""
+    return [
+        {'role': row['role'], 'content': row['content']}
+        for row in get_history_rows(session_id, limit)
+    ]
+
+def get_history_page(session_id, before_id=None, limit=50):
+    """Return (rows, has_more) for one page of history, oldest first.
+    
+    Without before_id this is the latest page, served like get_history_rows.
+    With it, the page holds the messages just before that message id, so a
+    client scrolls back by passing the id of the oldest message it has.
+    """
+    if before_id is None:
+        rows = get_history_rows(session_id, limit + 1)
+        if rows and rows[-limit:][0]['id'] is None:
+            # Queued write-behind rows get their ids when they are committed;
+            # the client needs the oldest one to page back from
+            _flush_session_writes(session_id)
+        return rows[-limit:], len(rows) > limit
+    
+    _flush_session_writes(session_id)
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT role, content, message_type, created_at
+            SELECT id, role, content, message_type, created_at
             FROM conversations
             WHERE session_id = ?
-            ORDER BY created_at DESC
+              AND (created_at, id) < (SELECT created_at, id FROM conversations WHERE id = ?)
+            ORDER BY created_at DESC, id DESC
             LIMIT ?
-        ''', (session_id, limit))
-        
-        rows = cursor.fetchall()
-        
-        # Convert to the format expected by Claude API
-        messages = []
-        for row in reversed(rows):  # Reverse to get chronological order
-            try:
-                # Try to parse JSON content
-                content = json.loads(row['content'])
-            except:
-                # If not JSON, keep as string
-                content = row['content']
-            
-            messages.append({
-                'role': row['role'],
-                'content': content
-            })
-        
+        ''', (session_id, before_id, limit + 1))
+        rows = [
+            _make_row(r['id'], r['role'], r['content'], r['message_type'], r['created_at'])
+            for r in reversed(cursor.fetchall())
+        ]
+    if not rows and _restore_if_archived(session_id):
+        return get_history_page(session_id, before_id, limit)
+    return rows[-limit:], len(rows) > limit
+
+def _restore_if_archived(session_id):
+    """Restore a session that retention moved to the archive store.
+    
+    Called when a session looks empty, so other sessions never pay for the
+    lookup. Returns True if the session was archived and is now back (restored
+    here or by another worker); a failed restore is logged and the session
+    reads as empty for this request.
+    """
+    with get_db() as conn:
+        row = conn.execute(
+            'SELECT 1 FROM archived_sessions WHERE session_id = ? AND restored_at IS NULL', (session_id,)
+        ).fetchone()
+    if row is None:
+        return False
+    
+    from app.retention import restore_session
+    try:
+        restore_session(session_id)
+    except Exception as e:
+        print(f"Could not restore archived session {session_id}: {str(e)}")
+        return False
+    return True
+
+def summarize_message(row):
+    """Role, content type and text length of a history row, without its content"""
+    content = row['content']
+    if isinstance(content, str):
+        types, length = ['text'], len(content)
+    else:
+        types, length = [], 0
+        for block in content if isinstance(content, list) else [content]:
+            block_type = block.get('type', 'text') if isinstance(block, dict) else 'text'
+            if block_type not in types:
+                types.append(block_type)
+            length += len(block.get('text', '')) if isinstance(block, dict) else len(str(block))
+    return {
+        'id': row['id'],
+        'role': row['role'],
+        'type': '+'.join(types),
+        'length': length,
+        'created_at': row['created_at']
+    }
+
+def get_history_version(session_id):
+    """Version string for a session's history, for ETags.
+    
+    Made from the latest message id and the message count in the sessions
+    table, so any insert or delete changes it. It costs one primary-key lookup,
+    or nothing when HISTORY_CACHE_VALIDATE is off and it is already known.
+    Returns None while this process has queued writes for the session.
+    """
+    if _pending_writes.get(session_id):
+        return None
+    if not Config.HISTORY_CACHE_VALIDATE:
+        version = history_versions.get(session_id)
+        if version is not None:
+            return version
+    
+    write_seq = _history_write_seq
+    with get_db() as conn:
+        row = conn.execute(
+            'SELECT last_message_id, message_count FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+    if row is None and _restore_if_archived(session_id):
+        return get_history_version(session_id)
+    version = f"{row['last_message_id']}.{row['message_count']}" if row else '0.0'
+    
+    # As with the history cache, don't keep a version read while this process was writing
+    if write_seq == _history_write_seq:
+        history_versions.set(session_id, version, len(session_id) + len(version) + _ROW_OVERHEAD_BYTES)
+    return version
+
+def _load_attachments(ids):
+    """Base64 data for the given attachment ids, from the cache or the database"""
+    found = {}
+    missing = []
+    for attachment_id in ids:
+        data = attachment_cache.get(attachment_id)
+        if data is None:
+            missing.append(attachment_id)
+        else:
+            found[attachment_id] = data
+    
+    if missing:
+        placeholders = ', '.join('?' for _ in missing)
+        with get_db() as conn:
+            rows = conn.execute(
+                f'SELECT id, data FROM attachments WHERE id IN ({placeholders})', missing
+            ).fetchall()
+        for row in rows:
+            encoded = base64.b64encode(row['data']).decode()
+            attachment_cache.set(row['id'], encoded, len(encoded))
+            found[row['id']] = encoded
+    return found
+
+def store_attachment(attachment_id, media_type, data):
+    """Store bytes as an attachment; like store_attachment_file(), an existing one only has created_at refreshed"""
+    with get_db() as conn:
+        try:
+            updated = conn.execute(
+                'UPDATE attachments SET created_at = CURRENT_TIMESTAMP WHERE id = ?', (attachment_id,)
+            ).rowcount
+            if not updated:
+                conn.execute('''
+                    INSERT INTO attachments (id, media_type, data, size)
+                    VALUES (?, ?, ?, ?)
+                ''', (attachment_id, media_type, data, len(data)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def store_attachment_file(attachment_id, media_type, file_path):
+    """Store a file as an attachment, copying it into the row in pieces.
+
+    An attachment that is already stored only has created_at refreshed, so
+    collect_attachments() gives it the same grace as a new one until the
+    message referring to it is saved.
+    """
+    size = os.path.getsize(file_path)
+    with get_db() as conn:
+        try:
+            updated = conn.execute(
+                'UPDATE attachments SET created_at = CURRENT_TIMESTAMP WHERE id = ?', (attachment_id,)
+            ).rowcount
+            if not updated:
+                cursor = conn.execute('''
+                    INSERT INTO attachments (id, media_type, data, size)
+                    VALUES (?, ?, zeroblob(?), ?)
+                ''', (attachment_id, media_type, size, size))
+                with conn.blobopen('attachments', 'data', cursor.lastrowid) as blob, open(file_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(ATTACHMENT_WRITE_CHUNK), b''):
+                        blob.write(chunk)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def hydrate_attachments(messages):
+    """Return API messages with attachment references replaced by their base64 data.
+    
+    Only call this when building a request payload; history listings and the
+    cache keep the small references. The input messages are not modified.
+    """
+    ids = {a_id for message in messages for a_id in attachment_ids(message['content'])}
+    if not ids:
         return messages
+    
+    data_by_id = _load_attachments(ids)
+    if len(data_by_id) < len(ids):
+        # Referenced by a queued write-behind turn whose cache entry was evicted
+        flush_pending_writes()
+        data_by_id.update(_load_attachments(ids - data_by_id.keys()))
+    
+    hydrated = []
+    for message in messages:
+        content = message['content']
+        try:
+            content = attach_data(content, data_by_id)
+        except KeyError as e:
+            print(f"Attachment {e} is missing; sending a placeholder instead")
+            content = attach_data([
+                {'type': 'text', 'text': '[Attachment no longer available]'}
+                if is_attachment_ref(block) and block['source']['attachment_id'] not in data_by_id
+                else block
+                for block in content
+            ], data_by_id)
+        hydrated.append({**message, 'content': content})
+    return hydrated
+
+SESSION_SORT_COLUMNS = ('last_message', 'first_message', 'message_count', 'byte_size')
+
+def _encode_cursor(row, sort):
+    return base64.urlsafe_b64encode(json.dumps([row[sort], row['session_id']]).encode()).decode()
+
+def _decode_cursor(cursor):
+    try:
+        value, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    return value, session_id
+
+def list_sessions(sort='last_message', descending=True, limit=50, cursor=None):
+    """Return (sessions, next_cursor) from the sessions summary table.
+    
+    Pages are keyset-paginated on (sort column, session_id); pass the returned
+    cursor to get the next page. next_cursor is None on the last page.
+    """
+    if sort not in SESSION_SORT_COLUMNS:
+        raise ValueError(f"sort must be one of {', '.join(SESSION_SORT_COLUMNS)}")
+    
+    direction, comparison = ('DESC', '<') if descending else ('ASC', '>')
+    where = ''
+    params = []
+    if cursor:
+        where = f'WHERE ({sort}, session_id) {comparison} (?, ?)'
+        params.extend(_decode_cursor(cursor))
+    
+    with get_db() as conn:
+        rows = conn.execute(f'''
+            SELECT session_id, message_count, byte_size, first_message, last_message, last_message_id
+            FROM sessions
+            {where}
+            ORDER BY {sort} {direction}, session_id {direction}
+            LIMIT ?
+        ''', params + [limit + 1]).fetchall()
+    
+    sessions = [dict(row) for row in rows[:limit]]
+    next_cursor = _encode_cursor(sessions[-1], sort) if len(rows) > limit else None
+    return sessions, next_cursor
+
+def get_session_summary(session_id):
+    """Return the session's summary row, or None if it has no messages"""
+    with get_db() as conn:
+        row = conn.execute('''
+            SELECT session_id, message_count, byte_size, first_message, last_message, last_message_id
+            FROM sessions WHERE session_id = ?
+        ''', (session_id,)).fetchone()
+    return dict(row) if row else None
+
+def get_message_count(session_id):
+    """Number of messages stored for the session, counting turns this process has queued for write-behind"""
+    if not Config.DB_WRITE_BEHIND:
+        summary = get_session_summary(session_id)
+        return summary['message_count'] if summary else 0
+    
+    with _message_count_lock:
+        summary = get_session_summary(session_id)
+        with _pool_lock:
+            queued = _pending_writes.get(session_id, 0)
+    return (summary['message_count'] if summary else 0) + 2 * queued
+
+def get_context_state(session_id):
+    """Return the session's context window start and rolling summary"""
+    with get_db() as conn:
+        row = conn.execute('''
+            SELECT start_id, summary, summary_through_id FROM context_state WHERE session_id = ?
+        ''', (session_id,)).fetchone()
+    if row is None and _restore_if_archived(session_id):
+        return get_context_state(session_id)
+    if row is None:
+        return {'start_id': 0, 'summary': None, 'summary_through_id': 0}
+    return dict(row)
+
+def save_context_start(session_id, start_id):
+    """Move the start of the session's context window forward"""
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO context_state (session_id, start_id) VALUES (?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                start_id = MAX(start_id, excluded.start_id),
+                updated_at = CURRENT_TIMESTAMP
+        ''', (session_id, start_id))
+        conn.commit()
+
+def save_context_summary(session_id, summary, through_id):
+    """Store a rolling summary covering messages up to through_id, unless a newer one exists"""
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO context_state (session_id, summary, summary_through_id) VALUES (?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                summary = excluded.summary,
+                summary_through_id = excluded.summary_through_id,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE summary_through_id < excluded.summary_through_id
+        ''', (session_id, summary, through_id))
+        conn.commit()
 
 def clear_conversation_history(session_id):
-    """Clear conversation history for a session"""
+    """Clear conversation history for a session, including an archived copy of it"""
+    _flush_session_writes(session_id)
     with get_db() as conn:
         cursor = conn.cursor()
+        archive_keys = [row['storage_key'] for row in cursor.execute(
+            'SELECT storage_key FROM archived_sessions WHERE session_id = ?', (session_id,)
+        ).fetchall()]
         cursor.execute('DELETE FROM conversations WHERE session_id = ?', (session_id,))
-        conn.commit()
\ No newline at end of file
+        cursor.execute('DELETE FROM context_state WHERE session_id = ?', (session_id,))
+        cursor.execute('DELETE FROM documents WHERE session_id = ?', (session_id,))
+        # Otherwise the next history read would restore the archive
+        cursor.execute('DELETE FROM archived_sessions WHERE session_id = ?', (session_id,))
+        conn.commit()
+    
+    _bump_history_writes()
+    history_versions.delete(session_id)
+    value, size = _cache_entry([], True)
+    history_cache.set(session_id, value, size)
+    
+    if archive_keys:
+        _delete_archives(archive_keys)
+
+def _delete_archives(keys):
+    """Remove archive objects from the backup store; a failure only leaves an unreferenced object"""
+    from app.backup_storage import BackupStorageError, get_backup_storage
+    
+    storage = get_backup_storage()
+    if storage is None:
+        return
+    for key in keys:
+        try:
+            storage.delete(key)
+        except BackupStorageError as e:
+            print(f"Could not delete archive {key}: {str(e)}")
+
+def forget_session_history(session_id):
+    """Drop this process's cached history for a session whose rows were archived or restored"""
+    _bump_history_writes()
+    history_cache.delete(session_id)
+    history_versions.delete(session_id)
+
+def clear_history_cache():
+    """Drop all cached history, e.g. after the database file is replaced"""
+    _bump_history_writes()
+    history_cache.clear()
+    history_versions.clear()
\ No newline at end of file
@@ -0,0 +1,256 @@
+# app/documents.py
+"""Retrieval over large uploaded documents.
+
+An uploaded document whose extracted text is longer than
+RETRIEVAL_MIN_DOCUMENT_CHARS is split into overlapping chunks and indexed for
+its session (documents, document_chunks and the FTS5 index over them,
+migration 9). The message stores a reference in place of the text:
+
+    {"type": "document_ref", "document_id": ..., "filename": ..., "chars": ...}
+
+so history reads, the history cache and the session's byte size no longer
+carry the text. build_context() expands references when a payload is built:
+the message that uploads a document gets its full text (up to
+RETRIEVAL_FULL_TEXT_MAX_CHARS), older messages get a one-line stand-in, and
+each new message gets the chunks of the session's documents that best match
+it (BM25), up to RETRIEVAL_TOP_K chunks and RETRIEVAL_BUDGET_CHARS. The full
+text stays available from GET /documents/<id>.
+"""
+import hashlib
+import re
+from app.config import Config
+from app.database import get_db
+
+MAX_QUERY_TERMS = 32
+
+# Too common to say what a message is about
+STOPWORDS = frozenset('''
+    about above after again all also and any are because been before being below between both but
+    can could did does doing down during each few for from further had has have having her here
+    hers him his how into its itself just more most not now off once only other our ours out over
+    own same she should some such than that the their theirs them then there these they this those
+    through too under until very was were what when where which while who whom why will with would
+    you your yours please tell show give explain describe summarize document file text
+'''.split())
+
+_WORD = re.compile(r'\w+')
+
+def is_document_ref(block):
+    return isinstance(block, dict) and block.get('type') == 'document_ref'
+
+def should_index(block):
+    """Whether an extracted content block is large enough to index instead of sending whole"""
+    return (Config.RETRIEVAL_ENABLED
+            and isinstance(block, dict) and block.get('type') == 'text'
+            and len(block.get('text', '')) > Config.RETRIEVAL_MIN_DOCUMENT_CHARS)
+
+def session_key(session_id):
+    """Index token standing for a session; session ids themselves aren't single tokens"""
+    return 's' + hashlib.sha256(session_id.encode()).hexdigest()[:16]
+
+def chunk_text(text, size, overlap):
+    """Split text into chunks of about size characters; returns (start, chunk) pairs.
+
+    A chunk ends at a paragraph, line, sentence or word break when there is
+    one in its last quarter, and the next starts overlap characters earlier,
+    so a passage cut at a boundary is whole in one of the two.
+    """
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            floor = start + size * 3 // 4
+            for separator in ('\n\n', '\n', '. ', ' '):
+                cut = text.rfind(separator, floor, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        chunks.append((start, text[start:end]))
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+def _join_chunks(chunks):
+    parts = []
+    covered = 0
+    for start, chunk in chunks:
+        parts.append(chunk[covered - start:])
+        covered = start + len(chunk)
+    return ''.join(parts)
+
+def index_document(session_id, filename, content_hash, text):
+    """Chunk and index a document for the session; returns the reference block for the message.
+
+    The same file uploaded again in a session is indexed once.
+    """
+    chunks = chunk_text(text, Config.RETRIEVAL_CHUNK_CHARS, Config.RETRIEVAL_CHUNK_OVERLAP_CHARS)
+    key = session_key(session_id)
+    with get_db() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT id FROM documents WHERE session_id = ? AND content_hash = ?', (session_id, content_hash)
+            ).fetchone()
+            if row is None:
+                document_id = conn.execute('''
+                    INSERT INTO documents (session_id, content_hash, filename, char_count, chunk_count)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (session_id, content_hash, filename, len(text), len(chunks))).lastrowid
+                conn.executemany('''
+                    INSERT INTO document_chunks (document_id, seq, start, session_key, text)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(document_id, seq, start, key, chunk) for seq, (start, chunk) in enumerate(chunks)])
+            else:
+                document_id = row['id']
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return {
+        'type': 'document_ref',
+        'document_id': document_id,
+        'filename': filename,
+        'chars': len(text)
+    }
+
+def list_documents(session_id):
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT id, filename, char_count, chunk_count, created_at
+            FROM documents WHERE session_id = ? ORDER BY id
+        ''', (session_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+def get_document(session_id, document_id):
+    """A session's document with its full text, or None"""
+    with get_db() as conn:
+        row = conn.execute('''
+            SELECT id, filename, char_count, chunk_count, created_at
+            FROM documents WHERE id = ? AND session_id = ?
+        ''', (document_id, session_id)).fetchone()
+        if row is None:
+            return None
+        chunks = conn.execute(
+            'SELECT start, text FROM document_chunks WHERE document_id = ? ORDER BY seq', (document_id,)
+        ).fetchall()
+    return {**dict(row), 'text': _join_chunks((c['start'], c['text']) for c in chunks)}
+
+def _match_query(session_id, text):
+    """FTS5 query for chunks of the session's documents sharing any term with text, or None"""
+    terms = []
+    for word in _WORD.findall(text.lower()):
+        if (len(word) < 3 and not word.isdigit()) or word in STOPWORDS or word in terms:
+            continue
+        terms.append(word)
+        if len(terms) == MAX_QUERY_TERMS:
+            break
+    if not terms:
+        return None
+    # \w+ words need no escaping inside the quotes
+    return f'session_key : "{session_key(session_id)}" AND (' + ' OR '.join(f'"{t}"' for t in terms) + ')'
+
+def retrieve_chunks(session_id, text, exclude_documents=()):
+    """Chunks of the session's documents that best match text, best first, within the retrieval budget"""
+    match = _match_query(session_id, text)
+    if match is None:
+        return []
+    exclude_documents = list(exclude_documents)
+    placeholders = ', '.join('?' for _ in exclude_documents)
+    with get_db() as conn:
+        rows = conn.execute(f'''
+            SELECT c.document_id, c.seq, c.text, d.filename, d.chunk_count
+            FROM document_chunks_fts
+            JOIN document_chunks c ON c.id = document_chunks_fts.rowid
+            JOIN documents d ON d.id = c.document_id
+            WHERE document_chunks_fts MATCH ? AND c.document_id NOT IN ({placeholders})
+            ORDER BY rank
+            LIMIT ?
+        ''', [match] + exclude_documents + [Config.RETRIEVAL_TOP_K]).fetchall()
+
+    chunks = []
+    used = 0
+    for row in rows:
+        if used + len(row['text']) > Config.RETRIEVAL_BUDGET_CHARS or len(chunks) == Config.RETRIEVAL_TOP_K:
+            break
+        chunks.append(dict(row))
+        used += len(row['text'])
+    return chunks
+
+def _leading_chunks(document_id, budget):
+    """The opening chunks of a document, for a message that matched none of it"""
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT c.document_id, c.seq, c.text, d.filename, d.chunk_count
+            FROM document_chunks c JOIN documents d ON d.id = c.document_id
+            WHERE c.document_id = ? ORDER BY c.seq LIMIT ?
+        ''', (document_id, Config.RETRIEVAL_TOP_K)).fetchall()
+    chunks = []
+    for row in rows:
+        if len(row['text']) > budget:
+            break
+        chunks.append(dict(row))
+        budget -= len(row['text'])
+    return chunks
+
+def _stand_in(block):
+    return {
+        'type': 'text',
+        'text': f"[Document {block['filename']} ({block['chars']:,} characters) is indexed for this "
+                f"conversation; the parts relevant to each message are included with it.]"
+    }
+
+def _format_excerpts(chunks):
+    parts = ['Excerpts from documents in this conversation that match the message, most relevant first:']
+    for chunk in chunks:
+        parts.append(f"--- {chunk['filename']}, part {chunk['seq'] + 1} of {chunk['chunk_count']} ---\n{chunk['text']}")
+    return '\n\n'.join(parts)
+
+def collapse_document_refs(content):
+    """Content of a history message with document references replaced by a one-line stand-in"""
+    if not isinstance(content, list) or not any(is_document_ref(b) for b in content):
+        return content
+    return [_stand_in(block) if is_document_ref(block) else block for block in content]
+
+def expand_new_message(session_id, content):
+    """Content to send for a new user message; returns (content, expanded).
+
+    Document references become the document's full text when it is no longer
+    than RETRIEVAL_FULL_TEXT_MAX_CHARS. Then the chunks of the session's other
+    documents that match the message are added, or, for a document referenced
+    here that is too long to send whole and matched nothing, its opening
+    chunks. expanded is False when content is returned unchanged.
+    """
+    blocks = content if isinstance(content, list) else [{'type': 'text', 'text': content}]
+    expanded = []
+    full_text = set()
+    partial = []
+    query = []
+    for block in blocks:
+        if not is_document_ref(block):
+            expanded.append(block)
+            if isinstance(block, dict) and block.get('type') == 'text':
+                query.append(block['text'])
+            continue
+        document = None
+        if block['chars'] <= Config.RETRIEVAL_FULL_TEXT_MAX_CHARS:
+            document = get_document(session_id, block['document_id'])
+        if document is None:
+            expanded.append(_stand_in(block))
+            partial.append(block['document_id'])
+        else:
+            expanded.append({'type': 'text', 'text': document['text']})
+            full_text.add(block['document_id'])
+
+    chunks = retrieve_chunks(session_id, '\n'.join(query), full_text)
+    for document_id in partial:
+        if not any(chunk['document_id'] == document_id for chunk in chunks):
+            used = sum(len(chunk['text']) for chunk in chunks)
+            chunks += _leading_chunks(document_id, Config.RETRIEVAL_BUDGET_CHARS - used)
+    if chunks:
+        expanded.append({'type': 'text', 'text': _format_excerpts(chunks)})
+
+    if not chunks and not full_text and not partial:
+        return content, False
+    return expanded, True
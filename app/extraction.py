@@ -0,0 +1,192 @@
+# app/extraction.py
+"""Out-of-process document parsing.
+
+PDF and Word parsing is CPU bound, so it runs in a small per-worker process
+pool instead of on the request thread (where it would hold the GIL against
+the other gthread threads). Large PDFs are split into page ranges parsed in
+parallel. Each file gets a time budget and each pool process a memory cap;
+when a limit trips the caller gets whatever pages finished plus a note.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import TimeoutError as PoolTimeoutError
+from app.config import Config
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# How often a wait checks whether its pool was terminated under it (seconds)
+POOL_POLL_SECONDS = 0.25
+
+class ExtractionLimitError(Exception):
+    """Raised when a document exceeds the extraction time or memory limits"""
+    pass
+
+class PoolTerminatedError(Exception):
+    """Raised to tasks whose pool was terminated because of another task"""
+    pass
+
+# Functions below run inside the pool processes
+
+def _init_worker(memory_limit_bytes):
+    if memory_limit_bytes:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, memory_limit_bytes))
+
+def _pdf_page_count(file_path):
+    from PyPDF2 import PdfReader
+    return len(PdfReader(file_path).pages)
+
+def _pdf_pages_text(file_path, start, end):
+    from PyPDF2 import PdfReader
+    reader = PdfReader(file_path)
+    return [(reader.pages[i].extract_text() or "") for i in range(start, end)]
+
+def _word_text(file_path):
+    from docx import Document
+    document = Document(file_path)
+    return "\n".join(para.text for para in document.paragraphs)
+
+# Pool management (request side)
+
+def _create_pool():
+    methods = multiprocessing.get_all_start_methods()
+    # Never fork the threaded web worker; forkserver children start from a clean process
+    ctx = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    if 'forkserver' in methods:
+        ctx.set_forkserver_preload(['PyPDF2', 'docx'])
+    pool = ctx.Pool(
+        processes=Config.EXTRACTION_WORKERS,
+        initializer=_init_worker,
+        initargs=(Config.EXTRACTION_MEMORY_LIMIT_MB * 1024 * 1024,),
+        maxtasksperchild=Config.EXTRACTION_TASKS_PER_PROCESS
+    )
+    # Set by _reset_pool(): tasks still waiting on the pool will never complete
+    pool.terminated = threading.Event()
+    return pool
+
+def get_pool():
+    """Return this worker process's extraction pool, creating it on first use"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = _create_pool()
+            _pool_pid = os.getpid()
+        return _pool
+
+def _reset_pool(pool):
+    """Kill the pool a runaway task ran in; the next request gets a fresh one.
+
+    Only that pool: if another request already replaced it, the new one is
+    left alone. Other tasks waiting on the killed pool fail right away with
+    PoolTerminatedError instead of running out their own time budget.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not pool:
+            return
+        print("Terminating extraction pool after a task exceeded its limits")
+        pool.terminated.set()
+        pool.terminate()
+        _pool = None
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.terminate()
+        _pool = None
+
+def _submit(pool, func, args):
+    try:
+        return pool.apply_async(func, args)
+    except ValueError:
+        # "Pool not running": terminated between get_pool() and here
+        if pool.terminated.is_set():
+            raise PoolTerminatedError()
+        raise
+
+def _wait(pool, async_result, deadline):
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise PoolTimeoutError()
+        try:
+            return async_result.get(min(remaining, POOL_POLL_SECONDS))
+        except PoolTimeoutError:
+            if pool.terminated.is_set():
+                raise PoolTerminatedError()
+
+def _interrupted():
+    return ExtractionLimitError("interrupted: the extraction pool was restarted after another "
+                                "document exceeded its limits")
+
+def extract_word_text(file_path):
+    """Parse a Word document in the pool; raises ExtractionLimitError when limits trip"""
+    deadline = time.monotonic() + Config.EXTRACTION_TIMEOUT_SECONDS
+    pool = get_pool()
+    try:
+        return _wait(pool, _submit(pool, _word_text, (str(file_path),)), deadline)
+    except PoolTimeoutError:
+        _reset_pool(pool)
+        raise ExtractionLimitError(f"time limit of {Config.EXTRACTION_TIMEOUT_SECONDS}s exceeded")
+    except PoolTerminatedError:
+        raise _interrupted()
+    except MemoryError:
+        raise ExtractionLimitError(f"memory limit of {Config.EXTRACTION_MEMORY_LIMIT_MB}MB exceeded")
+
+def extract_pdf_text(file_path):
+    """Parse a PDF in the pool, splitting large files into page ranges parsed in parallel.
+
+    Returns (text, page_count, problem): problem is None when every page was
+    extracted, otherwise a description of the limit that tripped and text
+    holds the pages that did finish.
+    """
+    file_path = str(file_path)
+    deadline = time.monotonic() + Config.EXTRACTION_TIMEOUT_SECONDS
+    pool = get_pool()
+
+    try:
+        page_count = _wait(pool, _submit(pool, _pdf_page_count, (file_path,)), deadline)
+    except PoolTimeoutError:
+        _reset_pool(pool)
+        raise ExtractionLimitError(f"time limit of {Config.EXTRACTION_TIMEOUT_SECONDS}s exceeded")
+    except PoolTerminatedError:
+        raise _interrupted()
+    except MemoryError:
+        raise ExtractionLimitError(f"memory limit of {Config.EXTRACTION_MEMORY_LIMIT_MB}MB exceeded")
+
+    step = Config.EXTRACTION_PDF_PAGES_PER_TASK
+    ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    try:
+        tasks = [_submit(pool, _pdf_pages_text, (file_path, start, end)) for start, end in ranges]
+    except PoolTerminatedError:
+        raise _interrupted()
+
+    pages = []
+    problem = None
+    for (start, end), task in zip(ranges, tasks):
+        try:
+            pages.extend(_wait(pool, task, deadline))
+        except PoolTimeoutError:
+            problem = f"time limit of {Config.EXTRACTION_TIMEOUT_SECONDS}s exceeded"
+            _reset_pool(pool)
+            break
+        except PoolTerminatedError:
+            problem = str(_interrupted())
+            break
+        except MemoryError:
+            problem = f"memory limit of {Config.EXTRACTION_MEMORY_LIMIT_MB}MB exceeded"
+            break
+        except Exception as e:
+            problem = f"error on pages {start + 1}-{end}: {e}"
+            break
+
+    text = "".join(page + "\n" for page in pages)
+    if problem:
+        text += (f"\n[Extraction stopped after {len(pages)} of {page_count} pages: {problem}. "
+                 f"The rest of the document is not included.]")
+    return text, page_count, problem
@@ -1,10 +1,22 @@
 # app/file_handler.py
 import os
-import base64
-import mimetypes
-from datetime import datetime
+import hashlib
+import json
 from werkzeug.utils import secure_filename
+from app.cache import LRUCache
 from app.config import Config
+from app.database import store_attachment, store_attachment_file
+from app.images import ImageError, PreparedImage, prepare_image
+from app.ingest import (
+    IMAGE_MEDIA_TYPES, SNIFF_BYTES, UPLOAD_CHUNK_SIZE, IngestWriter, ingest_stream, sniff_media_type
+)
+from app.metrics import EXTRACTION_LATENCY, IMAGE_BYTES, timed
+
+# Bump when extraction output changes so stale cached results are ignored
+EXTRACTOR_VERSION = 1
+
+# Extraction results by content hash, shared by all requests in this process
+extraction_cache = LRUCache(Config.EXTRACTION_CACHE_MAX_BYTES)
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
@@ -12,78 +24,214 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in Config.ALLOWED_EXTENSIONS
 
 def save_uploaded_file(file):
-    """Save uploaded file and return filename and filepath"""
+    """Save an uploaded file into the content-addressed store; returns an IngestedFile.
+
+    Identical uploads are stored once. With UploadRequest (see app.ingest) the
+    file was already written, hashed and sniffed while the request was parsed.
+    """
     filename = secure_filename(file.filename)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"{timestamp}_{filename}"
-    filepath = Config.UPLOADS_DIR / filename
-    file.save(str(filepath))
-    return filename, filepath
-
-def encode_file_for_claude(file_path):
-    """Encode file for Claude API based on file type"""
-    mime_type, _ = mimetypes.guess_type(str(file_path))
-    file_ext = file_path.suffix.lower()
+    if isinstance(file.stream, IngestWriter):
+        return file.stream.store(filename)
+    return ingest_stream(file.stream, filename)
+
+def hash_file(file_path):
+    """SHA256 of a file on disk"""
+    sha256_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            sha256_hash.update(chunk)
+    return sha256_hash.hexdigest()
+
+class ExtractionError(Exception):
+    """Raised when a document cannot be parsed"""
+    pass
+
+class PartialExtractionError(ExtractionError):
+    """Raised when only part of a document could be extracted; .block holds what was"""
+    def __init__(self, message, block):
+        super().__init__(message)
+        self.block = block
+
+def _extract_word(file_path):
+    if Config.EXTRACTION_POOL_ENABLED:
+        from app.extraction import extract_word_text
+        text = extract_word_text(file_path)
+    else:
+        from app.extraction import _word_text
+        text = _word_text(str(file_path))
+    return {
+        "type": "text",
+        "text": text
+    }
+
+def _extract_pdf(file_path):
+    if not Config.EXTRACTION_POOL_ENABLED:
+        from app.extraction import _pdf_page_count, _pdf_pages_text
+        pages = _pdf_pages_text(str(file_path), 0, _pdf_page_count(str(file_path)))
+        return {
+            "type": "text",
+            "text": "".join(page + "\n" for page in pages)
+        }
     
+    from app.extraction import extract_pdf_text
+    text, page_count, problem = extract_pdf_text(file_path)
+    block = {
+        "type": "text",
+        "text": text
+    }
+    if problem:
+        raise PartialExtractionError(f"Partial PDF extraction of {file_path.name}: {problem}", block)
+    return block
+
+def _store_image(file_path, content_hash, media_type):
+    """Prepare an image (see app.images), store it as an attachment and return a reference to it.
+
+    The reference is hydrated with the base64 data only when the API payload
+    is built, so no encoded copies are made or cached here.
+    """
+    if Config.IMAGE_PREPARE_ENABLED:
+        image = prepare_image(file_path, media_type)
+    else:
+        size = os.path.getsize(file_path)
+        image = PreparedImage(None, media_type, size, size, None, None)
+    if image.data is None:
+        attachment_id = content_hash
+        store_attachment_file(attachment_id, image.media_type, file_path)
+    else:
+        attachment_id = image.attachment_id
+        store_attachment(attachment_id, image.media_type, image.data)
+        print(f"Prepared image {file_path.name}: {image.original_size:,} bytes "
+              f"{image.original_dimensions[0]}x{image.original_dimensions[1]} -> {image.size:,} bytes "
+              f"{image.dimensions[0]}x{image.dimensions[1]} {image.media_type}")
+    IMAGE_BYTES.labels('original').inc(image.original_size)
+    IMAGE_BYTES.labels('sent').inc(image.size)
+    return {
+        "type": "image",
+        "source": {
+            "type": "attachment",
+            "attachment_id": attachment_id,
+            "media_type": image.media_type
+        }
+    }
+
+def _read_text(file_path):
     with open(file_path, 'rb') as file:
-        # Handle Word documents
-        if file_ext in ('.docx', '.doc'):
-            try:
-                from docx import Document
-                document = Document(str(file_path))
-                full_text = []
-                for para in document.paragraphs:
-                    full_text.append(para.text)
-                return {
-                    "type": "text",
-                    "text": "\n".join(full_text)
-                }
-            except Exception as e:
-                print(f"Error reading Word document: {e}")
-                return {
-                    "type": "text",
-                    "text": f"Error reading Word document: {e}\n\nUnable to process the file content."
-                }
-        
-        # Handle PDF files
-        elif file_ext == '.pdf':
-            try:
-                from PyPDF2 import PdfReader
-                reader = PdfReader(str(file_path))
-                text = ""
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-                return {
-                    "type": "text",
-                    "text": text
-                }
-            except Exception as e:
-                print(f"Error reading PDF file: {e}")
-                return {
-                    "type": "text",
-                    "text": f"Error reading PDF file: {e}\n\nUnable to process the file content."
-                }
-        
-        # Handle images
-        elif mime_type and mime_type.startswith('image/'):
+        try:
+            return {
+                "type": "text",
+                "text": file.read().decode('utf-8')
+            }
+        except UnicodeDecodeError:
+            return {
+                "type": "text",
+                "text": "This file appears to be a binary file that cannot be processed as text."
+            }
+
+def extract_file_content(file_path):
+    """Parse a file into a Claude content block; raises ExtractionError on parse failure"""
+    file_ext = file_path.suffix.lower()
+
+    # Handle Word documents
+    if file_ext in ('.docx', '.doc'):
+        try:
+            return _extract_word(file_path)
+        except Exception as e:
+            raise ExtractionError(f"Error reading Word document: {e}")
+
+    # Handle PDF files
+    elif file_ext == '.pdf':
+        try:
+            return _extract_pdf(file_path)
+        except PartialExtractionError:
+            raise
+        except Exception as e:
+            raise ExtractionError(f"Error reading PDF file: {e}")
+
+    # For text files, read as text
+    return _read_text(file_path)
+
+def _extraction_type(file_path):
+    """Metric label for the extractor extract_file_content will use"""
+    file_ext = file_path.suffix.lower()
+    if file_ext in ('.docx', '.doc'):
+        return 'word'
+    if file_ext == '.pdf':
+        return 'pdf'
+    return 'text'
+
+def _cache_key(content_hash, file_ext):
+    # The extension picks the extractor, so the same bytes as .txt and .py share
+    # a result but .pdf does not
+    return f"{content_hash}{file_ext}-v{EXTRACTOR_VERSION}"
+
+def _block_size(block):
+    return len(block.get('text', '')) + 200
+
+def _read_disk_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _write_disk_cache(path, block):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(block, f)
+    os.replace(tmp_path, path)
+
+def _sniff_file(file_path):
+    with open(file_path, 'rb') as f:
+        return sniff_media_type(f.read(SNIFF_BYTES))
+
+def encode_file_for_claude(file_path, content_hash=None, media_type=None):
+    """Encode file for Claude API based on file type.
+
+    Images (by their content, media_type when the caller already sniffed it)
+    become attachment references. Other results are cached in memory and on
+    disk by content hash and extractor version, so re-uploads of the same
+    file skip parsing entirely.
+    """
+    if content_hash is None:
+        content_hash = hash_file(file_path)
+    if media_type is None:
+        media_type = _sniff_file(file_path)
+    if media_type in IMAGE_MEDIA_TYPES:
+        try:
+            with timed(EXTRACTION_LATENCY, type='image'):
+                return _store_image(file_path, content_hash, media_type)
+        except ImageError as e:
+            print(str(e))
             return {
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": mime_type,
-                    "data": base64.b64encode(file.read()).decode()
-                }
+                "type": "text",
+                "text": f"{e}\n\nUnable to process the image."
             }
-        else:
-            # For text files, read as text
-            try:
-                file.seek(0)
-                return {
-                    "type": "text",
-                    "text": file.read().decode('utf-8')
-                }
-            except UnicodeDecodeError:
-                return {
-                    "type": "text",
-                    "text": "This file appears to be a binary file that cannot be processed as text."
-                }
\ No newline at end of file
+
+    key = _cache_key(content_hash, file_path.suffix.lower())
+
+    block = extraction_cache.get(key)
+    if block is not None:
+        return block
+
+    disk_path = Config.UPLOADS_DIR / 'extracted' / f"{key}.json"
+    block = _read_disk_cache(disk_path)
+    if block is None:
+        try:
+            with timed(EXTRACTION_LATENCY, type=_extraction_type(file_path)):
+                block = extract_file_content(file_path)
+        except PartialExtractionError as e:
+            # Limits tripped; use what was extracted but don't cache it
+            print(str(e))
+            return e.block
+        except ExtractionError as e:
+            # Not cached: a fixed extractor should get another chance
+            print(str(e))
+            return {
+                "type": "text",
+                "text": f"{e}\n\nUnable to process the file content."
+            }
+        _write_disk_cache(disk_path, block)
+
+    extraction_cache.set(key, block, _block_size(block))
+    return block
@@ -0,0 +1,255 @@
+# app/github_client.py
+"""Shared GitHub API client.
+
+One pooled requests.Session per worker process, with timeouts on every call.
+GET responses are cached by URL: within GITHUB_CACHE_TTL_SECONDS they are
+served from memory, after that they are revalidated with If-None-Match so an
+unchanged resource costs a 304 (which does not count against the rate limit)
+instead of a full response. List endpoints are followed through their Link
+headers. When the rate limit is hit the client waits for the reset if it is
+close, and otherwise serves a stale cached copy or raises GitHubRateLimitError.
+
+The a* methods are awaitable versions for the ASGI server; they share the
+cache and use an httpx client. GITHUB_API_URL can point at a local fake
+server for testing. requests and httpx are imported when the client is first
+created, not with the app.
+"""
+import asyncio
+import os
+import threading
+import time
+from app.cache import LRUCache
+from app.config import Config
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+class GitHubError(Exception):
+    """Raised when the GitHub API returns an error or can't be reached"""
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class GitHubRateLimitError(GitHubError):
+    """Raised when the rate limit is exhausted and nothing cached can be served"""
+    pass
+
+def _rate_limit_wait(response):
+    """Seconds until a rate-limited request may be retried, or None if it isn't rate limited"""
+    if response.status_code not in (403, 429):
+        return None
+    if 'Retry-After' in response.headers:
+        # Secondary rate limit
+        return float(response.headers['Retry-After'])
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        reset = float(response.headers.get('X-RateLimit-Reset', 0))
+        return max(0.0, reset - time.time())
+    return None
+
+class GitHubClient:
+    def __init__(self, base_url, token=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=Config.GITHUB_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept'] = 'application/vnd.github.v3+json'
+        if token:
+            self.session.headers['Authorization'] = f'token {token}'
+        self.cache = LRUCache(Config.GITHUB_CACHE_MAX_BYTES)
+        self._async_session = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'requests': 0, 'cache_hits': 0, 'not_modified': 0, 'rate_limited': 0}
+
+    @property
+    def configured(self):
+        return bool(self.token)
+
+    def _bump(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _url(self, path):
+        return path if path.startswith(('http://', 'https://')) else f'{self.base_url}/{path.lstrip("/")}'
+
+    def _request(self, url, headers):
+        """GET with rate-limit-aware retries; returns the final response"""
+        import requests
+
+        for attempt in range(Config.GITHUB_MAX_RETRIES + 1):
+            self._bump('requests')
+            try:
+                response = self.session.get(url, headers=headers, timeout=Config.GITHUB_TIMEOUT)
+            except requests.RequestException as e:
+                raise GitHubError(f"GitHub API request failed: {str(e)}") from e
+            wait = self._retry_wait(response, attempt)
+            if wait is None:
+                return response
+            print(f"GitHub rate limit hit; retrying {url} in {wait:.0f}s")
+            time.sleep(wait)
+        return response
+
+    async def _arequest(self, url, headers):
+        import httpx
+
+        for attempt in range(Config.GITHUB_MAX_RETRIES + 1):
+            self._bump('requests')
+            try:
+                response = await self._get_async_session().get(url, headers=headers)
+            except httpx.HTTPError as e:
+                raise GitHubError(f"GitHub API request failed: {str(e)}") from e
+            wait = self._retry_wait(response, attempt)
+            if wait is None:
+                return response
+            print(f"GitHub rate limit hit; retrying {url} in {wait:.0f}s")
+            await asyncio.sleep(wait)
+        return response
+
+    def _get_async_session(self):
+        # httpx rather than requests so the ASGI server can await GitHub calls
+        if self._async_session is None:
+            import httpx
+            connect, read = Config.GITHUB_TIMEOUT
+            self._async_session = httpx.AsyncClient(
+                headers=dict(self.session.headers),
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_connections=Config.GITHUB_POOL_SIZE)
+            )
+        return self._async_session
+
+    def _retry_wait(self, response, attempt):
+        """Seconds to wait before retrying a rate-limited response, or None to use it as is"""
+        wait = _rate_limit_wait(response)
+        if wait is None:
+            return None
+        self._bump('rate_limited')
+        if attempt == Config.GITHUB_MAX_RETRIES or wait > Config.GITHUB_RATE_LIMIT_MAX_WAIT_SECONDS:
+            return None
+        return wait
+
+    def _lookup(self, url):
+        """Return (cached entry, fresh); fresh entries are served without a request"""
+        cached = self.cache.get(url)
+        if cached is not None and time.monotonic() - cached['fetched_at'] < Config.GITHUB_CACHE_TTL_SECONDS:
+            self._bump('cache_hits')
+            return cached, True
+        return cached, False
+
+    def _conditional_headers(self, cached):
+        if cached is not None and cached['etag']:
+            return {'If-None-Match': cached['etag']}
+        return {}
+
+    def _handle_response(self, url, cached, response):
+        """Turn a response (requests or httpx) into (data, next_url), updating the cache"""
+        if response.status_code == 304 and cached is not None:
+            self._bump('not_modified')
+            self.cache.set(url, {**cached, 'fetched_at': time.monotonic()}, cached['size'])
+            return cached['data'], cached['next_url']
+
+        if _rate_limit_wait(response) is not None:
+            if cached is not None:
+                print(f"GitHub rate limit exhausted; serving cached {url}")
+                return cached['data'], cached['next_url']
+            raise GitHubRateLimitError("GitHub API rate limit exceeded", response.status_code)
+
+        if response.status_code != 200:
+            reason = getattr(response, 'reason', None) or getattr(response, 'reason_phrase', '')
+            try:
+                message = response.json().get('message', reason)
+            except ValueError:
+                message = reason
+            raise GitHubError(f"GitHub API error: {message}", response.status_code)
+
+        data = response.json()
+        next_url = response.links.get('next', {}).get('url')
+        entry = {
+            'data': data,
+            'next_url': next_url,
+            'etag': response.headers.get('ETag'),
+            'fetched_at': time.monotonic(),
+            'size': len(response.content) + 200
+        }
+        self.cache.set(url, entry, entry['size'])
+        return data, next_url
+
+    def get(self, path):
+        """GET a URL or API path and return (data, next_url), using the cache"""
+        url = self._url(path)
+        cached, fresh = self._lookup(url)
+        if fresh:
+            return cached['data'], cached['next_url']
+        response = self._request(url, self._conditional_headers(cached))
+        return self._handle_response(url, cached, response)
+
+    async def aget(self, path):
+        """Awaitable get(); shares the cache with the sync methods"""
+        url = self._url(path)
+        cached, fresh = self._lookup(url)
+        if fresh:
+            return cached['data'], cached['next_url']
+        response = await self._arequest(url, self._conditional_headers(cached))
+        return self._handle_response(url, cached, response)
+
+    def _first_page(self, path):
+        separator = '&' if '?' in path else '?'
+        return f'{path}{separator}per_page=100'
+
+    def get_all(self, path, max_pages=None):
+        """GET a list endpoint and follow its pages"""
+        max_pages = max_pages or Config.GITHUB_MAX_PAGES
+        items, next_url = self.get(self._first_page(path))
+        items = list(items)
+        pages = 1
+        while next_url and pages < max_pages:
+            page, next_url = self.get(next_url)
+            items.extend(page)
+            pages += 1
+        return items
+
+    async def aget_all(self, path, max_pages=None):
+        max_pages = max_pages or Config.GITHUB_MAX_PAGES
+        items, next_url = await self.aget(self._first_page(path))
+        items = list(items)
+        pages = 1
+        while next_url and pages < max_pages:
+            page, next_url = await self.aget(next_url)
+            items.extend(page)
+            pages += 1
+        return items
+
+    def list_repos(self):
+        """Repositories of the authenticated user, all pages"""
+        return self.get_all('/user/repos')
+
+    async def alist_repos(self):
+        return await self.aget_all('/user/repos')
+
+    def get_file(self, owner, repo, path):
+        """Contents API response for a file"""
+        data, _ = self.get(f'/repos/{owner}/{repo}/contents/{path}')
+        return data
+
+    async def aget_file(self, owner, repo, path):
+        data, _ = await self.aget(f'/repos/{owner}/{repo}/contents/{path}')
+        return data
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['cache'] = self.cache.stats()
+        return stats
+
+def get_github_client():
+    """Return this worker process's shared GitHub client, creating it on first use"""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = GitHubClient(Config.GITHUB_API_URL, Config.GITHUB_TOKEN)
+            _client_pid = os.getpid()
+        return _client
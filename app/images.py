@@ -0,0 +1,106 @@
+# app/images.py
+"""Preparing uploaded images for the API.
+
+The model downscales any image whose long edge is over IMAGE_MAX_EDGE_PX or
+whose area is over IMAGE_MAX_PIXELS, so sending a phone photo at full
+resolution only costs upload time and storage. prepare_image() decodes an
+upload once (JPEGs straight at a reduced scale), applies its EXIF rotation,
+resizes it to those limits and re-encodes it without metadata: JPEG at
+IMAGE_QUALITY, or WebP when it has transparency. An image that needs no
+resizing and has no metadata keeps its original bytes if re-encoding wouldn't
+make it smaller. Animated images are left as they are.
+
+Pillow is imported on first use.
+"""
+import hashlib
+import io
+import math
+from app.config import Config
+
+# Pillow modes that can be written as JPEG as they are
+JPEG_MODES = {'RGB', 'L'}
+
+# Image info keys holding metadata that is dropped when re-encoding
+METADATA_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment')
+
+class ImageError(Exception):
+    """Raised when an uploaded image cannot be decoded"""
+    pass
+
+class PreparedImage:
+    """An image ready to be stored as an attachment.
+
+    data is None when the original file is to be sent unchanged.
+    """
+    def __init__(self, data, media_type, size, original_size, dimensions, original_dimensions):
+        self.data = data
+        self.media_type = media_type
+        self.size = size
+        self.original_size = original_size
+        self.dimensions = dimensions
+        self.original_dimensions = original_dimensions
+
+    @property
+    def attachment_id(self):
+        return hashlib.sha256(self.data).hexdigest() if self.data is not None else None
+
+def target_dimensions(width, height):
+    """The largest size with the same aspect ratio that is within the model's limits"""
+    scale = min(
+        1.0,
+        Config.IMAGE_MAX_EDGE_PX / max(width, height),
+        math.sqrt(Config.IMAGE_MAX_PIXELS / (width * height))
+    )
+    if scale >= 1.0:
+        return width, height
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def _has_transparency(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+
+def _encode(image, transparent):
+    """Encode image without metadata; returns (bytes, media_type)"""
+    buffer = io.BytesIO()
+    if transparent:
+        image.convert('RGBA').save(buffer, 'WEBP', quality=Config.IMAGE_QUALITY)
+        return buffer.getvalue(), 'image/webp'
+    if image.mode not in JPEG_MODES:
+        image = image.convert('RGB')
+    image.save(buffer, 'JPEG', quality=Config.IMAGE_QUALITY, optimize=True)
+    return buffer.getvalue(), 'image/jpeg'
+
+def prepare_image(file_path, media_type):
+    """Decode, resize and re-encode an uploaded image; returns a PreparedImage.
+
+    Raises ImageError when the file can't be decoded.
+    """
+    from PIL import Image, ImageOps
+
+    original_size = file_path.stat().st_size
+    try:
+        with Image.open(file_path) as image:
+            original_dimensions = image.size
+            if getattr(image, 'is_animated', False):
+                return PreparedImage(None, media_type, original_size, original_size,
+                                     original_dimensions, original_dimensions)
+
+            dimensions = target_dimensions(*image.size)
+            resized = dimensions != image.size
+            has_metadata = any(key in image.info for key in METADATA_KEYS)
+            transparent = _has_transparency(image)
+            # JPEG only: decode at the smallest 1/2, 1/4 or 1/8 scale that is still large enough
+            image.draft(image.mode, dimensions)
+            # exif_transpose drops the orientation tag, so the rotation survives stripping it
+            oriented = ImageOps.exif_transpose(image)
+            if oriented.size != image.size:
+                dimensions = dimensions[::-1]
+            if oriented.size != dimensions:
+                oriented = oriented.resize(dimensions, Image.Resampling.LANCZOS, reducing_gap=3.0)
+            data, prepared_type = _encode(oriented, transparent)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageError(f"Unable to decode image {file_path.name}: {str(e)}")
+
+    if not resized and not has_metadata and len(data) >= original_size:
+        return PreparedImage(None, media_type, original_size, original_size,
+                             original_dimensions, original_dimensions)
+    return PreparedImage(data, prepared_type, len(data), original_size, dimensions, original_dimensions)
@@ -0,0 +1,357 @@
+# app/ingest.py
+"""Upload ingestion: one pass over the bytes, straight into the upload store.
+
+Werkzeug parses multipart uploads into a file object the request class
+provides (UploadRequest), so file parts are written directly to a temporary
+file in the content-addressed store (UPLOADS_DIR/objects), and are hashed,
+counted and type-sniffed as they go, instead of being spooled by Werkzeug
+and copied afterwards. No copy of the whole file is held in memory.
+
+Files too large for one request, or sent over connections that drop, can go
+up in pieces through the resumable upload API (routes/upload.py):
+
+    POST   /uploads        {"filename": ..., "size": ...}  -> upload_id
+    PATCH  /uploads/<id>   the next piece, with an Upload-Offset header
+    GET    /uploads/<id>   how much has arrived, to resume from
+    DELETE /uploads/<id>
+
+and are then analyzed with POST /upload (or /upload/stream) and an upload_id
+form field in place of the file. Pieces are appended under UPLOADS_DIR/incoming;
+uploads untouched for RESUMABLE_UPLOAD_EXPIRY_HOURS are removed.
+"""
+import fcntl
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+from flask import Request
+from werkzeug.utils import secure_filename
+from app.config import Config
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+SNIFF_BYTES = 512
+
+# Image types the API accepts
+IMAGE_MEDIA_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+
+_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),  # docx
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'),  # legacy doc
+]
+
+# What the content of files with these extensions has to sniff as
+_EXPECTED_TYPES = {
+    '.pdf': {'application/pdf'},
+    '.docx': {'application/zip'},
+    '.doc': {'application/zip', 'application/x-ole-storage'},
+}
+
+_UPLOAD_ID = re.compile(r'[0-9a-f]{32}')
+
+# Running hashes of resumable uploads whose pieces this process appended in
+# order, by upload id: (offset, sha256). Others are hashed when finished.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+class UploadError(Exception):
+    """An upload the client has to fix; .status is the HTTP status to answer with"""
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+class IngestedFile:
+    """A file in the content-addressed upload store"""
+    def __init__(self, filename, path, content_hash, size, media_type):
+        self.filename = filename
+        self.path = path
+        self.content_hash = content_hash
+        self.size = size
+        self.media_type = media_type
+
+def sniff_media_type(head):
+    """Media type from a file's first bytes: text/plain or application/octet-stream when not recognised"""
+    for signature, media_type in _SIGNATURES:
+        if head.startswith(signature):
+            return media_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream' if b'\x00' in head else 'text/plain'
+
+def check_file_type(upload):
+    """Raise UploadError when the content can't be what the file's extension says"""
+    file_ext = os.path.splitext(upload.filename)[1].lower()
+    guessed, _ = mimetypes.guess_type(upload.filename)
+    if guessed and guessed.startswith('image/') and upload.media_type not in IMAGE_MEDIA_TYPES:
+        raise UploadError('Unsupported or damaged image; PNG, JPEG, GIF and WebP images can be analyzed', 415)
+    expected = _EXPECTED_TYPES.get(file_ext)
+    if expected and upload.media_type not in expected:
+        raise UploadError(f'The file is not a valid {file_ext[1:].upper()} document', 415)
+
+def _objects_dir():
+    objects_dir = Config.UPLOADS_DIR / 'objects'
+    objects_dir.mkdir(parents=True, exist_ok=True)
+    return objects_dir
+
+def _store_object(tmp_path, content_hash, filename, size, media_type):
+    """Move a fully written file to its content-addressed name; identical files are stored once"""
+    file_ext = os.path.splitext(filename)[1].lower()
+    filepath = _objects_dir() / f"{content_hash}{file_ext}"
+    if filepath.exists():
+        # Already stored by an earlier upload of the same content
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, filepath)
+    return IngestedFile(filename, filepath, content_hash, size, media_type)
+
+class IngestWriter:
+    """Writable file that takes an upload into the store in a single pass.
+
+    Bytes go to a temporary file beside the store while being hashed, counted
+    and sniffed; store() then gives the file its content-addressed name.
+    Closing it before then discards the file.
+    """
+    def __init__(self):
+        fd, self.tmp_path = tempfile.mkstemp(dir=_objects_dir(), suffix='.part')
+        self.file = os.fdopen(fd, 'w+b')
+        self.sha256 = hashlib.sha256()
+        self.head = b''
+        self.size = 0
+        self.stored = None
+
+    def write(self, data):
+        self.sha256.update(data)
+        if len(self.head) < SNIFF_BYTES:
+            self.head += data[:SNIFF_BYTES - len(self.head)]
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        # read(), seek() etc. for Werkzeug's FileStorage
+        return getattr(self.file, name)
+
+    def store(self, filename):
+        """Move the file into the store; returns an IngestedFile"""
+        if self.stored is None:
+            self.file.close()
+            self.stored = _store_object(
+                self.tmp_path, self.sha256.hexdigest(), filename, self.size, sniff_media_type(self.head)
+            )
+        return self.stored
+
+    def close(self):
+        self.file.close()
+        if self.stored is None and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+class UploadRequest(Request):
+    """Flask request class that parses file parts straight into the upload store"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return IngestWriter()
+
+def ingest_stream(stream, filename):
+    """Copy a readable stream into the store in one pass; returns an IngestedFile"""
+    writer = IngestWriter()
+    try:
+        for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+            writer.write(chunk)
+        return writer.store(filename)
+    finally:
+        writer.close()
+
+# Resumable uploads
+
+def _incoming_dir():
+    incoming_dir = Config.UPLOADS_DIR / 'incoming'
+    incoming_dir.mkdir(parents=True, exist_ok=True)
+    return incoming_dir
+
+def _upload_paths(upload_id):
+    if not _UPLOAD_ID.fullmatch(upload_id or ''):
+        raise UploadError('Unknown or expired upload', 404)
+    incoming_dir = _incoming_dir()
+    return incoming_dir / f'{upload_id}.part', incoming_dir / f'{upload_id}.json'
+
+def _write_meta(meta_path, meta):
+    tmp_path = meta_path.with_name(f"{meta_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+def _load_upload(upload_id, session_id):
+    part_path, meta_path = _upload_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        raise UploadError('Unknown or expired upload', 404)
+    if meta['session_id'] != session_id:
+        # Uploads belong to the session that started them
+        raise UploadError('Unknown or expired upload', 404)
+    return part_path, meta_path, meta
+
+def _upload_status(upload_id, meta, offset):
+    return {
+        'upload_id': upload_id,
+        'filename': meta['filename'],
+        'size': meta['size'],
+        'offset': offset,
+        'complete': offset == meta['size']
+    }
+
+def _take_hasher(upload_id, offset):
+    """Running hash for an upload at offset, if this process has one"""
+    with _hashers_lock:
+        entry = _hashers.pop(upload_id, None)
+    if entry is not None and entry[0] == offset:
+        return entry[1]
+    return hashlib.sha256() if offset == 0 else None
+
+def _put_hasher(upload_id, offset, sha256):
+    with _hashers_lock:
+        _hashers[upload_id] = (offset, sha256)
+
+def remove_expired_uploads():
+    """Delete resumable uploads nothing was appended to for RESUMABLE_UPLOAD_EXPIRY_HOURS"""
+    cutoff = time.time() - Config.RESUMABLE_UPLOAD_EXPIRY_HOURS * 3600
+    removed = 0
+    for path in _incoming_dir().iterdir():
+        try:
+            if path.stat().st_mtime >= cutoff:
+                continue
+            upload_id = path.name.split('.', 1)[0]
+            part_path, meta_path = _upload_paths(upload_id)
+            if part_path.exists() and part_path.stat().st_mtime >= cutoff:
+                continue
+            for stale in (part_path, meta_path):
+                stale.unlink(missing_ok=True)
+            with _hashers_lock:
+                _hashers.pop(upload_id, None)
+            removed += 1
+        except (FileNotFoundError, UploadError):
+            continue
+    return removed
+
+def create_upload(session_id, filename, size):
+    """Start a resumable upload; returns its status"""
+    filename = secure_filename(filename or '')
+    if not filename:
+        raise UploadError('A filename is required')
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        raise UploadError('size must be the file size in bytes')
+    if size > Config.RESUMABLE_UPLOAD_MAX_BYTES:
+        raise UploadError(f'Files can be at most {Config.RESUMABLE_UPLOAD_MAX_BYTES} bytes', 413)
+
+    remove_expired_uploads()
+    upload_id = secrets.token_hex(16)
+    part_path, meta_path = _upload_paths(upload_id)
+    part_path.touch()
+    meta = {'filename': filename, 'size': size, 'session_id': session_id, 'created_at': time.time()}
+    _write_meta(meta_path, meta)
+    return {**_upload_status(upload_id, meta, 0), 'chunk_size': Config.RESUMABLE_UPLOAD_CHUNK_BYTES}
+
+def get_upload(upload_id, session_id):
+    """Status of a resumable upload: its offset is where to resume from"""
+    part_path, _, meta = _load_upload(upload_id, session_id)
+    if 'content_hash' in meta:
+        return _upload_status(upload_id, meta, meta['size'])
+    try:
+        offset = part_path.stat().st_size
+    except FileNotFoundError:
+        raise UploadError('Unknown or expired upload', 404)
+    return _upload_status(upload_id, meta, offset)
+
+def append_upload(upload_id, session_id, offset, stream):
+    """Append a piece read from stream at offset, which must be where the upload is up to.
+
+    A piece cut short by a dropped connection is kept; the client resumes
+    from the offset GET /uploads/<id> reports.
+    """
+    part_path, _, meta = _load_upload(upload_id, session_id)
+    if 'content_hash' in meta:
+        raise UploadError('Upload already finished', 409, offset=meta['size'])
+    try:
+        part = open(part_path, 'r+b')
+    except FileNotFoundError:
+        raise UploadError('Unknown or expired upload', 404)
+
+    with part:
+        # Pieces for one upload are appended one at a time, across workers too
+        fcntl.flock(part, fcntl.LOCK_EX)
+        current = os.fstat(part.fileno()).st_size
+        if offset != current:
+            raise UploadError(f'Upload is at offset {current}', 409, offset=current)
+
+        part.seek(current)
+        sha256 = _take_hasher(upload_id, current)
+        try:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                if current + len(chunk) > meta['size']:
+                    raise UploadError(f"Upload is larger than the {meta['size']} bytes declared", 413, offset=current)
+                part.write(chunk)
+                if sha256 is not None:
+                    sha256.update(chunk)
+                current += len(chunk)
+        finally:
+            part.flush()
+            if sha256 is not None:
+                _put_hasher(upload_id, current, sha256)
+    return _upload_status(upload_id, meta, current)
+
+def finish_upload(upload_id, session_id):
+    """Move a complete resumable upload into the store; returns an IngestedFile.
+
+    The upload id stays usable until it expires, so a request that fails
+    after this (e.g. the API is busy) can be retried without re-uploading.
+    """
+    part_path, meta_path, meta = _load_upload(upload_id, session_id)
+    if 'content_hash' in meta:
+        filepath = _objects_dir() / meta['stored_name']
+        if not filepath.exists():
+            raise UploadError('Unknown or expired upload', 404)
+        return IngestedFile(meta['filename'], filepath, meta['content_hash'], meta['size'], meta['media_type'])
+
+    try:
+        part = open(part_path, 'rb')
+    except FileNotFoundError:
+        raise UploadError('Unknown or expired upload', 404)
+
+    with part:
+        fcntl.flock(part, fcntl.LOCK_EX)
+        size = os.fstat(part.fileno()).st_size
+        if size != meta['size']:
+            raise UploadError(f"Upload incomplete: {size} of {meta['size']} bytes received", 409, offset=size)
+        head = part.read(SNIFF_BYTES)
+        sha256 = _take_hasher(upload_id, size)
+        if sha256 is None:
+            # Pieces went to other workers; hash the assembled file instead
+            sha256 = hashlib.sha256(head)
+            for chunk in iter(lambda: part.read(UPLOAD_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+        upload = _store_object(part_path, sha256.hexdigest(), meta['filename'], size, sniff_media_type(head))
+
+    _write_meta(meta_path, {
+        **meta,
+        'content_hash': upload.content_hash,
+        'media_type': upload.media_type,
+        'stored_name': upload.path.name
+    })
+    return upload
+
+def abort_upload(upload_id, session_id):
+    """Delete a resumable upload"""
+    part_path, meta_path, _ = _load_upload(upload_id, session_id)
+    part_path.unlink(missing_ok=True)
+    meta_path.unlink(missing_ok=True)
+    with _hashers_lock:
+        _hashers.pop(upload_id, None)
@@ -0,0 +1,508 @@
+# app/llm.py
+"""Process-wide Anthropic client.
+
+Every LLM call in a worker goes through one client with a tuned connection
+pool. Calls are limited by a semaphore so a burst queues briefly and then
+sheds load instead of piling up threads behind a slow upstream. 429 and 529
+responses are retried with exponential backoff and jitter within a per-request
+deadline. A circuit breaker fails fast while the upstream keeps failing.
+
+get_client() returns an object with the same messages.create() and
+messages.stream() calls as the SDK client, so callers don't change.
+get_async_client() is the awaitable equivalent used by the ASGI server.
+
+The anthropic SDK takes a few hundred milliseconds to import, so it is only
+imported when the first client is created (or by the startup prewarm, see
+app.startup), not when the app is.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from app.config import Config
+from app.metrics import LLM_LATENCY, LLM_TIME_TO_FIRST_TOKEN, record_llm_usage, timed
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_async_client = None
+_async_client_pid = None
+
+class LLMUnavailableError(Exception):
+    """Raised instead of calling the API when this worker is shedding load"""
+    retry_after = 5
+
+class LLMBusyError(LLMUnavailableError):
+    """Raised when no call slot frees up within LLM_QUEUE_TIMEOUT_SECONDS"""
+    pass
+
+class CircuitOpenError(LLMUnavailableError):
+    """Raised while the circuit breaker is open after repeated upstream failures"""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class LLMDeadlineError(TimeoutError):
+    """Raised when a call, including retries, runs past its deadline"""
+    def __init__(self, message='Claude request ran past its deadline'):
+        super().__init__(message)
+
+def _sdk():
+    """The anthropic module, imported on first use"""
+    import anthropic
+    return anthropic
+
+def _is_retryable(error):
+    return isinstance(error, _sdk().APIStatusError) and error.status_code in (429, 529)
+
+def _is_upstream_failure(error):
+    """Errors that say the upstream is degraded, as opposed to a bad request"""
+    sdk = _sdk()
+    if isinstance(error, (LLMDeadlineError, sdk.APIConnectionError, sdk.APITimeoutError)):
+        return True
+    return isinstance(error, sdk.APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+def _retry_delay(error, attempt):
+    """Exponential backoff with full jitter, but no sooner than the server's retry-after"""
+    delay = random.uniform(0, min(Config.LLM_BACKOFF_MAX_SECONDS, Config.LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+    try:
+        retry_after = float(error.response.headers.get('retry-after', 0))
+    except (AttributeError, TypeError, ValueError):
+        retry_after = 0
+    return max(delay, min(retry_after, Config.LLM_BACKOFF_MAX_SECONDS))
+
+class CircuitBreaker:
+    """Opens after consecutive upstream failures; lets one trial call through after a cool-down"""
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return 'half_open'
+            return 'open'
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self.reset_seconds - (time.monotonic() - self._opened_at)
+            if remaining > 0 or self._trial_running:
+                raise CircuitOpenError(
+                    "Claude API is unavailable after repeated failures; try again shortly",
+                    retry_after=max(1, int(remaining) + 1)
+                )
+            self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_running:
+                    print(f"LLM circuit breaker opened after {self._failures} consecutive failures")
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def record_other(self):
+        # A request error (bad input) says nothing about upstream health
+        with self._lock:
+            self._trial_running = False
+
+def _stream_usage(stream):
+    """Usage accumulated by a MessageStream so far, or None before its first event"""
+    try:
+        return stream.current_message_snapshot.usage
+    except AssertionError:
+        return None
+
+def _observe_stream(model, started, exc, stream):
+    outcome = 'success' if exc is None or isinstance(exc, (GeneratorExit, asyncio.CancelledError)) else 'error'
+    LLM_LATENCY.labels(model=model, method='stream', outcome=outcome).observe(time.perf_counter() - started)
+    if stream is not None:
+        record_llm_usage(model, _stream_usage(stream))
+
+class _Stream:
+    """MessageStream proxy that enforces the call deadline while reading"""
+
+    def __init__(self, stream, deadline, model, started):
+        self._stream = stream
+        self._deadline = deadline
+        self._model = model
+        self._started = started
+
+    @property
+    def text_stream(self):
+        first = True
+        for text in self._stream.text_stream:
+            if first:
+                LLM_TIME_TO_FIRST_TOKEN.labels(self._model).observe(time.perf_counter() - self._started)
+                first = False
+            yield text
+            if time.monotonic() > self._deadline:
+                raise LLMDeadlineError()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+class _StreamManager:
+    """Context manager matching messages.stream(); holds a call slot until the stream closes"""
+
+    def __init__(self, client, kwargs):
+        self._client = client
+        self._kwargs = kwargs
+        self._manager = None
+        self._stream = None
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        deadline = time.monotonic() + Config.LLM_REQUEST_DEADLINE_SECONDS
+        self._client._acquire()
+        try:
+            def open_stream(timeout):
+                manager = self._client.anthropic.messages.stream(timeout=timeout, **self._kwargs)
+                stream = manager.__enter__()
+                self._manager = manager
+                return stream
+            stream = self._client._call_with_retries(open_stream, deadline, record_success=False)
+        except BaseException as e:
+            self._client._release()
+            _observe_stream(self._kwargs.get('model'), self._started, e, None)
+            raise
+        self._stream = stream
+        return _Stream(stream, deadline, self._kwargs.get('model'), self._started)
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._manager is not None:
+                self._manager.__exit__(exc_type, exc, tb)
+        finally:
+            _observe_stream(self._kwargs.get('model'), self._started, exc, self._stream)
+            if exc is None or isinstance(exc, GeneratorExit):
+                self._client.breaker.record_success()
+            elif _is_upstream_failure(exc):
+                self._client.breaker.record_failure()
+            else:
+                self._client.breaker.record_other()
+            self._client._release()
+        return False
+
+class _Messages:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, **kwargs):
+        with timed(LLM_LATENCY, model=kwargs.get('model'), method='create'):
+            response = self._client.call(
+                lambda timeout: self._client.anthropic.messages.create(timeout=timeout, **kwargs)
+            )
+        record_llm_usage(kwargs.get('model'), response.usage)
+        return response
+
+    def stream(self, **kwargs):
+        return _StreamManager(self._client, kwargs)
+
+def _http_limits(max_concurrency):
+    import httpx
+    return httpx.Limits(
+        max_connections=max_concurrency + 2,
+        max_keepalive_connections=max_concurrency,
+        keepalive_expiry=Config.LLM_KEEPALIVE_SECONDS
+    )
+
+def _http_timeout():
+    import httpx
+    return httpx.Timeout(Config.LLM_READ_TIMEOUT_SECONDS, connect=Config.LLM_CONNECT_TIMEOUT_SECONDS)
+
+class _BaseClient:
+    """Breaker, retry policy and counters shared by the sync and async clients"""
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.breaker = CircuitBreaker(Config.LLM_BREAKER_FAILURES, Config.LLM_BREAKER_RESET_SECONDS)
+        self._stats_lock = threading.Lock()
+        self._stats = {'calls': 0, 'in_flight': 0, 'retries': 0, 'failures': 0, 'shed': 0}
+
+    def _bump(self, name, amount=1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def check_available(self):
+        """Raise CircuitOpenError now rather than partway through a streamed response"""
+        if self.breaker.state == 'open':
+            self.breaker.before_call()
+
+    def _before_acquire(self):
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self._bump('shed')
+            raise
+
+    def _busy(self):
+        self.breaker.record_other()
+        self._bump('shed')
+        return LLMBusyError("Too many Claude requests in progress on this worker; try again shortly")
+
+    def _acquired(self):
+        self._bump('calls')
+        self._bump('in_flight')
+
+    def _attempt_timeout(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self.breaker.record_failure()
+            self._bump('failures')
+            raise LLMDeadlineError()
+        return min(remaining, Config.LLM_READ_TIMEOUT_SECONDS)
+
+    def _retry_after(self, error, attempt, deadline):
+        """Delay before retrying a failed attempt, or None after recording the failure"""
+        if _is_retryable(error) and attempt < Config.LLM_MAX_RETRIES:
+            delay = _retry_delay(error, attempt)
+            if time.monotonic() + delay < deadline:
+                self._bump('retries')
+                print(f"Claude API returned {error.status_code}; retry {attempt + 1} in {delay:.1f}s")
+                return delay
+        if _is_upstream_failure(error):
+            self.breaker.record_failure()
+            self._bump('failures')
+        else:
+            self.breaker.record_other()
+        return None
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['breaker'] = self.breaker.state
+        stats['max_concurrency'] = self.max_concurrency
+        return stats
+
+class LLMClient(_BaseClient):
+    def __init__(self):
+        super().__init__(Config.LLM_MAX_CONCURRENCY)
+        sdk = _sdk()
+        self.anthropic = sdk.Anthropic(
+            api_key=Config.ANTHROPIC_API_KEY,
+            # Retries are ours so they respect the deadline and the breaker
+            max_retries=0,
+            http_client=sdk.DefaultHttpxClient(
+                limits=_http_limits(Config.LLM_MAX_CONCURRENCY),
+                timeout=_http_timeout()
+            )
+        )
+        self.messages = _Messages(self)
+        self._slots = threading.BoundedSemaphore(Config.LLM_MAX_CONCURRENCY)
+
+    def _acquire(self):
+        self._before_acquire()
+        if not self._slots.acquire(timeout=Config.LLM_QUEUE_TIMEOUT_SECONDS):
+            raise self._busy()
+        self._acquired()
+
+    def _release(self):
+        self._bump('in_flight', -1)
+        self._slots.release()
+
+    def _call_with_retries(self, func, deadline, record_success=True):
+        attempt = 0
+        while True:
+            timeout = self._attempt_timeout(deadline)
+            try:
+                result = func(timeout)
+            except Exception as e:
+                delay = self._retry_after(e, attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            if record_success:
+                self.breaker.record_success()
+            return result
+
+    def call(self, func):
+        """Run func(timeout) under a call slot with retries, the deadline and the breaker"""
+        deadline = time.monotonic() + Config.LLM_REQUEST_DEADLINE_SECONDS
+        self._acquire()
+        try:
+            return self._call_with_retries(func, deadline)
+        finally:
+            self._release()
+
+class _AsyncStream:
+    """AsyncMessageStream proxy that enforces the call deadline while reading"""
+
+    def __init__(self, stream, deadline, model, started):
+        self._stream = stream
+        self._deadline = deadline
+        self._model = model
+        self._started = started
+
+    @property
+    async def text_stream(self):
+        first = True
+        async for text in self._stream.text_stream:
+            if first:
+                LLM_TIME_TO_FIRST_TOKEN.labels(self._model).observe(time.perf_counter() - self._started)
+                first = False
+            yield text
+            if time.monotonic() > self._deadline:
+                raise LLMDeadlineError()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+class _AsyncStreamManager:
+    """Async context manager matching messages.stream() on the async client"""
+
+    def __init__(self, client, kwargs):
+        self._client = client
+        self._kwargs = kwargs
+        self._manager = None
+        self._stream = None
+        self._started = None
+
+    async def __aenter__(self):
+        self._started = time.perf_counter()
+        deadline = time.monotonic() + Config.LLM_REQUEST_DEADLINE_SECONDS
+        await self._client._acquire()
+        try:
+            async def open_stream(timeout):
+                manager = self._client.anthropic.messages.stream(timeout=timeout, **self._kwargs)
+                stream = await manager.__aenter__()
+                self._manager = manager
+                return stream
+            stream = await self._client._call_with_retries(open_stream, deadline, record_success=False)
+        except BaseException as e:
+            self._client._release()
+            _observe_stream(self._kwargs.get('model'), self._started, e, None)
+            raise
+        self._stream = stream
+        return _AsyncStream(stream, deadline, self._kwargs.get('model'), self._started)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if self._manager is not None:
+                await self._manager.__aexit__(exc_type, exc, tb)
+        finally:
+            _observe_stream(self._kwargs.get('model'), self._started, exc, self._stream)
+            if exc is None or isinstance(exc, (GeneratorExit, asyncio.CancelledError)):
+                self._client.breaker.record_success()
+            elif _is_upstream_failure(exc):
+                self._client.breaker.record_failure()
+            else:
+                self._client.breaker.record_other()
+            self._client._release()
+        return False
+
+class _AsyncMessages:
+    def __init__(self, client):
+        self._client = client
+
+    async def create(self, **kwargs):
+        async def request(timeout):
+            return await self._client.anthropic.messages.create(timeout=timeout, **kwargs)
+        with timed(LLM_LATENCY, model=kwargs.get('model'), method='create'):
+            response = await self._client.call(request)
+        record_llm_usage(kwargs.get('model'), response.usage)
+        return response
+
+    def stream(self, **kwargs):
+        return _AsyncStreamManager(self._client, kwargs)
+
+class AsyncLLMClient(_BaseClient):
+    """Awaitable twin of LLMClient for the ASGI server; must be used from one event loop"""
+
+    def __init__(self):
+        super().__init__(Config.ASYNC_LLM_MAX_CONCURRENCY)
+        sdk = _sdk()
+        self.anthropic = sdk.AsyncAnthropic(
+            api_key=Config.ANTHROPIC_API_KEY,
+            max_retries=0,
+            http_client=sdk.DefaultAsyncHttpxClient(
+                limits=_http_limits(Config.ASYNC_LLM_MAX_CONCURRENCY),
+                timeout=_http_timeout()
+            )
+        )
+        self.messages = _AsyncMessages(self)
+        self._slots = asyncio.Semaphore(Config.ASYNC_LLM_MAX_CONCURRENCY)
+
+    async def _acquire(self):
+        self._before_acquire()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), Config.LLM_QUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise self._busy()
+        self._acquired()
+
+    def _release(self):
+        self._bump('in_flight', -1)
+        self._slots.release()
+
+    async def _call_with_retries(self, func, deadline, record_success=True):
+        attempt = 0
+        while True:
+            timeout = self._attempt_timeout(deadline)
+            try:
+                result = await func(timeout)
+            except Exception as e:
+                delay = self._retry_after(e, attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            if record_success:
+                self.breaker.record_success()
+            return result
+
+    async def call(self, func):
+        """Await func(timeout) under a call slot with retries, the deadline and the breaker"""
+        deadline = time.monotonic() + Config.LLM_REQUEST_DEADLINE_SECONDS
+        await self._acquire()
+        try:
+            return await self._call_with_retries(func, deadline)
+        finally:
+            self._release()
+
+def get_client():
+    """Return this worker process's shared LLM client, creating it on first use"""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = LLMClient()
+            _client_pid = os.getpid()
+        return _client
+
+def get_async_client():
+    """Return this worker process's shared async LLM client; call from the event loop"""
+    global _async_client, _async_client_pid
+    if _async_client is None or _async_client_pid != os.getpid():
+        _async_client = AsyncLLMClient()
+        _async_client_pid = os.getpid()
+    return _async_client
+
+def get_llm_stats():
+    """Stats for this process's client, or None if no call has been made yet"""
+    client = _client if _client_pid == os.getpid() else None
+    stats = client.get_stats() if client is not None else None
+    if _async_client is not None and _async_client_pid == os.getpid():
+        stats = {**(stats or {}), 'async': _async_client.get_stats()}
+    return stats
@@ -0,0 +1,132 @@
+# app/metrics.py
+"""Prometheus metrics.
+
+Request latency per route, SQLite statement latency, Anthropic call latency,
+time to first token and token usage, file extraction time, uploaded image
+sizes before and after preparation, backup runs and retention.
+Served at /metrics (app/routes/metrics.py).
+
+With several worker processes each one keeps its own values, so
+scripts/start.sh sets PROMETHEUS_MULTIPROC_DIR: prometheus_client then keeps
+the values in per-process files there and /metrics adds them up across
+workers, including ones gunicorn has since recycled. The variable has to be
+set before prometheus_client is imported; without it (e.g. the Flask dev
+server) /metrics reports this process only.
+"""
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+)
+from prometheus_client import multiprocess
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route (streams: until the response starts)',
+    ['method', 'route', 'status'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+
+DB_QUERY_LATENCY = Histogram(
+    'db_query_duration_seconds', 'SQLite statement latency by operation (for SELECTs, up to the first row)',
+    ['operation'],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+)
+DB_CONNECTION_HOLD = Histogram(
+    'db_connection_hold_seconds', 'Time a pooled connection is held per get_db() block',
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+)
+
+LLM_LATENCY = Histogram(
+    'llm_request_duration_seconds', 'Anthropic call latency including queueing and retries',
+    ['model', 'method', 'outcome'],
+    buckets=(0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 240)
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    'llm_time_to_first_token_seconds', 'Time from starting a streamed call to its first text',
+    ['model'],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 60)
+)
+LLM_TOKENS = Counter(
+    'llm_tokens', 'Tokens reported in response usage',
+    ['model', 'type']
+)
+
+EXTRACTION_LATENCY = Histogram(
+    'file_extraction_duration_seconds', 'Time to extract an uploaded file (cache misses only)',
+    ['type', 'outcome'],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+IMAGE_BYTES = Counter(
+    'image_bytes', 'Uploaded image bytes as received and as stored and sent to the API',
+    ['stage']
+)
+
+BACKUP_LATENCY = Histogram(
+    'backup_duration_seconds', 'Backup run duration by result',
+    ['result'],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+BACKUP_UPLOADED_BYTES = Counter(
+    'backup_uploaded_bytes', 'Compressed chunk bytes uploaded by backups'
+)
+BACKUP_SNAPSHOT_BYTES = Gauge(
+    'backup_snapshot_bytes', 'Size of the last backed up database snapshot',
+    multiprocess_mode='mostrecent'
+)
+
+RETENTION_SESSIONS = Counter(
+    'retention_sessions', 'Sessions moved to the archive store and restored from it',
+    ['operation']
+)
+RETENTION_FREED_BYTES = Counter(
+    'retention_freed_bytes', 'Bytes returned to the filesystem by incremental vacuum'
+)
+
+_SQL_OPERATIONS = {
+    'select', 'insert', 'update', 'delete', 'replace', 'with', 'begin', 'commit', 'rollback', 'pragma', 'create'
+}
+_USAGE_FIELDS = (
+    ('input', 'input_tokens'),
+    ('output', 'output_tokens'),
+    ('cache_read', 'cache_read_input_tokens'),
+    ('cache_creation', 'cache_creation_input_tokens'),
+)
+
+def sql_operation(sql):
+    """Metric label for a SQL statement: its leading keyword"""
+    words = sql.lstrip().split(None, 1)
+    operation = words[0].lower() if words else 'other'
+    return operation if operation in _SQL_OPERATIONS else 'other'
+
+def observe_db_query(sql, seconds):
+    DB_QUERY_LATENCY.labels(sql_operation(sql)).observe(seconds)
+
+@contextmanager
+def timed(histogram, **labels):
+    """Observe the duration of the block, labelled outcome=success or outcome=error"""
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'success'
+    finally:
+        histogram.labels(outcome=outcome, **labels).observe(time.perf_counter() - started)
+
+def record_llm_usage(model, usage):
+    """Count the tokens in a response's usage"""
+    if usage is None:
+        return
+    for token_type, field in _USAGE_FIELDS:
+        count = getattr(usage, field, None)
+        if count:
+            LLM_TOKENS.labels(model, token_type).inc(count)
+
+def render():
+    """Return (body, content type) for the /metrics response"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
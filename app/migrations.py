@@ -0,0 +1,356 @@
+# app/migrations.py
+"""Versioned schema migrations.
+
+Each migration is (version, description, steps) where a step is either a SQL
+string or a callable taking the connection. Migrations run in order at startup
+and each one is applied in its own transaction, recorded in schema_version.
+Never edit a migration that has shipped; add a new one instead.
+"""
+import json
+from app.attachments import detach_content
+
+def _move_inline_attachments(conn):
+    """Move base64 images already stored inline in conversations into attachments"""
+    rows = conn.execute(
+        """SELECT id, content FROM conversations WHERE content LIKE '%"type": "base64"%'"""
+    ).fetchall()
+    for row_id, content_str in rows:
+        try:
+            content = json.loads(content_str)
+        except ValueError:
+            continue
+        content, attachments = detach_content(content)
+        if not attachments:
+            continue
+        conn.executemany(
+            'INSERT OR IGNORE INTO attachments (id, media_type, data, size) VALUES (?, ?, ?, ?)',
+            [(a_id, media_type, data, len(data)) for a_id, media_type, data in attachments]
+        )
+        conn.execute('UPDATE conversations SET content = ? WHERE id = ?', (json.dumps(content), row_id))
+
+def search_text_sql(content):
+    """SQL expression for the searchable text of a conversations.content value.
+    
+    Plain messages are indexed as they are; for JSON content only the text
+    blocks are, so base64 payloads and attachment references stay out of the
+    index. Shared by the search triggers and app.search.rebuild_search_index.
+    """
+    return f'''
+        CASE
+            WHEN NOT json_valid({content}) THEN {content}
+            WHEN json_type({content}) = 'array' THEN (
+                SELECT group_concat(json_extract(value, '$.text'), char(10))
+                FROM json_each({content})
+                WHERE json_extract(value, '$.type') = 'text'
+            )
+            WHEN json_type({content}) = 'object' THEN json_extract({content}, '$.text')
+            ELSE {content}
+        END
+    '''
+
+MIGRATIONS = [
+    (1, 'Create conversations and db_metadata tables', [
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            message_type TEXT DEFAULT 'text'
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS db_metadata (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            last_backup_hash TEXT,
+            last_backup_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+    ]),
+    (2, 'Index conversations by session for history reads and deletes', [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversations_session_created
+        ON conversations (session_id, created_at, id)
+        '''
+    ]),
+    (3, 'Track writes with a change counter for cheap backup change detection', [
+        '''
+        CREATE TABLE IF NOT EXISTS change_counter (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+        ''',
+        'INSERT OR IGNORE INTO change_counter (id, value) VALUES (1, 1)',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversations_insert_counter
+        AFTER INSERT ON conversations
+        BEGIN
+            UPDATE change_counter SET value = value + 1 WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversations_update_counter
+        AFTER UPDATE ON conversations
+        BEGIN
+            UPDATE change_counter SET value = value + 1 WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversations_delete_counter
+        AFTER DELETE ON conversations
+        BEGIN
+            UPDATE change_counter SET value = value + 1 WHERE id = 1;
+        END
+        ''',
+        # Counter value captured by the last backup; NULL for pre-counter backups
+        'ALTER TABLE db_metadata ADD COLUMN change_counter INTEGER'
+    ]),
+    (4, 'Store attachments out of line instead of as base64 in conversations.content', [
+        '''
+        CREATE TABLE IF NOT EXISTS attachments (
+            id TEXT PRIMARY KEY,
+            media_type TEXT NOT NULL,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        _move_inline_attachments
+    ]),
+    (5, 'Track the context window start and rolling summary per session', [
+        '''
+        CREATE TABLE IF NOT EXISTS context_state (
+            session_id TEXT PRIMARY KEY,
+            start_id INTEGER NOT NULL DEFAULT 0,
+            summary TEXT,
+            summary_through_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+    ]),
+    (6, 'Maintain a per-session summary table for session listings', [
+        '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            byte_size INTEGER NOT NULL DEFAULT 0,
+            first_message TIMESTAMP,
+            last_message TIMESTAMP,
+            last_message_id INTEGER
+        )
+        ''',
+        # One index per sortable column; session_id breaks ties for keyset paging
+        'CREATE INDEX IF NOT EXISTS idx_sessions_last_message ON sessions (last_message, session_id)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_first_message ON sessions (first_message, session_id)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_message_count ON sessions (message_count, session_id)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_byte_size ON sessions (byte_size, session_id)',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversations_insert_sessions
+        AFTER INSERT ON conversations
+        BEGIN
+            INSERT INTO sessions (session_id, message_count, byte_size, first_message, last_message, last_message_id)
+            VALUES (NEW.session_id, 1, length(CAST(NEW.content AS BLOB)), NEW.created_at, NEW.created_at, NEW.id)
+            ON CONFLICT(session_id) DO UPDATE SET
+                message_count = message_count + 1,
+                byte_size = byte_size + excluded.byte_size,
+                first_message = MIN(first_message, excluded.first_message),
+                last_message = MAX(last_message, excluded.last_message),
+                last_message_id = MAX(last_message_id, excluded.last_message_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversations_update_sessions
+        AFTER UPDATE OF content ON conversations
+        BEGIN
+            UPDATE sessions
+            SET byte_size = byte_size - length(CAST(OLD.content AS BLOB)) + length(CAST(NEW.content AS BLOB))
+            WHERE session_id = NEW.session_id;
+        END
+        ''',
+        # Deletes may remove the first or last message, so those are re-read
+        # through idx_conversations_session_created
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversations_delete_sessions
+        AFTER DELETE ON conversations
+        BEGIN
+            UPDATE sessions SET
+                message_count = message_count - 1,
+                byte_size = byte_size - length(CAST(OLD.content AS BLOB)),
+                first_message = (SELECT MIN(created_at) FROM conversations WHERE session_id = OLD.session_id),
+                last_message = (SELECT MAX(created_at) FROM conversations WHERE session_id = OLD.session_id),
+                last_message_id = (
+                    SELECT id FROM conversations WHERE session_id = OLD.session_id
+                    ORDER BY created_at DESC, id DESC LIMIT 1
+                )
+            WHERE session_id = OLD.session_id;
+            DELETE FROM sessions WHERE session_id = OLD.session_id AND message_count <= 0;
+        END
+        ''',
+        '''
+        INSERT OR REPLACE INTO sessions (session_id, message_count, byte_size, first_message, last_message, last_message_id)
+        SELECT session_id, COUNT(*), SUM(length(CAST(content AS BLOB))), MIN(created_at), MAX(created_at), MAX(id)
+        FROM conversations
+        GROUP BY session_id
+        '''
+    ]),
+    (7, 'Full-text index over the text of conversation messages', [
+        # Rowids are conversation ids. The extracted text is stored in the
+        # index itself, since snippets can't be built from the JSON content
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts
+        USING fts5(text, tokenize = 'porter unicode61')
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS conversations_insert_fts
+        AFTER INSERT ON conversations
+        BEGIN
+            INSERT INTO conversations_fts (rowid, text) VALUES (NEW.id, {search_text_sql('NEW.content')});
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS conversations_update_fts
+        AFTER UPDATE OF content ON conversations
+        BEGIN
+            DELETE FROM conversations_fts WHERE rowid = OLD.id;
+            INSERT INTO conversations_fts (rowid, text) VALUES (NEW.id, {search_text_sql('NEW.content')});
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversations_delete_fts
+        AFTER DELETE ON conversations
+        BEGIN
+            DELETE FROM conversations_fts WHERE rowid = OLD.id;
+        END
+        ''',
+        f'''
+        INSERT INTO conversations_fts (rowid, text)
+        SELECT id, {search_text_sql('content')} FROM conversations
+        '''
+    ]),
+    (8, 'Record sessions moved out to the archive store by retention', [
+        # restored_at stays NULL while the session's messages are only in the
+        # archive; the row is kept after a restore for the record
+        '''
+        CREATE TABLE IF NOT EXISTS archived_sessions (
+            session_id TEXT PRIMARY KEY,
+            storage_key TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            byte_size INTEGER NOT NULL,
+            first_message TIMESTAMP,
+            last_message TIMESTAMP,
+            last_message_id INTEGER,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            restored_at TIMESTAMP
+        )
+        '''
+    ]),
+    (9, 'Index large uploaded documents in chunks for retrieval', [
+        '''
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            char_count INTEGER NOT NULL,
+            chunk_count INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (session_id, content_hash)
+        )
+        ''',
+        # start is the chunk's offset in the document text; chunks overlap, so
+        # the text is rebuilt from the offsets. session_key is a token that
+        # limits an index query to one session's chunks
+        '''
+        CREATE TABLE IF NOT EXISTS document_chunks (
+            id INTEGER PRIMARY KEY,
+            document_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            session_key TEXT NOT NULL,
+            text TEXT NOT NULL,
+            UNIQUE (document_id, seq)
+        )
+        ''',
+        # External content: the index reads the text from document_chunks
+        # instead of keeping its own copy
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS document_chunks_fts
+        USING fts5(
+            text, session_key,
+            content = 'document_chunks', content_rowid = 'id',
+            tokenize = 'porter unicode61'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS document_chunks_insert_fts
+        AFTER INSERT ON document_chunks
+        BEGIN
+            INSERT INTO document_chunks_fts (rowid, text, session_key)
+            VALUES (NEW.id, NEW.text, NEW.session_key);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS document_chunks_delete_fts
+        AFTER DELETE ON document_chunks
+        BEGIN
+            INSERT INTO document_chunks_fts (document_chunks_fts, rowid, text, session_key)
+            VALUES ('delete', OLD.id, OLD.text, OLD.session_key);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS documents_delete_chunks
+        AFTER DELETE ON documents
+        BEGIN
+            DELETE FROM document_chunks WHERE document_id = OLD.id;
+        END
+        '''
+    ]),
+]
+
+def get_schema_version(conn):
+    """Return the highest applied migration version (0 for a fresh database)"""
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+def run_migrations(conn):
+    """Apply any pending migrations and return the resulting schema version"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    for version, description, steps in MIGRATIONS:
+        if version <= get_schema_version(conn):
+            continue
+
+        # BEGIN IMMEDIATE takes the write lock up front, so when several gunicorn
+        # workers start at once only one applies each migration
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if version <= get_schema_version(conn):
+                conn.rollback()
+                continue
+
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+
+            conn.execute(
+                'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                (version, description)
+            )
+            conn.commit()
+            print(f"Applied migration {version}: {description}")
+        except Exception:
+            conn.rollback()
+            raise
+
+    return get_schema_version(conn)
@@ -0,0 +1,456 @@
+# app/retention.py
+"""Retention: archiving cold sessions, attachment cleanup and incremental vacuum.
+
+Nothing else removes conversations, so without this the database, which every
+backup snapshots and every cold start downloads, only grows. A retention run
+(started by the backup leader every RETENTION_INTERVAL_SECONDS, or from
+POST /admin/retention/run):
+
+1. Moves sessions matching a retention policy (Config.RETENTION_*) to the
+   backup store under archive/, one gzipped JSON object per session holding
+   its messages, context state, attachments and indexed documents, and
+   records them in archived_sessions (migration 8). Their rows are then
+   deleted; the triggers keep sessions, the search index and the change
+   counter in step.
+2. Deletes attachments no message refers to any more.
+3. Returns free pages to the filesystem with PRAGMA incremental_vacuum, a few
+   thousand pages per step so writers are not held up. A database created
+   before this (auto_vacuum NONE) is converted by one full VACUUM first.
+
+Reopening an archived session restores it: app.database calls
+restore_session() when a session with an archive reads as empty. Messages
+come back with their original ids (conversation ids are never reused), so
+paging back by id and the context state work as before. Archive objects are
+left in the store after a restore; clearing a session's history deletes them.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import time
+from app.attachments import attachment_ids
+from app.backup_storage import BackupStorageError, get_backup_storage
+from app.config import Config
+from app.database import get_db, checkpoint_database, flush_pending_writes, forget_session_history
+from app.documents import session_key
+from app.metrics import RETENTION_FREED_BYTES, RETENTION_SESSIONS
+
+ARCHIVE_PREFIX = 'archive/'
+ARCHIVE_FORMAT = 1
+AUTO_VACUUM_INCREMENTAL = 2
+# Attachment ids per DELETE statement
+DELETE_BATCH_SIZE = 500
+
+_ATTACHMENT_REFS_SQL = '''
+    SELECT content FROM conversations
+    WHERE instr(content, '"attachment_id"') > 0
+'''
+
+def archive_key(session_id, last_message_id):
+    """Store key for a session's archive; a session archived again with new messages gets a new key"""
+    digest = hashlib.sha256(session_id.encode()).hexdigest()[:32]
+    return f'{ARCHIVE_PREFIX}{digest}/{last_message_id}.json.gz'
+
+def _referenced_attachments(rows):
+    ids = set()
+    for row in rows:
+        try:
+            ids.update(attachment_ids(json.loads(row['content'])))
+        except ValueError:
+            continue
+    return ids
+
+def _policies():
+    """(reason, SQL condition on sessions, parameters) for each enabled policy"""
+    idle = ("last_message < datetime('now', ?)", [f'-{Config.RETENTION_MIN_IDLE_HOURS} hours'])
+    policies = []
+    if Config.RETENTION_INACTIVE_DAYS > 0:
+        policies.append((
+            'inactive', "last_message < datetime('now', ?)", [f'-{Config.RETENTION_INACTIVE_DAYS} days']
+        ))
+    if Config.RETENTION_MAX_AGE_DAYS > 0:
+        policies.append((
+            'age', f"first_message < datetime('now', ?) AND {idle[0]}",
+            [f'-{Config.RETENTION_MAX_AGE_DAYS} days'] + idle[1]
+        ))
+    if Config.RETENTION_MAX_SESSION_BYTES > 0:
+        policies.append((
+            'size', f'byte_size > ? AND {idle[0]}', [Config.RETENTION_MAX_SESSION_BYTES] + idle[1]
+        ))
+    return policies
+
+def find_cold_sessions(limit):
+    """Sessions matching a retention policy, least recently used first within each policy"""
+    found = {}
+    with get_db() as conn:
+        for reason, condition, params in _policies():
+            if len(found) >= limit:
+                break
+            rows = conn.execute(f'''
+                SELECT session_id, message_count, byte_size, first_message, last_message
+                FROM sessions
+                WHERE {condition}
+                ORDER BY last_message
+                LIMIT ?
+            ''', params + [limit]).fetchall()
+            for row in rows:
+                if row['session_id'] not in found and len(found) < limit:
+                    found[row['session_id']] = dict(row, reason=reason)
+    return list(found.values())
+
+def archive_session(session_id, reason, storage):
+    """Move a session to the archive store.
+
+    Returns a summary dict, or None if the session is empty or was written to
+    while it was being archived (it is left alone and retried next run).
+    """
+    with get_db() as conn:
+        # One read transaction, so the messages match the summary row
+        conn.execute('BEGIN')
+        summary = conn.execute('''
+            SELECT message_count, byte_size, first_message, last_message, last_message_id
+            FROM sessions WHERE session_id = ?
+        ''', (session_id,)).fetchone()
+        if summary is None:
+            conn.rollback()
+            return None
+        messages = conn.execute('''
+            SELECT id, role, content, message_type, created_at
+            FROM conversations
+            WHERE session_id = ?
+            ORDER BY created_at, id
+        ''', (session_id,)).fetchall()
+        state = conn.execute('''
+            SELECT start_id, summary, summary_through_id FROM context_state WHERE session_id = ?
+        ''', (session_id,)).fetchone()
+        ids = _referenced_attachments(messages)
+        attachments = []
+        if ids:
+            placeholders = ', '.join('?' for _ in ids)
+            attachments = conn.execute(f'''
+                SELECT id, media_type, data, created_at FROM attachments WHERE id IN ({placeholders})
+            ''', list(ids)).fetchall()
+        documents = conn.execute('''
+            SELECT id, content_hash, filename, char_count, chunk_count, created_at
+            FROM documents WHERE session_id = ?
+        ''', (session_id,)).fetchall()
+        chunks = {}
+        for row in conn.execute('''
+            SELECT c.document_id, c.seq, c.start, c.text
+            FROM document_chunks c JOIN documents d ON d.id = c.document_id
+            WHERE d.session_id = ?
+            ORDER BY c.document_id, c.seq
+        ''', (session_id,)):
+            chunks.setdefault(row['document_id'], []).append([row['seq'], row['start'], row['text']])
+        conn.rollback()
+
+    archive = {
+        'format': ARCHIVE_FORMAT,
+        'session_id': session_id,
+        'reason': reason,
+        'messages': [dict(row) for row in messages],
+        'context_state': dict(state) if state else None,
+        # Kept with every session that uses them, since they may be deleted
+        # once no message in the database refers to them
+        'attachments': [
+            {
+                'id': row['id'],
+                'media_type': row['media_type'],
+                'created_at': row['created_at'],
+                'data': base64.b64encode(row['data']).decode()
+            }
+            for row in attachments
+        ],
+        'documents': [
+            {**dict(row), 'chunks': chunks.get(row['id'], [])}
+            for row in documents
+        ]
+    }
+    data = gzip.compress(json.dumps(archive).encode())
+    key = archive_key(session_id, summary['last_message_id'])
+    storage.put_bytes(key, data)
+
+    with get_db() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            current = conn.execute(
+                'SELECT message_count, last_message_id FROM sessions WHERE session_id = ?', (session_id,)
+            ).fetchone()
+            if (current is None
+                    or current['message_count'] != summary['message_count']
+                    or current['last_message_id'] != summary['last_message_id']):
+                conn.rollback()
+                return None
+            conn.execute('''
+                INSERT OR REPLACE INTO archived_sessions (
+                    session_id, storage_key, reason, message_count, byte_size,
+                    first_message, last_message, last_message_id
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                session_id, key, reason, summary['message_count'], summary['byte_size'],
+                summary['first_message'], summary['last_message'], summary['last_message_id']
+            ))
+            conn.execute('DELETE FROM conversations WHERE session_id = ?', (session_id,))
+            conn.execute('DELETE FROM context_state WHERE session_id = ?', (session_id,))
+            # Only the archived ones; a document indexed since belongs to an
+            # upload whose message isn't saved yet
+            conn.executemany('DELETE FROM documents WHERE id = ?', [(row['id'],) for row in documents])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    forget_session_history(session_id)
+    RETENTION_SESSIONS.labels('archived').inc()
+    return {
+        'session_id': session_id,
+        'reason': reason,
+        'messages': len(messages),
+        'bytes': summary['byte_size'],
+        'archive_bytes': len(data)
+    }
+
+def restore_session(session_id):
+    """Bring an archived session back into the database.
+
+    Returns the number of messages restored; 0 if the session is not archived
+    (e.g. another worker restored it first).
+    """
+    with get_db() as conn:
+        row = conn.execute(
+            'SELECT storage_key FROM archived_sessions WHERE session_id = ? AND restored_at IS NULL',
+            (session_id,)
+        ).fetchone()
+    if row is None:
+        return 0
+    storage = get_backup_storage()
+    if storage is None:
+        raise BackupStorageError('No archive store is configured')
+
+    started = time.monotonic()
+    archive = json.loads(gzip.decompress(storage.get_bytes(row['storage_key'])))
+    messages = archive['messages']
+    state = archive['context_state']
+
+    with get_db() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            current = conn.execute(
+                'SELECT storage_key FROM archived_sessions WHERE session_id = ? AND restored_at IS NULL',
+                (session_id,)
+            ).fetchone()
+            if current is None or current['storage_key'] != row['storage_key']:
+                conn.rollback()
+                return 0
+            conn.executemany('''
+                INSERT OR IGNORE INTO attachments (id, media_type, data, size, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [
+                (a['id'], a['media_type'], raw, len(raw), a['created_at'])
+                for a in archive['attachments']
+                for raw in [base64.b64decode(a['data'])]
+            ])
+            conn.executemany('''
+                INSERT OR IGNORE INTO conversations (id, session_id, role, content, message_type, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [
+                (m['id'], session_id, m['role'], m['content'], m['message_type'], m['created_at'])
+                for m in messages
+            ])
+            # Archives written before documents were indexed have none
+            for document in archive.get('documents', []):
+                if conn.execute('''
+                    INSERT OR IGNORE INTO documents (
+                        id, session_id, content_hash, filename, char_count, chunk_count, created_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    document['id'], session_id, document['content_hash'], document['filename'],
+                    document['char_count'], document['chunk_count'], document['created_at']
+                )).rowcount:
+                    conn.executemany('''
+                        INSERT INTO document_chunks (document_id, seq, start, session_key, text)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', [
+                        (document['id'], seq, start, session_key(session_id), text)
+                        for seq, start, text in document['chunks']
+                    ])
+            if state:
+                conn.execute('''
+                    INSERT OR IGNORE INTO context_state (session_id, start_id, summary, summary_through_id)
+                    VALUES (?, ?, ?, ?)
+                ''', (session_id, state['start_id'], state['summary'], state['summary_through_id']))
+            conn.execute(
+                'UPDATE archived_sessions SET restored_at = CURRENT_TIMESTAMP WHERE session_id = ?',
+                (session_id,)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    forget_session_history(session_id)
+    RETENTION_SESSIONS.labels('restored').inc()
+    print(f"Restored archived session {session_id}: {len(messages)} messages "
+          f"in {time.monotonic() - started:.2f}s")
+    return len(messages)
+
+def collect_attachments():
+    """Delete attachments no message refers to; returns (count, bytes).
+
+    The scan of conversations runs without the write lock. Messages written or
+    restored while it ran are checked again under the lock before deleting.
+    """
+    with get_db() as conn:
+        scan_started, max_id = conn.execute(
+            'SELECT CURRENT_TIMESTAMP, (SELECT MAX(id) FROM conversations)'
+        ).fetchone()
+        referenced = _referenced_attachments(conn.execute(_ATTACHMENT_REFS_SQL))
+        # Uploaded images are stored before the message that refers to them
+        # is saved, so recent ones get until the idle period to be referenced
+        candidates = [
+            row['id'] for row in conn.execute(
+                'SELECT id FROM attachments WHERE created_at < datetime(?, ?)',
+                (scan_started, f'-{Config.RETENTION_MIN_IDLE_HOURS} hours')
+            )
+            if row['id'] not in referenced
+        ]
+        if not candidates:
+            return 0, 0
+
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            referenced = _referenced_attachments(conn.execute(_ATTACHMENT_REFS_SQL + '''
+                AND (id > ? OR session_id IN (
+                    SELECT session_id FROM archived_sessions WHERE restored_at >= ?
+                ))
+            ''', (max_id or 0, scan_started)))
+            candidates = [a_id for a_id in candidates if a_id not in referenced]
+            count = freed = 0
+            for start in range(0, len(candidates), DELETE_BATCH_SIZE):
+                batch = candidates[start:start + DELETE_BATCH_SIZE]
+                placeholders = ', '.join('?' for _ in batch)
+                freed += conn.execute(
+                    f'SELECT COALESCE(SUM(size), 0) FROM attachments WHERE id IN ({placeholders})', batch
+                ).fetchone()[0]
+                count += conn.execute(f'DELETE FROM attachments WHERE id IN ({placeholders})', batch).rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return count, freed
+
+def _page_counts(conn):
+    return (
+        conn.execute('PRAGMA page_size').fetchone()[0],
+        conn.execute('PRAGMA page_count').fetchone()[0],
+        conn.execute('PRAGMA freelist_count').fetchone()[0]
+    )
+
+def vacuum_free_pages():
+    """Return the database's free pages to the filesystem; returns the bytes freed"""
+    with get_db() as conn:
+        page_size, pages_before, free_pages = _page_counts(conn)
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            # Switching modes needs a full rebuild, once; it blocks writers for
+            # its duration and needs free disk space for a copy of the database
+            print(f"Converting {Config.DATABASE_PATH} to incremental auto-vacuum")
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+
+        while free_pages:
+            # executescript steps the pragma to completion; execute() would
+            # free a single page
+            conn.executescript(f'PRAGMA incremental_vacuum({Config.VACUUM_PAGES_PER_STEP})')
+            remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if remaining >= free_pages:
+                break
+            free_pages = remaining
+        pages_after = conn.execute('PRAGMA page_count').fetchone()[0]
+
+    freed = max(0, pages_before - pages_after) * page_size
+    RETENTION_FREED_BYTES.inc(freed)
+    return freed
+
+def run_retention(dry_run=False):
+    """Run one retention pass and return a summary dict.
+
+    With dry_run the sessions that would be archived are listed and nothing
+    is changed. Runs regardless of RETENTION_ENABLED, which only controls
+    the scheduled runs.
+    """
+    started = time.monotonic()
+    flush_pending_writes()
+    candidates = find_cold_sessions(Config.RETENTION_BATCH_SESSIONS)
+    if dry_run:
+        return {
+            'result': 'dry_run',
+            'message': f'{len(candidates)} sessions would be archived',
+            'candidates': candidates
+        }
+
+    storage = get_backup_storage()
+    if storage is None:
+        return {'result': 'skipped', 'message': 'No archive store is configured'}
+
+    archived = []
+    failed = 0
+    for candidate in candidates:
+        try:
+            result = archive_session(candidate['session_id'], candidate['reason'], storage)
+        except Exception as e:
+            print(f"Could not archive session {candidate['session_id']}: {str(e)}")
+            failed += 1
+            continue
+        if result is not None:
+            archived.append(result)
+
+    attachments, attachment_bytes = collect_attachments()
+    freed = vacuum_free_pages()
+    # Fold the WAL in so the file on disk (and the next snapshot) shrinks now
+    checkpoint_database()
+
+    message = (f'Archived {len(archived)} sessions, deleted {attachments} attachments, '
+               f'freed {freed / 2**20:.1f} MB')
+    if failed:
+        message += f'; {failed} sessions failed to archive'
+    return {
+        'result': 'partial' if failed else 'success',
+        'message': message,
+        'archived_sessions': len(archived),
+        'archived_messages': sum(a['messages'] for a in archived),
+        'archived_bytes': sum(a['bytes'] for a in archived),
+        'archive_upload_bytes': sum(a['archive_bytes'] for a in archived),
+        'failed_sessions': failed,
+        'deleted_attachments': attachments,
+        'deleted_attachment_bytes': attachment_bytes,
+        'vacuumed_bytes': freed,
+        'duration_seconds': round(time.monotonic() - started, 3)
+    }
+
+def get_retention_status():
+    """Policies, archive counts and free space in the database"""
+    with get_db() as conn:
+        archived = conn.execute('''
+            SELECT COUNT(*) AS sessions, COALESCE(SUM(byte_size), 0) AS bytes
+            FROM archived_sessions WHERE restored_at IS NULL
+        ''').fetchone()
+        restored = conn.execute(
+            'SELECT COUNT(*) FROM archived_sessions WHERE restored_at IS NOT NULL'
+        ).fetchone()[0]
+        page_size, page_count, free_pages = _page_counts(conn)
+        auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    return {
+        'enabled': Config.RETENTION_ENABLED,
+        'policies': {
+            'inactive_days': Config.RETENTION_INACTIVE_DAYS,
+            'max_age_days': Config.RETENTION_MAX_AGE_DAYS,
+            'max_session_bytes': Config.RETENTION_MAX_SESSION_BYTES,
+            'min_idle_hours': Config.RETENTION_MIN_IDLE_HOURS
+        },
+        'archived_sessions': archived['sessions'],
+        'archived_bytes': archived['bytes'],
+        'restored_sessions': restored,
+        'database_bytes': page_count * page_size,
+        'free_bytes': free_pages * page_size,
+        'incremental_vacuum': auto_vacuum == AUTO_VACUUM_INCREMENTAL
+    }
@@ -1,7 +1,12 @@
 # app/routes/admin.py
-from flask import Blueprint, jsonify
-from app.database import clear_conversation_history, get_session_id, get_db
-from app.cloud_storage import upload_database, download_database, has_database_changed
+from flask import Blueprint, jsonify, request
+from app.config import Config
+from app.database import clear_conversation_history, get_session_id
+from app.database import list_sessions as list_session_summaries
+from app.cloud_storage import download_database, has_database_changed
+from app.backup_scheduler import backup_scheduler
+from app.retention import get_retention_status, restore_session
+from app.search import rebuild_search_index
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -14,32 +19,58 @@ def clear_history():
 
 @admin_bp.route('/admin/get_history', methods=['GET'])
 def get_history():
-    """Get the current conversation history"""
-    from app.database import get_conversation_history
+    """Get the current conversation history (paginated, see history_response)"""
+    from app.routes.chat import history_response
     session_id = get_session_id()
-    history = get_conversation_history(session_id)
-    return jsonify({
+    return history_response(session_id, lambda history, has_more, next_before_id: {
         'success': True,
         'history': history,
-        'count': len(history)
+        'count': len(history),
+        'has_more': has_more,
+        'next_before_id': next_before_id
     })
 
 @admin_bp.route('/admin/backup_db', methods=['POST'])
 def backup_database():
-    """Manually trigger database backup to Cloud Storage"""
+    """Trigger a database backup to Cloud Storage.
+    
+    With the background scheduler running this only queues a request (requests
+    coalesce into one backup); pass ?wait=true to wait for it to finish.
+    """
     try:
-        success = upload_database()
+        if not backup_scheduler.running:
+            # No scheduler in this process, so back up inline
+            result = backup_scheduler.run_backup('manual')
+            if result['result'] == 'success':
+                return jsonify({
+                    'success': True,
+                    'message': 'Database backed up successfully'
+                })
+            return jsonify({
+                'success': False,
+                'message': f"Database backup failed or skipped: {result['message']}"
+            }), 400
         
-        if success:
+        requested_at = backup_scheduler.request_backup()
+        if request.args.get('wait', 'false').lower() != 'true':
             return jsonify({
                 'success': True,
-                'message': 'Database backed up successfully'
-            })
-        else:
+                'message': 'Backup requested',
+                'status': backup_scheduler.get_status()
+            }), 202
+        
+        status = backup_scheduler.wait_for_backup(requested_at, Config.BACKUP_REQUEST_TIMEOUT_SECONDS)
+        if status is None:
             return jsonify({
                 'success': False,
-                'message': 'Database backup failed or skipped (no changes)'
-            }), 400
+                'message': 'Backup still pending',
+                'status': backup_scheduler.get_status()
+            }), 504
+        return jsonify({
+            'success': status.get('last_result') in ('success', 'skipped'),
+            'message': status.get('last_message'),
+            'status': status
+        }), 200 if status.get('last_result') in ('success', 'skipped') else 400
             
     except Exception as e:
         return jsonify({
@@ -47,6 +78,16 @@ def backup_database():
             'error': str(e)
         }), 500
 
+@admin_bp.route('/admin/backup_status', methods=['GET'])
+def backup_status():
+    """Progress and outcome of the current and last backups"""
+    return jsonify({
+        'success': True,
+        'scheduler_running': backup_scheduler.running,
+        'is_leader': backup_scheduler.is_leader,
+        'status': backup_scheduler.get_status()
+    })
+
 @admin_bp.route('/admin/restore_db', methods=['POST'])
 def restore_database():
     """Manually restore database from Cloud Storage"""
@@ -64,8 +105,8 @@ def restore_database():
         else:
             return jsonify({
                 'success': False,
-                'message': 'Database restore failed'
-            }), 400
+                'message': 'No backup found to restore'
+            }), 404
             
     except Exception as e:
         return jsonify({
@@ -75,49 +116,131 @@ def restore_database():
 
 @admin_bp.route('/admin/sessions', methods=['GET'])
 def list_sessions():
-    """List all active sessions"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT session_id, COUNT(*) as message_count, 
-                   MIN(created_at) as first_message,
-                   MAX(created_at) as last_message
-            FROM conversations
-            GROUP BY session_id
-            ORDER BY last_message DESC
-        ''')
-        sessions = cursor.fetchall()
+    """List sessions a page at a time.
+    
+    Query parameters: sort (last_message, first_message, message_count or
+    byte_size), order (asc or desc), limit and cursor (next_cursor from the
+    previous page).
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), Config.SESSIONS_PAGE_MAX)
+        sessions, next_cursor = list_session_summaries(
+            sort=request.args.get('sort', 'last_message'),
+            descending=request.args.get('order', 'desc').lower() != 'asc',
+            limit=limit,
+            cursor=request.args.get('cursor')
+        )
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
     
     return jsonify({
         'success': True,
-        'sessions': [dict(session) for session in sessions]
+        'sessions': sessions,
+        'next_cursor': next_cursor
+    })
+
+@admin_bp.route('/admin/search', methods=['GET'])
+def search():
+    """Search all sessions, or one with ?session_id="""
+    from app.routes.chat import search_response
+    return search_response(request.args.get('session_id'))
+
+@admin_bp.route('/admin/search/rebuild', methods=['POST'])
+def rebuild_search():
+    """Rebuild the full-text index, e.g. after restoring an old database by hand"""
+    try:
+        count = rebuild_search_index()
+        return jsonify({
+            'success': True,
+            'message': f'Search index rebuilt ({count} messages)'
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@admin_bp.route('/admin/retention', methods=['GET'])
+def retention_status():
+    """Retention policies, archived sessions, free space and the last run"""
+    try:
+        return jsonify({
+            'success': True,
+            'retention': get_retention_status(),
+            'last_run': backup_scheduler.get_status().get('retention')
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@admin_bp.route('/admin/retention/run', methods=['POST'])
+def run_retention():
+    """Archive cold sessions, delete unreferenced attachments and vacuum now.
+    
+    Pass ?dry_run=true to list the sessions that would be archived. Runs even
+    with RETENTION_ENABLED off, which only controls the scheduled runs.
+    """
+    dry_run = request.args.get('dry_run', 'false').lower() == 'true'
+    result = backup_scheduler.run_retention('manual', dry_run=dry_run)
+    success = result['result'] in ('success', 'dry_run', 'skipped')
+    return jsonify({
+        'success': success,
+        'message': result['message'],
+        'result': result
+    }), 200 if success else 500
+
+@admin_bp.route('/admin/archive/restore', methods=['POST'])
+def restore_archived_session():
+    """Restore an archived session now instead of when it is next opened"""
+    data = request.get_json(silent=True) or {}
+    session_id = data.get('session_id') or request.args.get('session_id')
+    if not session_id:
+        return jsonify({
+            'success': False,
+            'error': 'session_id is required'
+        }), 400
+    
+    try:
+        count = restore_session(session_id)
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+    if not count:
+        return jsonify({
+            'success': False,
+            'message': 'Session is not archived'
+        }), 404
+    return jsonify({
+        'success': True,
+        'message': f'Restored {count} messages'
     })
 
 @admin_bp.route('/admin/db_status', methods=['GET'])
 def db_status():
     """Check database status and backup information"""
     try:
-        from app.cloud_storage import get_database_hash
-        
-        with get_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT last_backup_hash, last_backup_timestamp 
-                FROM db_metadata 
-                ORDER BY id DESC 
-                LIMIT 1
-            ''')
-            backup_info = cursor.fetchone()
+        from app.cloud_storage import get_last_backup_info
+        from app.database import get_change_counter
         
-        current_hash = get_database_hash()
-        changed = has_database_changed()
+        # Cheap enough to poll: no file hashing, just two single-row reads
+        backup_info = get_last_backup_info()
+        change_counter = get_change_counter()
         
         return jsonify({
             'success': True,
-            'current_hash': current_hash,
+            'change_counter': change_counter,
+            'last_backup_change_counter': backup_info['change_counter'] if backup_info else None,
             'last_backup_hash': backup_info['last_backup_hash'] if backup_info else None,
             'last_backup_timestamp': backup_info['last_backup_timestamp'] if backup_info else None,
-            'has_changes': changed
+            'has_changes': has_database_changed(),
+            'backup': backup_scheduler.get_status()
         })
         
     except Exception as e:
@@ -1,33 +1,24 @@
 # app/routes/chat.py
-from flask import Blueprint, request, jsonify
-from anthropic import Anthropic
+from flask import Blueprint, request, jsonify, make_response
 from app.config import Config
-from app.database import get_session_id, save_message_to_db, get_conversation_history
-import requests
+from app.context import build_context
+from app.database import (
+    get_session_id, save_turn, get_history_page, get_message_count, get_history_version, summarize_message
+)
+from app.search import search_messages
+from app.github_client import get_github_client
+from app.llm import get_client, LLMUnavailableError
+from app.streaming import stream_claude_response
 import base64
-import os
+import hashlib
 
 chat_bp = Blueprint('chat', __name__)
-client = Anthropic(api_key=Config.ANTHROPIC_API_KEY)
 
-def handle_github_command(message):
-    """Handle GitHub-specific commands"""
-    token = os.environ.get('GITHUB_TOKEN')
-    if not token:
-        return None
-    
-    headers = {
-        'Authorization': f'token {token}',
-        'Accept': 'application/vnd.github.v3+json'
-    }
-    
+def parse_github_command(message):
+    """Recognise a GitHub command: ('repos',), ('file', repo_name, filename) or None"""
     # Simple command parsing
     if "list my repos" in message.lower():
-        response = requests.get('https://api.github.com/user/repos', headers=headers)
-        if response.status_code == 200:
-            repos = response.json()
-            repo_list = "\n".join([f"- {repo['name']}: {repo['description'] or 'No description'}" for repo in repos[:10]])
-            return f"Here are your recent repositories:\n{repo_list}"
+        return ('repos',)
     
     elif "show file" in message.lower():
         # Try to extract repo and file path
@@ -37,30 +28,57 @@ def handle_github_command(message):
             try:
                 file_idx = parts.index("file") + 1
                 from_idx = parts.index("from")
-                repo_idx = parts.index("repo")
                 
                 filename = parts[file_idx]
                 repo_name = parts[from_idx + 1]
-                
-                url = f'https://api.github.com/repos/scottstef/{repo_name}/contents/{filename}'
-                response = requests.get(url, headers=headers)
-                
-                if response.status_code == 200:
-                    file_data = response.json()
-                    content = base64.b64decode(file_data['content']).decode('utf-8')
-                    return f"File: {filename} from {repo_name}\n\n```{content}```"
+                return ('file', repo_name, filename)
             except:
                 pass
     
     return None
 
-SYSTEM_MESSAGE = """You are a helpful assistant that analyzes files and answers questions. 
+def format_github_result(command, data):
+    if command[0] == 'repos':
+        repo_list = "\n".join([f"- {repo['name']}: {repo['description'] or 'No description'}" for repo in data[:10]])
+        return f"Here are your recent repositories:\n{repo_list}"
+    
+    _, repo_name, filename = command
+    content = base64.b64decode(data['content']).decode('utf-8')
+    return f"File: {filename} from {repo_name}\n\n```{content}```"
+
+def handle_github_command(message):
+    """Handle GitHub-specific commands"""
+    github = get_github_client()
+    command = parse_github_command(message)
+    if not github.configured or command is None:
+        return None
+    
+    try:
+        if command[0] == 'repos':
+            data = github.list_repos()
+        else:
+            data = github.get_file('scottstef', command[1], command[2])
+        return format_github_result(command, data)
+    except Exception as e:
+        print(f"GitHub command failed: {str(e)}")
+        return None
 
-IMPORTANT: When you provide code modifications or updates, ALWAYS:
-1. Comment where you make changes with markers like "# NEW", "# CHANGED", or "# UPDATED"
-2. If the change is substantial, include a brief comment explaining what was changed
-3. Make it easy for the user to spot the differences from the original code
-"""
+async def handle_github_command_async(message):
+    """handle_github_command() for the ASGI server"""
+    github = get_github_client()
+    command = parse_github_command(message)
+    if not github.configured or command is None:
+        return None
+    
+    try:
+        if command[0] == 'repos':
+            data = await github.alist_repos()
+        else:
+            data = await github.aget_file('scottstef', command[1], command[2])
+        return format_github_result(command, data)
+    except Exception as e:
+        print(f"GitHub command failed: {str(e)}")
+        return None
 
 @chat_bp.route('/chat', methods=['POST'])
 def chat():
@@ -82,29 +100,22 @@ def chat():
         
         print(f"Received message: {message}")
         
-        # Get history from database
-        messages = get_conversation_history(session_id)
-        
-        user_message = {
-            "role": "user",
-            "content": message
-        }
-        messages.append(user_message)
+        # History packed into the token budget, plus the new message
+        system, messages = build_context(session_id, message)
         
         # Create the API request
-        response = client.messages.create(
+        response = get_client().messages.create(
             model="claude-3-7-sonnet-20250219",
             max_tokens=4096,
-            system=SYSTEM_MESSAGE,
+            system=system,
             messages=messages
         )
         
         # Save to database
-        save_message_to_db(session_id, 'user', message)
-        save_message_to_db(session_id, 'assistant', response.content[0].text)
+        save_turn(session_id, message, response.content[0].text)
         
-        # Update count for response
-        history_count = len(get_conversation_history(session_id))
+        # Messages stored for the session, not just the ones sent this turn
+        history_count = get_message_count(session_id)
         
         print(f"Response received successfully")
         
@@ -113,12 +124,106 @@ def chat():
             'conversation_length': history_count
         })
         
+    except LLMUnavailableError as e:
+        # Shedding load; the client should retry later
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         print(f"Error in chat endpoint: {str(e)}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@chat_bp.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Chat endpoint that streams the reply as Server-Sent Events"""
+    data = request.get_json()
+    message = data.get('message', '')
+    session_id = get_session_id()
+    
+    if not message:
+        return jsonify({'error': 'No message provided'}), 400
+    
+    try:
+        # Check for GitHub commands
+        github_response = handle_github_command(message)
+        if github_response:
+            message = f"{github_response}\n\nUser's question: {message}"
+        
+        # History packed into the token budget, plus the new message
+        system, messages = build_context(session_id, message)
+        
+        return stream_claude_response(get_client(), session_id, messages, message, system)
+        
+    except LLMUnavailableError as e:
+        # Shedding load; the client should retry later
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        print(f"Error in chat stream endpoint: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+def history_response(session_id, build_payload):
+    """One page of a session's history as JSON, with ETag / 304 support.
+    
+    Query parameters: before_id (the oldest message id the client already
+    has), limit, and summary=true for role, type and length instead of
+    content. build_payload(history, has_more, next_before_id) returns the
+    endpoint's JSON body.
+    """
+    try:
+        before_id = request.args.get('before_id')
+        before_id = int(before_id) if before_id else None
+        limit = min(max(int(request.args.get('limit', 50)), 1), Config.HISTORY_PAGE_MAX)
+    except ValueError:
+        return jsonify({'error': 'before_id and limit must be integers'}), 400
+    summary = request.args.get('summary', 'false').lower() == 'true'
+    
+    # Checked before any history is read, so an unchanged history costs at
+    # most one primary-key lookup
+    etag = None
+    version = get_history_version(session_id)
+    if version is not None:
+        session_hash = hashlib.sha256(session_id.encode()).hexdigest()[:12]
+        etag = f'{session_hash}.{version}'
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+    
+    rows, has_more = get_history_page(session_id, before_id, limit)
+    if summary:
+        history = [summarize_message(row) for row in rows]
+    else:
+        history = [{'role': row['role'], 'content': row['content']} for row in rows]
+    next_before_id = rows[0]['id'] if has_more else None
+    
+    response = jsonify(build_payload(history, has_more, next_before_id))
+    if etag:
+        response.set_etag(etag, weak=True)
+    # Browsers revalidate on every load and get a 304 while nothing changed
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def search_response(session_id=None):
+    """Run a search from the q, limit and offset query parameters"""
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), Config.SEARCH_PAGE_MAX)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        results = search_messages(request.args.get('q', ''), session_id, limit, offset)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    return jsonify({
+        'success': True,
+        'results': results,
+        'count': len(results)
+    })
+
 @chat_bp.route('/get_history', methods=['GET'])
 def get_chat_history():
     """Endpoint to retrieve conversation history for the current session"""
@@ -126,16 +231,20 @@ def get_chat_history():
         # Get the current session ID
         session_id = get_session_id()
         
-        # Retrieve history from database
-        history = get_conversation_history(session_id)
-        
-        return jsonify({
+        return history_response(session_id, lambda history, has_more, next_before_id: {
             'history': history,
-            'conversation_length': len(history)
+            'conversation_length': get_message_count(session_id),
+            'has_more': has_more,
+            'next_before_id': next_before_id
         })
         
     except Exception as e:
         print(f"Error in get_history endpoint: {str(e)}")
         import traceback
         traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@chat_bp.route('/search', methods=['GET'])
+def search_history():
+    """Search the current session's history (?q=, limit, offset)"""
+    return search_response(get_session_id())
@@ -1,25 +1,17 @@
 # app/routes/github.py
 from flask import Blueprint, request, jsonify
-import requests
-import os
+from app.github_client import get_github_client, GitHubError
 import base64
 
 github_bp = Blueprint('github', __name__)
 
-def get_github_headers():
-    """Get headers for GitHub API requests"""
-    token = os.environ.get('GITHUB_TOKEN')
-    return {
-        'Authorization': f'token {token}',
-        'Accept': 'application/vnd.github.v3+json'
-    }
-
 @github_bp.route('/github/repos', methods=['GET'])
 def list_repos():
     """List user's GitHub repositories"""
-    headers = get_github_headers()
-    response = requests.get('https://api.github.com/user/repos', headers=headers)
-    return jsonify(response.json())
+    try:
+        return jsonify(get_github_client().list_repos())
+    except GitHubError as e:
+        return jsonify({'error': str(e), 'status': e.status}), e.status or 502
 
 @github_bp.route('/github/file', methods=['POST'])
 def get_file_content():
@@ -29,20 +21,17 @@ def get_file_content():
     repo = data.get('repo')
     path = data.get('path')
     
-    headers = get_github_headers()
-    url = f'https://api.github.com/repos/{owner}/{repo}/contents/{path}'
-    response = requests.get(url, headers=headers)
-    
-    if response.status_code == 200:
-        file_data = response.json()
-        # Decode base64 content
-        content = base64.b64decode(file_data['content']).decode('utf-8')
-        return jsonify({
-            'content': content,
-            'path': path,
-            'repo': repo,
-            'size': file_data.get('size'),
-            'url': file_data.get('html_url')
-        })
+    try:
+        file_data = get_github_client().get_file(owner, repo, path)
+    except GitHubError as e:
+        return jsonify({'error': 'File not found', 'status': e.status}), 404
     
-    return jsonify({'error': 'File not found', 'status': response.status_code}), 404
\ No newline at end of file
+    # Decode base64 content
+    content = base64.b64decode(file_data['content']).decode('utf-8')
+    return jsonify({
+        'content': content,
+        'path': path,
+        'repo': repo,
+        'size': file_data.get('size'),
+        'url': file_data.get('html_url')
+    })
@@ -1,23 +1,50 @@
 # app/routes/health.py
 from flask import Blueprint, jsonify
-from app.database import get_db
+from app.database import get_db, get_pool_stats, history_cache, write_queue
 from app.config import Config
+from app.llm import get_client, get_llm_stats
+from app.startup import get_startup_report, init_failed, is_ready
 
 health_bp = Blueprint('health', __name__)
 
 @health_bp.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint for container monitoring"""
+    """Health check endpoint for container monitoring.
+    
+    Answers 200 while the worker is still starting (status 'starting', ready
+    false) so it counts as live; use /health/ready to wait for readiness.
+    """
+    if not is_ready():
+        return jsonify({
+            'status': 'starting',
+            'live': True,
+            'ready': False,
+            'startup': get_startup_report()
+        }), 200
+    
+    if init_failed():
+        return jsonify({
+            'status': 'unhealthy',
+            'error': get_startup_report()['error']
+        }), 500
+    
     try:
-        # Test database connection
+        # Test database connection (reuses this thread's pooled connection)
         with get_db() as conn:
             conn.execute('SELECT 1')
         
         return jsonify({
             'status': 'healthy',
+            'live': True,
+            'ready': True,
             'database': 'connected',
+            'database_pool': get_pool_stats(),
+            'history_cache': history_cache.stats(),
+            'write_behind': write_queue.get_stats() if Config.DB_WRITE_BEHIND else None,
+            'llm': get_llm_stats(),
             'uploads_dir': Config.UPLOADS_DIR.exists(),
-            'data_dir': Config.DATA_DIR.exists()
+            'data_dir': Config.DATA_DIR.exists(),
+            'startup': get_startup_report()
         }), 200
     except Exception as e:
         return jsonify({
@@ -25,15 +52,30 @@ def health_check():
             'error': str(e)
         }), 500
 
+@health_bp.route('/health/live', methods=['GET'])
+def liveness():
+    """Liveness probe: the worker is up and answering, ready or not"""
+    return jsonify({'status': 'live'}), 200
+
+@health_bp.route('/health/ready', methods=['GET'])
+def readiness():
+    """Readiness probe: 503 until the database is restored and migrated, and for good if that failed"""
+    if not is_ready():
+        return jsonify({'status': 'starting', 'startup': get_startup_report()}), 503
+    if init_failed():
+        return jsonify({'status': 'failed', 'startup': get_startup_report()}), 503
+    try:
+        with get_db() as conn:
+            conn.execute('SELECT 1')
+    except Exception as e:
+        return jsonify({'status': 'unhealthy', 'error': str(e)}), 503
+    return jsonify({'status': 'ready'}), 200
+
 @health_bp.route('/test', methods=['GET'])
 def test():
     """Test route to verify the API is working"""
-    from anthropic import Anthropic
-    from app.config import Config
-    
     try:
-        client = Anthropic(api_key=Config.ANTHROPIC_API_KEY)
-        response = client.messages.create(
+        response = get_client().messages.create(
             model="claude-3-7-sonnet-20250219",
             max_tokens=50,
             messages=[{
@@ -0,0 +1,27 @@
+# app/routes/metrics.py
+import time
+from flask import Blueprint, Response, g, request
+from app.metrics import REQUEST_LATENCY, render
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.before_app_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@metrics_bp.after_app_request
+def record_request(response):
+    """Observe request latency, labelled by route pattern to keep label values bounded"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.labels(request.method, route, response.status_code).observe(
+            time.perf_counter() - started
+        )
+    return response
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, summed across this server's worker processes"""
+    body, content_type = render()
+    return Response(body, content_type=content_type)
@@ -1,108 +1,217 @@
 # app/routes/upload.py
 from flask import Blueprint, request, jsonify
-from anthropic import Anthropic
-from app.config import Config
-from app.database import get_session_id, save_message_to_db, get_conversation_history
+from app.context import build_context
+from app.database import get_message_count, get_session_id, save_turn
+from app.documents import get_document, index_document, list_documents, should_index
+from app.llm import get_client, LLMUnavailableError
 from app.file_handler import allowed_file, save_uploaded_file, encode_file_for_claude
+from app.ingest import (
+    UploadError, abort_upload, append_upload, check_file_type, create_upload, finish_upload, get_upload
+)
+from app.streaming import stream_claude_response
 
 upload_bp = Blueprint('upload', __name__)
-client = Anthropic(api_key=Config.ANTHROPIC_API_KEY)
 
-SYSTEM_MESSAGE = """You are a helpful assistant that analyzes files and answers questions. 
+INVALID_FILE_TYPE = 'Invalid file type. Supported types include: txt, pdf, docx, doc, images, etc.'
 
-IMPORTANT: When you provide code modifications or updates, ALWAYS:
-1. Comment where you make changes with markers like "# NEW", "# CHANGED", or "# UPDATED"
-2. If the change is substantial, include a brief comment explaining what was changed
-3. Make it easy for the user to spot the differences from the original code
-"""
+def _upload_error_response(error):
+    return jsonify({'error': str(error), **error.details}), error.status
 
-@upload_bp.route('/upload', methods=['POST'])
-def upload_file():
-    # Get message from request and session ID
+def prepare_upload_content():
+    """Save and encode the uploaded file and build the user message content.
+    
+    The file is either in the request or, with an upload_id field, a finished
+    resumable upload. Returns (user_content, filename, has_file,
+    error_response); error_response is a ready-to-return response when the
+    upload is invalid.
+    """
+    # Get message from request
     message = request.form.get('message', '')
-    session_id = get_session_id()
+    upload_id = request.form.get('upload_id', '')
     
     # Make file upload optional
     file_content = None
     filename = None
+    upload = None
     
-    if 'file' in request.files and request.files['file'].filename != '':
-        file = request.files['file']
-        
-        if allowed_file(file.filename):
-            filename, filepath = save_uploaded_file(file)
+    try:
+        if upload_id:
+            upload = finish_upload(upload_id, get_session_id())
+        elif 'file' in request.files and request.files['file'].filename != '':
+            file = request.files['file']
+            if not allowed_file(file.filename):
+                return None, None, False, (jsonify({'error': INVALID_FILE_TYPE}), 400)
+            upload = save_uploaded_file(file)
+        if upload:
+            filename = upload.filename
+            check_file_type(upload)
+    except UploadError as e:
+        return None, filename, False, _upload_error_response(e)
+    
+    if upload:
+        try:
+            print(f"Processing file: {filename}")
+            
+            file_content = encode_file_for_claude(upload.path, upload.content_hash, upload.media_type)
+            if should_index(file_content):
+                # Indexed for retrieval; the message keeps a reference to it
+                file_content = index_document(get_session_id(), filename, upload.content_hash, file_content['text'])
             
-            try:
-                print(f"Processing file: {filename}")
-                
-                file_content = encode_file_for_claude(filepath)
-                
-            except Exception as e:
-                print(f"Error processing file: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                return jsonify({'error': f'Error processing file: {str(e)}'}), 500
-        else:
-            return jsonify({'error': 'Invalid file type. Supported types include: txt, pdf, docx, doc, images, etc.'}), 400
+        except Exception as e:
+            print(f"Error processing file: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return None, filename, False, (jsonify({'error': f'Error processing file: {str(e)}'}), 500)
     
     if not message and not file_content:
-        return jsonify({'error': 'Please provide either a message or a file'}), 400
+        return None, filename, False, (jsonify({'error': 'Please provide either a message or a file'}), 400)
+    
+    # Build content array based on what's provided
+    content = []
+    
+    if message:
+        content.append({
+            "type": "text",
+            "text": message
+        })
+    
+    if file_content:
+        content.append(file_content)
+    
+    if not file_content and message and ("file" in message.lower() or "analyze" in message.lower()):
+        content.append({
+            "type": "text",
+            "text": "Note: No file was uploaded for analysis."
+        })
+    
+    user_content = content if len(content) > 1 else message
+    return user_content, filename, file_content is not None, None
+
+@upload_bp.route('/upload', methods=['POST'])
+def upload_file():
+    # Get session ID and build the user message
+    session_id = get_session_id()
+    user_content, filename, has_file, error_response = prepare_upload_content()
+    if error_response:
+        return error_response
     
     try:
-        # Build content array based on what's provided
-        content = []
-        
-        if message:
-            content.append({
-                "type": "text",
-                "text": message
-            })
-        
-        if file_content:
-            content.append(file_content)
-        
-        if not file_content and message and ("file" in message.lower() or "analyze" in message.lower()):
-            content.append({
-                "type": "text",
-                "text": "Note: No file was uploaded for analysis."
-            })
-        
-        # Get history from database
-        messages = get_conversation_history(session_id)
-        
-        user_message = {
-            "role": "user",
-            "content": content if len(content) > 1 else message
-        }
-        messages.append(user_message)
+        # History packed into the token budget, plus the new message
+        system, messages = build_context(session_id, user_content)
         
         # Send to Claude
-        response = client.messages.create(
+        response = get_client().messages.create(
             model="claude-3-7-sonnet-20250219",
             max_tokens=4096,
-            system=SYSTEM_MESSAGE,
+            system=system,
             messages=messages
         )
         
         # Save to database
-        save_message_to_db(session_id, 'user', content if len(content) > 1 else message)
-        save_message_to_db(session_id, 'assistant', response.content[0].text)
+        save_turn(session_id, user_content, response.content[0].text)
         
-        # Update count for response
-        history_count = len(get_conversation_history(session_id))
+        # Messages stored for the session, not just the ones sent this turn
+        history_count = get_message_count(session_id)
         
         response_data = {
             'success': True,
             'analysis': response.content[0].text,
             'filename': filename if filename else None,
-            'has_file': file_content is not None,
+            'has_file': has_file,
             'conversation_length': history_count
         }
         
         return jsonify(response_data)
         
+    except LLMUnavailableError as e:
+        # Shedding load; the client should retry later
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         print(f"Error in upload route: {str(e)}")
         import traceback
         traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@upload_bp.route('/upload/stream', methods=['POST'])
+def upload_file_stream():
+    """Upload endpoint that streams the analysis as Server-Sent Events"""
+    session_id = get_session_id()
+    user_content, filename, has_file, error_response = prepare_upload_content()
+    if error_response:
+        return error_response
+    
+    try:
+        # History packed into the token budget, plus the new message
+        system, messages = build_context(session_id, user_content)
+        
+        return stream_claude_response(
+            get_client(), session_id, messages, user_content, system,
+            start_data={'filename': filename, 'has_file': has_file}
+        )
+        
+    except LLMUnavailableError as e:
+        # Shedding load; the client should retry later
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        print(f"Error in upload stream route: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@upload_bp.route('/uploads', methods=['POST'])
+def create_resumable_upload():
+    """Start a resumable upload of {"filename", "size"}; send it with PATCH /uploads/<id>"""
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename') or ''
+    if not allowed_file(filename):
+        return jsonify({'error': INVALID_FILE_TYPE}), 400
+    
+    try:
+        upload = create_upload(get_session_id(), filename, data.get('size'))
+    except UploadError as e:
+        return _upload_error_response(e)
+    return jsonify(upload), 201, {'Location': f"/uploads/{upload['upload_id']}"}
+
+@upload_bp.route('/uploads/<upload_id>', methods=['GET'])
+def resumable_upload_status(upload_id):
+    """How much of an upload has arrived; resume by sending from its offset"""
+    try:
+        upload = get_upload(upload_id, get_session_id())
+    except UploadError as e:
+        return _upload_error_response(e)
+    return jsonify(upload), 200, {'Upload-Offset': str(upload['offset'])}
+
+@upload_bp.route('/uploads/<upload_id>', methods=['PATCH'])
+def append_resumable_upload(upload_id):
+    """Append the request body to an upload at the Upload-Offset header (or ?offset=)"""
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset')))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Upload-Offset header is required'}), 400
+    
+    try:
+        upload = append_upload(upload_id, get_session_id(), offset, request.stream)
+    except UploadError as e:
+        return _upload_error_response(e)
+    return jsonify(upload), 200, {'Upload-Offset': str(upload['offset'])}
+
+@upload_bp.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_resumable_upload(upload_id):
+    try:
+        abort_upload(upload_id, get_session_id())
+    except UploadError as e:
+        return _upload_error_response(e)
+    return jsonify({'success': True})
+
+@upload_bp.route('/documents', methods=['GET'])
+def get_documents():
+    """Documents indexed for retrieval in this session"""
+    return jsonify({'documents': list_documents(get_session_id())})
+
+@upload_bp.route('/documents/<int:document_id>', methods=['GET'])
+def get_document_text(document_id):
+    """A document's full text; turns only send Claude the parts matching the message"""
+    document = get_document(get_session_id(), document_id)
+    if document is None:
+        return jsonify({'error': 'Document not found'}), 404
+    return jsonify(document)
@@ -0,0 +1,104 @@
+# app/search.py
+"""Full-text search over conversation history.
+
+conversations_fts (migration 7) holds the text of every message and is kept
+in sync by triggers on conversations, so searching costs an FTS5 index lookup
+instead of a scan of the content column. Results are ranked with BM25 and
+carry a snippet around the matched terms: the message text, HTML-escaped, with
+the terms wrapped in <mark>.
+
+A database restored from a backup taken before migration 7 is indexed when
+the migration runs; rebuild_search_index() re-creates the index from scratch
+if it is ever out of step with conversations (scripts/rebuild_search_index.sh
+or POST /admin/search/rebuild).
+"""
+import html
+import time
+from app.database import get_db, flush_pending_writes
+from app.migrations import search_text_sql
+
+SNIPPET_START = '<mark>'
+SNIPPET_END = '</mark>'
+SNIPPET_TOKENS = 16
+# snippet() marks matches with these noncharacters, which become the tags
+# above once the message text around them has been escaped
+_MATCH_START = '\ufdd0'
+_MATCH_END = '\ufdd1'
+
+def build_match_query(query):
+    """Turn user input into an FTS5 query: every term must match, a trailing * matches a prefix.
+
+    Terms are quoted so FTS5 operators and punctuation in the input are
+    searched for literally instead of raising syntax errors.
+    """
+    terms = []
+    for term in query.split():
+        prefix = term.endswith('*') and len(term) > 1
+        term = term.rstrip('*')
+        if not term:
+            continue
+        quoted = '"' + term.replace('"', '""') + '"'
+        terms.append(quoted + '*' if prefix else quoted)
+    if not terms:
+        raise ValueError('Search query is empty')
+    return ' '.join(terms)
+
+def _snippet_html(snippet):
+    escaped = html.escape(snippet or '')
+    return escaped.replace(_MATCH_START, SNIPPET_START).replace(_MATCH_END, SNIPPET_END)
+
+def search_messages(query, session_id=None, limit=20, offset=0):
+    """Return messages matching query, best match first.
+
+    Each result has id, session_id, role, created_at, snippet and score
+    (BM25; lower is better); snippet is HTML. Pass session_id to search a single session.
+    """
+    match = build_match_query(query)
+    where = 'conversations_fts MATCH ?'
+    params = [match]
+    if session_id is not None:
+        where += ' AND c.session_id = ?'
+        params.append(session_id)
+
+    # Messages queued for write-behind aren't in the index until committed
+    flush_pending_writes()
+    with get_db() as conn:
+        rows = conn.execute(f'''
+            SELECT c.id, c.session_id, c.role, c.created_at,
+                   snippet(conversations_fts, 0, ?, ?, '...', ?) AS snippet,
+                   bm25(conversations_fts) AS score
+            FROM conversations_fts
+            JOIN conversations c ON c.id = conversations_fts.rowid
+            WHERE {where}
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+        ''', [_MATCH_START, _MATCH_END, SNIPPET_TOKENS] + params + [limit, offset]).fetchall()
+    return [{**dict(row), 'snippet': _snippet_html(row['snippet'])} for row in rows]
+
+def rebuild_search_index():
+    """Re-create the full-text index from conversations; returns the number of messages indexed"""
+    flush_pending_writes()
+    started = time.monotonic()
+    with get_db() as conn:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # Dropping and re-creating the table is much faster than deleting
+            # every row; the triggers refer to it by name so they keep working
+            create_sql = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'conversations_fts'"
+            ).fetchone()[0]
+            conn.execute('DROP TABLE conversations_fts')
+            conn.execute(create_sql)
+            conn.execute(f'''
+                INSERT INTO conversations_fts (rowid, text)
+                SELECT id, {search_text_sql('content')} FROM conversations
+            ''')
+            count = conn.execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+            # Merge the index into a single b-tree for the fastest queries
+            conn.execute("INSERT INTO conversations_fts (conversations_fts) VALUES ('optimize')")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    print(f"Search index rebuilt: {count} messages in {time.monotonic() - started:.1f}s")
+    return count
@@ -0,0 +1,237 @@
+# app/startup.py
+"""Worker startup: database restore, readiness and the startup timing report.
+
+The app package imports this module first, so its clock starts before Flask
+and the rest of the app are imported.
+
+With STARTUP_RESTORE=background (scripts/start.sh's default) the server binds
+its port straight away. Each worker then, in a background thread, restores the
+database from the backup store (the first worker to take restore.lock
+downloads it; the others wait and reuse it), runs migrations and starts the
+backup scheduler. If the restore still fails after its retries the worker
+serves a fresh database without the scheduler, so the backup is left intact. Until that is done the worker is live but not ready:
+/health/live answers, /health/ready returns 503, and requests that need the
+database wait up to STARTUP_READY_TIMEOUT_SECONDS and then get a 503. The
+index page, static files, /health and /metrics don't wait. If migrations fail
+the worker never becomes ready: it answers those requests and /health/ready
+with a 503. In the other modes the same steps run inline in create_app(), and
+a failure there stops the worker from booting.
+
+Heavy dependencies (the Anthropic SDK, requests) are imported on first use.
+Once ready, a worker imports them and creates its LLM client in the
+background (STARTUP_PREWARM), so the first chat doesn't pay for that either.
+
+Every step is timed; the report is printed when the worker becomes ready and
+returned by /health.
+"""
+import fcntl
+import os
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from app.config import Config
+
+_started = time.perf_counter()
+_phases = {}
+_ready = threading.Event()
+_ready_after = None
+_ready_at = None
+_error = None
+_init_failed = False
+
+# Endpoints served before the worker is ready; none of them touch the database
+READY_EXEMPT_ENDPOINTS = {'index', 'static', 'metrics.metrics'}
+READY_EXEMPT_BLUEPRINTS = {'health'}
+
+def since_start():
+    """Seconds since this worker started importing the app"""
+    return time.perf_counter() - _started
+
+def record(phase, seconds):
+    _phases[phase] = round(seconds, 3)
+
+@contextmanager
+def timed_phase(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - started)
+
+def _container_started_at():
+    """When scripts/start.sh started (STARTUP_STARTED_AT), or None when not run by it"""
+    try:
+        return float(os.environ['STARTUP_STARTED_AT'])
+    except (KeyError, ValueError):
+        return None
+
+def is_ready():
+    return _ready.is_set()
+
+def init_failed():
+    """Whether the database couldn't be initialized (background mode); the worker then never serves"""
+    return _init_failed
+
+def wait_until_ready(timeout):
+    return _ready.wait(timeout)
+
+def get_startup_report():
+    """Startup phases and durations for this worker, in seconds"""
+    container_started = _container_started_at()
+    return {
+        'pid': os.getpid(),
+        'mode': Config.STARTUP_RESTORE,
+        'ready': is_ready() and not init_failed(),
+        'ready_after_seconds': _ready_after,
+        'ready_after_container_start_seconds': (
+            round(_ready_at - container_started, 3)
+            if _ready_at is not None and container_started is not None else None
+        ),
+        'phases': dict(_phases),
+        'error': _error
+    }
+
+def _format_report(report):
+    phases = ', '.join(f'{name} {seconds:.3f}s' for name, seconds in report['phases'].items())
+    line = f"Startup report (pid {report['pid']}, {report['mode']}): {phases}; ready after {report['ready_after_seconds']:.3f}s"
+    if report['ready_after_container_start_seconds'] is not None:
+        line += f" ({report['ready_after_container_start_seconds']:.3f}s after container start)"
+    return line
+
+def _restore_database():
+    """Restore the database once per server start; returns True if a backup was restored.
+
+    Workers start together, so the first one to take restore.lock downloads
+    the database and the others wait for it. restore.done records which start
+    (STARTUP_STARTED_AT) it was done for, so recycled workers don't restore it
+    again over newer writes. It is only written once the backup was restored
+    or there was none: a failed restore is retried STARTUP_RESTORE_ATTEMPTS
+    times, then recorded in restore.failed and raised, so no worker of this
+    start backs up the fresh database over the real backup.
+    """
+    from app.cloud_storage import RestoreError, download_database
+
+    start_id = os.environ.get('STARTUP_STARTED_AT', '')
+    done_path = Config.DATA_DIR / 'restore.done'
+    failed_path = Config.DATA_DIR / 'restore.failed'
+    fd = os.open(Config.DATA_DIR / 'restore.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if done_path.read_text() == start_id:
+                return False
+        except FileNotFoundError:
+            pass
+        try:
+            # Another worker of this start already gave up; don't repeat its retries
+            if start_id and failed_path.read_text() == start_id:
+                raise RestoreError('the database restore failed in another worker')
+        except FileNotFoundError:
+            pass
+
+        delay = Config.STARTUP_RESTORE_RETRY_SECONDS
+        for attempt in range(1, Config.STARTUP_RESTORE_ATTEMPTS + 1):
+            try:
+                restored = download_database()
+                break
+            except RestoreError as e:
+                if attempt == Config.STARTUP_RESTORE_ATTEMPTS:
+                    failed_path.write_text(start_id)
+                    raise
+                print(f"Database restore attempt {attempt} failed ({str(e)}); retrying in {delay}s")
+                time.sleep(delay)
+                delay *= 2
+        done_path.write_text(start_id)
+        return restored
+    finally:
+        os.close(fd)
+
+def _prewarm():
+    """Import the heavy client libraries and create this worker's clients ahead of the first request"""
+    try:
+        with timed_phase('prewarm'):
+            import anthropic  # noqa: F401
+            import requests  # noqa: F401
+            from app.llm import get_client
+            get_client()
+    except Exception as e:
+        print(f"Startup prewarm failed: {str(e)}")
+
+def _initialize():
+    """Restore (in background mode), migrate and start the backup scheduler, then become ready.
+
+    Run inline, a failed init_db() is raised so the worker fails to boot. In
+    background mode it is recorded instead and the worker answers 503.
+    """
+    global _ready_after, _ready_at, _error, _init_failed
+    from app.backup_scheduler import start_backup_scheduler
+    from app.database import init_db
+
+    restore_failed = False
+    if Config.STARTUP_RESTORE == 'background':
+        try:
+            with timed_phase('restore'):
+                _restore_database()
+        except Exception as e:
+            # Serve from a fresh database, as a failed start.sh restore used to
+            traceback.print_exc()
+            _error = f'Database restore failed: {str(e)}'
+            restore_failed = True
+
+    try:
+        with timed_phase('init_db'):
+            init_db()
+    except Exception as e:
+        if Config.STARTUP_RESTORE != 'background':
+            raise
+        traceback.print_exc()
+        _error = f'Database initialization failed: {str(e)}'
+        _init_failed = True
+    else:
+        try:
+            # Only after the restore, so a backup never replaces the stored
+            # database with a fresh, empty one
+            if restore_failed:
+                print("Backup scheduler not started: the database restore failed")
+            else:
+                with timed_phase('backup_scheduler'):
+                    start_backup_scheduler()
+        except Exception as e:
+            traceback.print_exc()
+            _error = str(e)
+
+    _ready_after = round(since_start(), 3)
+    _ready_at = time.time()
+    _ready.set()
+    print(_format_report(get_startup_report()))
+
+    if Config.STARTUP_PREWARM and not _init_failed:
+        threading.Thread(target=_prewarm, name='startup-prewarm', daemon=True).start()
+
+def start():
+    """Run the startup steps for this worker: in a background thread in background mode, else inline"""
+    if Config.STARTUP_RESTORE == 'background':
+        threading.Thread(target=_initialize, name='startup', daemon=True).start()
+    else:
+        _initialize()
+
+def readiness_gate():
+    """Flask before_request hook: hold requests that need the database until the worker is ready"""
+    from flask import jsonify, request
+
+    if is_ready() and not init_failed():
+        return None
+    if request.endpoint in READY_EXEMPT_ENDPOINTS or request.blueprint in READY_EXEMPT_BLUEPRINTS:
+        return None
+    if wait_until_ready(Config.STARTUP_READY_TIMEOUT_SECONDS) and not init_failed():
+        return None
+    if init_failed():
+        return jsonify({
+            'success': False,
+            'error': 'The server failed to start; try again later'
+        }), 503
+    return jsonify({
+        'success': False,
+        'error': 'The server is still starting; try again shortly'
+    }), 503, {'Retry-After': '5'}
@@ -0,0 +1,67 @@
+# app/streaming.py
+import json
+from flask import Response, stream_with_context
+from app.database import get_message_count, save_turn
+
+# The API rejects a conversation holding an empty (or whitespace) assistant
+# message, so a reply without text is reported and never saved
+EMPTY_REPLY_ERROR = 'Claude returned an empty reply; please try again'
+
+def sse_event(event, data):
+    """Format a single Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_claude_response(client, session_id, messages, user_content, system, start_data=None):
+    """Stream a Claude reply to the browser as SSE and persist the turn when the stream closes"""
+    # Fail with a 503 now rather than as an error event after the response has started
+    client.check_available()
+    
+    def generate():
+        chunks = []
+        saved = False
+        try:
+            with client.messages.stream(
+                model="claude-3-7-sonnet-20250219",
+                max_tokens=4096,
+                system=system,
+                messages=messages
+            ) as stream:
+                yield sse_event('start', start_data or {})
+                for text in stream.text_stream:
+                    chunks.append(text)
+                    yield sse_event('delta', {'text': text})
+
+            reply = ''.join(chunks)
+            if not reply.strip():
+                yield sse_event('error', {'error': EMPTY_REPLY_ERROR})
+                return
+
+            # Save before telling the client we're done so a follow-up request sees the turn
+            save_turn(session_id, user_content, reply)
+            saved = True
+
+            yield sse_event('done', {'conversation_length': get_message_count(session_id)})
+
+        except GeneratorExit:
+            # Client disconnected; the finally block keeps whatever was generated
+            print(f"Client disconnected from stream for session {session_id}")
+            raise
+        except Exception as e:
+            print(f"Error while streaming response: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            yield sse_event('error', {'error': str(e)})
+        finally:
+            # Only persist a turn with some reply; a lone user message would break
+            # the alternating role order the API requires
+            if not saved and ''.join(chunks).strip():
+                save_turn(session_id, user_content, ''.join(chunks))
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
@@ -0,0 +1,110 @@
+# app/write_behind.py
+import os
+import queue
+import threading
+import time
+import traceback
+
+class WriteBehindQueue:
+    """Collect writes and commit them in batches from a background thread.
+
+    flush_func(batch) receives a list of queued items and is expected to write
+    them all in a single transaction. Items that still fail after a few
+    retries are logged and dropped, so this is only for data where a small
+    window of loss on a crash is acceptable. done_func(batch, written), if
+    given, is called after every batch; written is False if it was dropped.
+    """
+
+    def __init__(self, flush_func, done_func=None, max_batch=100, max_delay=0.05, retries=3):
+        self.flush_func = flush_func
+        self.done_func = done_func
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retries = retries
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.stats = {
+            'queued': 0,
+            'written': 0,
+            'dropped': 0,
+            'batches': 0,
+            'largest_batch': 0
+        }
+
+    def _ensure_thread(self):
+        # Threads don't survive fork, so each worker process starts its own writer
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+
+    def put(self, item):
+        """Queue an item for the next group commit"""
+        self._ensure_thread()
+        with self._lock:
+            self.stats['queued'] += 1
+        self._queue.put(item)
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            written = False
+            try:
+                for attempt in range(self.retries):
+                    try:
+                        self.flush_func(batch)
+                        with self._lock:
+                            self.stats['written'] += len(batch)
+                            self.stats['batches'] += 1
+                            self.stats['largest_batch'] = max(self.stats['largest_batch'], len(batch))
+                        written = True
+                        break
+                    except Exception as e:
+                        print(f"Write-behind flush failed (attempt {attempt + 1}): {str(e)}")
+                        traceback.print_exc()
+                        time.sleep(0.1 * (2 ** attempt))
+                else:
+                    print(f"Dropping {len(batch)} queued writes after {self.retries} failed attempts")
+                    with self._lock:
+                        self.stats['dropped'] += len(batch)
+            finally:
+                if self.done_func is not None:
+                    self.done_func(batch, written)
+                for _ in batch:
+                    self._queue.task_done()
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far has been written; False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['pending'] = self.pending()
+        return stats
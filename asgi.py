@@ -0,0 +1,5 @@
+# asgi.py
+from app.asgi import create_asgi_app
+
+# ASGI entry point, e.g. `uvicorn asgi:app`; run.py is the WSGI equivalent
+app = create_asgi_app()
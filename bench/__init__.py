@@ -0,0 +1,14 @@
+# bench/__init__.py
+"""Offline load tests and benchmarks.
+
+    python -m bench --scenario mixed
+    python -m bench --scenario chat --server asgi --save-baseline chat-asgi
+    DB_WRITE_BEHIND=true python -m bench --scenario chat --compare chat-asgi
+
+Starts the app on a local port with stub Anthropic and GitHub servers (see
+bench/stubs.py), runs a scenario from bench/scenarios.py and prints latency
+percentiles and throughput per endpoint, database growth and worker RSS.
+Baselines are saved to bench/baselines/; --compare exits non-zero when a
+run regresses against one. Needs Linux (worker RSS is read from /proc) and
+no network access.
+"""
@@ -0,0 +1,70 @@
+# bench/__main__.py
+import argparse
+import json
+import sys
+from bench.report import compare, format_report, load_baseline, save_baseline
+from bench.runner import run_benchmark
+from bench.scenarios import SCENARIOS
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Run an offline benchmark scenario')
+    parser.add_argument('--scenario', default='mixed', choices=sorted(SCENARIOS))
+    parser.add_argument('--server', default='wsgi', choices=['wsgi', 'asgi'], help='as SERVER_MODE in start.sh')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=2, help='gunicorn threads per worker')
+    parser.add_argument('--users', type=int, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, help='measured seconds')
+    parser.add_argument('--warmup', type=float, help='unmeasured seconds before that')
+    parser.add_argument('--seed-sessions', type=int, help='sessions of history inserted before the run')
+    parser.add_argument('--seed-messages', type=int, help='messages per seeded session')
+    parser.add_argument('--llm-first-token', type=float, help='stub time to first token (s)')
+    parser.add_argument('--llm-tokens-per-second', type=float, help='stub output rate')
+    parser.add_argument('--llm-output-tokens', type=int, help='stub tokens per reply')
+    parser.add_argument('--github-latency', type=float, help='stub GitHub latency (s)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the workload')
+    parser.add_argument('--save-baseline', metavar='NAME', help='save the report as bench/baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='compare with bench/baselines/NAME.json')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change that counts as a regression')
+    parser.add_argument('--json', metavar='PATH', help='also write the report to PATH')
+    parser.add_argument('--keep-data', action='store_true', help="keep the server's data dir and log")
+    return parser.parse_args(argv)
+
+def build_scenario(args):
+    scenario = {**SCENARIOS[args.scenario]}
+    scenario['llm'] = {**scenario['llm']}
+    scenario['github'] = {**scenario['github']}
+    for option, key in (('users', 'users'), ('duration', 'duration'), ('warmup', 'warmup'),
+                        ('seed_sessions', 'seed_sessions'), ('seed_messages', 'seed_messages')):
+        if getattr(args, option) is not None:
+            scenario[key] = getattr(args, option)
+    for option, key in (('llm_first_token', 'first_token_seconds'), ('llm_tokens_per_second', 'tokens_per_second'),
+                        ('llm_output_tokens', 'output_tokens')):
+        if getattr(args, option) is not None:
+            scenario['llm'][key] = getattr(args, option)
+    if args.github_latency is not None:
+        scenario['github']['latency_seconds'] = args.github_latency
+    return scenario
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    report = run_benchmark(
+        args.scenario, build_scenario(args), args.server, args.workers, args.threads, args.seed, args.keep_data
+    )
+    print()
+    print(format_report(report))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        print(f'\nSaved baseline to {save_baseline(report, args.save_baseline)}')
+
+    regressed = False
+    if args.compare:
+        lines, regressed = compare(report, load_baseline(args.compare), args.threshold)
+        print()
+        print('\n'.join(lines))
+    return 1 if regressed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
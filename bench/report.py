@@ -0,0 +1,142 @@
+# bench/report.py
+"""Benchmark results: summaries, text reports and baselines.
+
+A report is a JSON-serializable dict. Baselines are reports saved under
+bench/baselines/<name>.json; compare() flags latency percentiles and
+throughput that moved the wrong way by more than a threshold.
+"""
+import json
+import math
+from pathlib import Path
+
+BASELINE_DIR = Path(__file__).resolve().parent / 'baselines'
+
+def percentile(values, q):
+    """q-th percentile (0-100) of values, interpolating between ranks"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+def summarize_samples(samples, elapsed):
+    """Per-endpoint stats from (label, seconds, first_byte_seconds, status, error) samples"""
+    by_label = {}
+    for sample in samples:
+        by_label.setdefault(sample[0], []).append(sample)
+
+    endpoints = {}
+    for label, rows in sorted(by_label.items()):
+        latencies = [row[1] for row in rows]
+        first_bytes = [row[2] for row in rows if row[2] is not None]
+        statuses = {}
+        for row in rows:
+            key = row[4] or str(row[3])
+            statuses[key] = statuses.get(key, 0) + 1
+        stats = {
+            'count': len(rows),
+            'errors': sum(1 for row in rows if row[4] or row[3] >= 400),
+            'rps': round(len(rows) / elapsed, 2),
+            'mean_ms': _ms(sum(latencies) / len(latencies)),
+            'p50_ms': _ms(percentile(latencies, 50)),
+            'p95_ms': _ms(percentile(latencies, 95)),
+            'p99_ms': _ms(percentile(latencies, 99)),
+            'max_ms': _ms(max(latencies)),
+            'statuses': statuses,
+        }
+        if first_bytes:
+            stats['first_byte_p50_ms'] = _ms(percentile(first_bytes, 50))
+            stats['first_byte_p95_ms'] = _ms(percentile(first_bytes, 95))
+        endpoints[label] = stats
+    return endpoints
+
+def format_report(report):
+    lines = [
+        f"Scenario {report['scenario']} ({report['settings']['server']}, "
+        f"{report['settings']['workers']} workers, {report['settings']['users']} users, "
+        f"{report['elapsed_seconds']:.0f}s measured)",
+        f"Requests: {report['requests']}  errors: {report['errors']}  throughput: {report['rps']} req/s",
+        '',
+        f"{'endpoint':<28}{'count':>7}{'err':>6}{'req/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'ttfb50':>9}",
+    ]
+    for label, stats in report['endpoints'].items():
+        lines.append(
+            f"{label:<28}{stats['count']:>7}{stats['errors']:>6}{stats['rps']:>8}"
+            f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}"
+            f"{stats.get('first_byte_p50_ms', ''):>9}"
+        )
+    database = report['database']
+    lines += [
+        '',
+        'Latencies in ms. ttfb50: median time to the first byte of streamed responses.',
+        f"Database: {database['start_bytes'] / 2**20:.1f} MB -> {database['end_bytes'] / 2**20:.1f} MB "
+        f"(+{database['growth_bytes'] / 2**20:.1f} MB); uploads dir +{report['uploads_growth_bytes'] / 2**20:.1f} MB",
+        'Worker RSS (MB): ' + ', '.join(
+            f"{pid}: max {worker['rss_max_mb']}, end {worker['rss_end_mb']}"
+            for pid, worker in report['workers'].items()
+        ),
+    ]
+    return '\n'.join(lines)
+
+def baseline_path(name):
+    return BASELINE_DIR / f'{name}.json'
+
+def save_baseline(report, name):
+    path = baseline_path(name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return path
+
+def load_baseline(name):
+    with open(baseline_path(name)) as f:
+        return json.load(f)
+
+def _change(new, old):
+    if new is None or old in (None, 0):
+        return None
+    return (new - old) / old
+
+def compare(report, baseline, threshold=0.2):
+    """Return (lines, regressed) comparing report with baseline.
+
+    Latency percentiles more than threshold higher, or throughput more than
+    threshold lower, count as regressions.
+    """
+    lines = [f"Compared with baseline {baseline['scenario']} taken {baseline['started_at']}:"]
+    if report['settings'] != baseline['settings']:
+        lines.append('  warning: settings differ from the baseline; numbers may not be comparable')
+    regressed = False
+
+    def check(label, metric, new, old, higher_is_worse=True):
+        nonlocal regressed
+        change = _change(new, old)
+        if change is None:
+            return
+        worse = change > threshold if higher_is_worse else change < -threshold
+        if worse:
+            regressed = True
+        if worse or abs(change) > threshold:
+            marker = 'REGRESSION' if worse else 'improved'
+            lines.append(f"  {label} {metric}: {old} -> {new} ({change:+.0%}) {marker}")
+
+    check('overall', 'req/s', report['rps'], baseline['rps'], higher_is_worse=False)
+    for label, stats in report['endpoints'].items():
+        old = baseline['endpoints'].get(label)
+        if old is None:
+            lines.append(f"  {label}: not in baseline")
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            check(label, metric, stats[metric], old[metric])
+        if stats['errors'] > old['errors']:
+            lines.append(f"  {label} errors: {old['errors']} -> {stats['errors']}")
+    check('database', 'growth', report['database']['growth_bytes'], baseline['database']['growth_bytes'])
+    check('workers', 'max RSS MB', report['rss_max_mb'], baseline['rss_max_mb'])
+
+    if len(lines) == 1:
+        lines.append(f'  no changes beyond {threshold:.0%}')
+    return lines, regressed
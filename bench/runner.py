@@ -0,0 +1,336 @@
+# bench/runner.py
+"""Runs a benchmark scenario against a local server.
+
+The app is started the way scripts/start.sh starts it (gunicorn gthread
+workers, or uvicorn for SERVER_MODE=asgi) in a temporary APP_BASE_DIR, with
+the Anthropic and GitHub stubs as its upstreams. The database is seeded with
+history, then virtual users (threads, each with its own cookie session) run
+the scenario's action mix as fast as responses come back. RSS of every
+worker process is sampled while they run. Environment variables set by the
+caller (DB_WRITE_BEHIND, HISTORY_CACHE_VALIDATE, ...) are passed through to
+the server, so the same scenario can compare configurations.
+"""
+import os
+import random
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import requests
+from bench.report import summarize_samples
+from bench.stubs import GitHubSettings, LLMSettings, start_stub_anthropic, start_stub_github
+from bench.workload import WORDS, assistant_message, chat_message, next_action, upload_file
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+STARTUP_TIMEOUT_SECONDS = 60
+REQUEST_TIMEOUT_SECONDS = 300
+RSS_SAMPLE_SECONDS = 0.5
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _child_pids(parent_pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name is parenthesized and may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent_pid:
+            children.append(int(entry))
+    return children
+
+def _dir_size(path, pattern='*'):
+    return sum(p.stat().st_size for p in Path(path).rglob(pattern) if p.is_file())
+
+class AppServer:
+    """The app in a child process, bound to a free local port"""
+
+    def __init__(self, base_dir, mode='wsgi', workers=2, threads=2, env=None):
+        self.base_dir = Path(base_dir)
+        self.mode = mode
+        self.workers = workers
+        self.threads = threads
+        self.env = env or {}
+        self.port = _free_port()
+        self.process = None
+        self.log_path = self.base_dir / 'server.log'
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def command(self):
+        if self.mode == 'asgi':
+            return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(self.port),
+                    '--workers', str(self.workers), '--timeout-keep-alive', '5', '--log-level', 'warning']
+        return [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{self.port}',
+                '--workers', str(self.workers), '--threads', str(self.threads), '--worker-class', 'gthread',
+                '--timeout', '300', '--log-level', 'warning', 'run:app']
+
+    def start(self):
+        (self.base_dir / 'metrics').mkdir(parents=True, exist_ok=True)
+        env = {
+            **os.environ,
+            'APP_BASE_DIR': str(self.base_dir),
+            'PROMETHEUS_MULTIPROC_DIR': str(self.base_dir / 'metrics'),
+            'BACKUP_SCHEDULER_ENABLED': 'false',
+            **self.env,
+        }
+        self.log = open(self.log_path, 'w')
+        self.process = subprocess.Popen(
+            self.command(), cwd=REPO_ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT
+        )
+
+        deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Server exited during startup; see {self.log_path}')
+            try:
+                if requests.get(f'{self.url}/health', timeout=2).status_code == 200:
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f'Server did not become healthy within {STARTUP_TIMEOUT_SECONDS}s; see {self.log_path}')
+
+    def worker_pids(self):
+        if self.mode == 'asgi' and self.workers == 1:
+            # uvicorn serves from the main process; its children are extraction pools
+            return [self.process.pid]
+        return _child_pids(self.process.pid) or [self.process.pid]
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+
+class ResourceSampler(threading.Thread):
+    """Samples RSS of the server's worker processes until stopped"""
+
+    def __init__(self, server):
+        super().__init__(daemon=True)
+        self.server = server
+        self.workers = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(RSS_SAMPLE_SECONDS):
+            self.sample()
+
+    def sample(self):
+        for pid in self.server.worker_pids():
+            rss = _rss_bytes(pid)
+            if rss is None:
+                continue
+            worker = self.workers.setdefault(pid, {'max': 0, 'end': 0})
+            worker['max'] = max(worker['max'], rss)
+            worker['end'] = rss
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+def seed_history(db_path, sessions, messages, rng):
+    """Insert past conversations directly; the schema's triggers keep the summaries and search index current"""
+    now = datetime.now(timezone.utc)
+    with sqlite3.connect(db_path) as conn:
+        for s in range(sessions):
+            session_id = f'seed-{s:06d}'
+            started = now - timedelta(days=rng.uniform(0, 30))
+            rows = []
+            for m in range(messages):
+                role = 'user' if m % 2 == 0 else 'assistant'
+                content = chat_message(rng) if role == 'user' else assistant_message(rng)
+                created_at = (started + timedelta(seconds=30 * m)).strftime('%Y-%m-%d %H:%M:%S')
+                rows.append((session_id, role, content, created_at))
+            conn.executemany(
+                'INSERT INTO conversations (session_id, role, content, created_at) VALUES (?, ?, ?, ?)', rows
+            )
+
+class VirtualUser:
+    """One browser: a cookie session sending the scenario's action mix"""
+
+    def __init__(self, index, base_url, scenario, uploads, seed):
+        self.rng = random.Random(seed * 1000 + index)
+        self.base_url = base_url
+        self.scenario = scenario
+        self.uploads = uploads
+        self.http = requests.Session()
+        self.history_etag = None
+
+    def request(self, action):
+        """Return (label, method, path, kwargs) for an action"""
+        rng = self.rng
+        if action in ('chat', 'chat_stream'):
+            path = '/chat' if action == 'chat' else '/chat/stream'
+            return f'POST {path}', 'POST', path, {'json': {'message': chat_message(rng)}}
+        if action == 'github':
+            message = rng.choice(['list my repos', f'show file app.py from repo-{rng.randint(0, 20)} repo'])
+            return 'POST /chat (github)', 'POST', '/chat', {'json': {'message': message}}
+        if action in ('upload', 'upload_stream'):
+            path = '/upload' if action == 'upload' else '/upload/stream'
+            filename, data, mimetype = rng.choice(self.uploads)
+            return f'POST {path}', 'POST', path, {
+                'data': {'message': 'Please review this file'},
+                'files': {'file': (filename, data, mimetype)}
+            }
+        if action == 'history':
+            # Revalidate like the browser does
+            headers = {'If-None-Match': self.history_etag} if self.history_etag else {}
+            return 'GET /get_history', 'GET', '/get_history', {'headers': headers}
+        if action == 'search':
+            return 'GET /search', 'GET', f'/search?q={rng.choice(WORDS)}', {}
+        if action == 'admin_sessions':
+            sort = rng.choice(['last_message', 'message_count', 'byte_size'])
+            return 'GET /admin/sessions', 'GET', f'/admin/sessions?sort={sort}&limit=50', {}
+        if action == 'admin_history':
+            return 'GET /admin/get_history', 'GET', '/admin/get_history?summary=true', {}
+        if action == 'admin_db_status':
+            return 'GET /admin/db_status', 'GET', '/admin/db_status', {}
+        raise ValueError(f'Unknown action {action}')
+
+    def run(self, measure_from, deadline, samples, lock):
+        while time.monotonic() < deadline:
+            label, method, path, kwargs = self.request(next_action(self.rng, self.scenario['actions']))
+            streamed = path.endswith('/stream')
+            started = time.monotonic()
+            first_byte = None
+            status = None
+            error = None
+            try:
+                response = self.http.request(
+                    method, self.base_url + path, stream=streamed, timeout=REQUEST_TIMEOUT_SECONDS, **kwargs
+                )
+                if streamed:
+                    for _ in response.iter_content(None):
+                        if first_byte is None:
+                            first_byte = time.monotonic() - started
+                else:
+                    response.content
+                status = response.status_code
+                if label == 'GET /get_history' and response.headers.get('ETag'):
+                    self.history_etag = response.headers['ETag']
+            except requests.RequestException as e:
+                error = type(e).__name__
+            if started >= measure_from:
+                with lock:
+                    samples.append((label, time.monotonic() - started, first_byte, status, error))
+
+def run_benchmark(scenario_name, scenario, server_mode='wsgi', workers=2, threads=2, seed=1, keep_data=False):
+    """Run a scenario and return its report dict"""
+    rng = random.Random(seed)
+    base_dir = Path(tempfile.mkdtemp(prefix='bench-'))
+    llm = start_stub_anthropic(LLMSettings(**scenario['llm']))
+    github = start_stub_github(GitHubSettings(**scenario['github']))
+    server = AppServer(base_dir, server_mode, workers, threads, env={
+        'ANTHROPIC_API_KEY': 'bench',
+        'ANTHROPIC_BASE_URL': llm.url,
+        'GITHUB_API_URL': github.url,
+        'GITHUB_TOKEN': 'bench',
+    })
+
+    try:
+        print(f'Generating {scenario["upload_pool"]} upload files...')
+        uploads = [upload_file(rng, scenario['uploads'], i) for i in range(scenario['upload_pool'])]
+
+        print(f'Starting {server_mode} server in {base_dir}...')
+        server.start()
+        db_path = base_dir / 'data' / 'chat_history.db'
+        print(f'Seeding {scenario["seed_sessions"]} sessions of {scenario["seed_messages"]} messages...')
+        seed_history(db_path, scenario['seed_sessions'], scenario['seed_messages'], rng)
+        start_bytes = _dir_size(base_dir / 'data', 'chat_history.db*')
+        start_uploads = _dir_size(base_dir / 'uploads')
+
+        sampler = ResourceSampler(server)
+        sampler.start()
+        samples = []
+        lock = threading.Lock()
+        started_at = datetime.now(timezone.utc)
+        measure_from = time.monotonic() + scenario['warmup']
+        deadline = measure_from + scenario['duration']
+        users = [
+            VirtualUser(i, server.url, scenario, uploads, seed)
+            for i in range(scenario['users'])
+        ]
+        print(f'Running {len(users)} users for {scenario["warmup"]}s warm-up + {scenario["duration"]}s...')
+        user_threads = [
+            threading.Thread(target=user.run, args=(measure_from, deadline, samples, lock), daemon=True)
+            for user in users
+        ]
+        for thread in user_threads:
+            thread.start()
+        for thread in user_threads:
+            thread.join()
+        # In-flight requests finish after the deadline; count the time they took
+        elapsed = max(time.monotonic(), deadline) - measure_from
+        sampler.stop()
+
+        end_bytes = _dir_size(base_dir / 'data', 'chat_history.db*')
+        workers_report = {
+            str(pid): {'rss_max_mb': round(w['max'] / 2**20, 1), 'rss_end_mb': round(w['end'] / 2**20, 1)}
+            for pid, w in sorted(sampler.workers.items())
+        }
+        errors = sum(1 for s in samples if s[4] or s[3] >= 400)
+        return {
+            'scenario': scenario_name,
+            'started_at': started_at.isoformat(timespec='seconds'),
+            'settings': {
+                'server': server_mode,
+                'workers': workers,
+                'threads': threads,
+                'seed': seed,
+                **scenario,
+            },
+            'elapsed_seconds': round(elapsed, 1),
+            'requests': len(samples),
+            'errors': errors,
+            'rps': round(len(samples) / elapsed, 2),
+            'endpoints': summarize_samples(samples, elapsed),
+            'database': {
+                'start_bytes': start_bytes,
+                'end_bytes': end_bytes,
+                'growth_bytes': end_bytes - start_bytes,
+            },
+            'uploads_growth_bytes': _dir_size(base_dir / 'uploads') - start_uploads,
+            'workers': workers_report,
+            'rss_max_mb': max((w['rss_max_mb'] for w in workers_report.values()), default=0),
+        }
+    finally:
+        server.stop()
+        llm.stop()
+        github.stop()
+        if keep_data:
+            print(f'Kept server data and log in {base_dir}')
+        else:
+            shutil.rmtree(base_dir, ignore_errors=True)
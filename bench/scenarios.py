@@ -0,0 +1,77 @@
+# bench/scenarios.py
+"""Named benchmark scenarios.
+
+Each scenario sets the load (virtual users, duration, warm-up), the history
+seeded before the run, the action and upload mixes and the stub upstream
+latencies. Command line options override any of them; baselines record the
+settings they were taken with.
+"""
+from bench.workload import DEFAULT_ACTIONS, DEFAULT_UPLOADS
+
+SCENARIOS = {
+    # A quick check that everything starts and every endpoint answers
+    'smoke': {
+        'users': 4,
+        'duration': 15,
+        'warmup': 2,
+        'seed_sessions': 20,
+        'seed_messages': 20,
+        'upload_pool': 8,
+        'actions': DEFAULT_ACTIONS,
+        'uploads': DEFAULT_UPLOADS,
+        'llm': {'first_token_seconds': 0.2, 'tokens_per_second': 400, 'output_tokens': 100},
+        'github': {'latency_seconds': 0.02},
+    },
+    # Production-like traffic against a database with some history in it
+    'mixed': {
+        'users': 20,
+        'duration': 60,
+        'warmup': 5,
+        'seed_sessions': 500,
+        'seed_messages': 40,
+        'upload_pool': 30,
+        'actions': DEFAULT_ACTIONS,
+        'uploads': DEFAULT_UPLOADS,
+        'llm': {'first_token_seconds': 0.8, 'tokens_per_second': 80, 'output_tokens': 300},
+        'github': {'latency_seconds': 0.05},
+    },
+    # Many concurrent conversations waiting on a slow upstream
+    'chat': {
+        'users': 60,
+        'duration': 60,
+        'warmup': 5,
+        'seed_sessions': 100,
+        'seed_messages': 20,
+        'upload_pool': 4,
+        'actions': {'chat': 50, 'chat_stream': 45, 'history': 5},
+        'uploads': DEFAULT_UPLOADS,
+        'llm': {'first_token_seconds': 1.5, 'tokens_per_second': 60, 'output_tokens': 400},
+        'github': {'latency_seconds': 0.05},
+    },
+    # File extraction and attachment storage
+    'uploads': {
+        'users': 10,
+        'duration': 60,
+        'warmup': 5,
+        'seed_sessions': 50,
+        'seed_messages': 10,
+        'upload_pool': 60,
+        'actions': {'upload': 60, 'upload_stream': 30, 'history': 10},
+        'uploads': {'pdf': 4, 'docx': 3, 'png': 3, 'text': 2},
+        'llm': {'first_token_seconds': 0.3, 'tokens_per_second': 200, 'output_tokens': 150},
+        'github': {'latency_seconds': 0.05},
+    },
+    # Read-heavy: history, search and admin listings on a large database
+    'reads': {
+        'users': 20,
+        'duration': 45,
+        'warmup': 5,
+        'seed_sessions': 5000,
+        'seed_messages': 40,
+        'upload_pool': 4,
+        'actions': {'history': 40, 'search': 20, 'admin_sessions': 20, 'admin_history': 10, 'admin_db_status': 10},
+        'uploads': DEFAULT_UPLOADS,
+        'llm': {'first_token_seconds': 0.2, 'tokens_per_second': 400, 'output_tokens': 100},
+        'github': {'latency_seconds': 0.02},
+    },
+}
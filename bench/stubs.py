@@ -0,0 +1,189 @@
+# bench/stubs.py
+"""Local stand-ins for the Anthropic and GitHub APIs.
+
+The benchmark points ANTHROPIC_BASE_URL and GITHUB_API_URL at these, so a
+run needs no network access and the upstream behaves the same every time.
+The Anthropic stub answers /v1/messages with lorem ipsum after a configurable
+time to first token and token rate, streamed or not. The GitHub stub serves
+a paginated /user/repos and the contents API, with ETags and 304s like the
+real one.
+"""
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+LOREM = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+    'incididunt ut labore et dolore magna aliqua ut enim ad minim veniam quis nostrud'
+).split()
+
+STREAM_FLUSH_TOKENS = 8  # tokens per streamed text delta
+
+class LLMSettings:
+    def __init__(self, first_token_seconds=0.8, tokens_per_second=80.0, output_tokens=300):
+        self.first_token_seconds = first_token_seconds
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+
+class GitHubSettings:
+    def __init__(self, latency_seconds=0.05, repo_count=120, file_bytes=4000):
+        self.latency_seconds = latency_seconds
+        self.repo_count = repo_count
+        self.file_bytes = file_bytes
+
+class StubServer:
+    """A ThreadingHTTPServer on a free local port, served from a daemon thread"""
+
+    def __init__(self, handler_class):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class AnthropicHandler(_Handler):
+    settings = LLMSettings()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urlsplit(self.path).path != '/v1/messages':
+            return self.send_json({'type': 'error', 'error': {'type': 'not_found_error', 'message': 'Not found'}}, 404)
+        request = json.loads(body)
+
+        settings = self.settings
+        # Roughly 4 bytes per token, counting base64 images like text
+        input_tokens = max(1, len(body) // 4)
+        words = [random.choice(LOREM) for _ in range(settings.output_tokens)]
+        usage = {'input_tokens': input_tokens, 'output_tokens': 0}
+        message = {
+            'id': 'msg_bench', 'type': 'message', 'role': 'assistant',
+            'model': request.get('model', 'bench'), 'content': [],
+            'stop_reason': None, 'stop_sequence': None, 'usage': usage
+        }
+
+        time.sleep(settings.first_token_seconds)
+        if not request.get('stream'):
+            time.sleep(settings.output_tokens / settings.tokens_per_second)
+            message.update(
+                content=[{'type': 'text', 'text': ' '.join(words)}],
+                stop_reason='end_turn',
+                usage={**usage, 'output_tokens': settings.output_tokens}
+            )
+            return self.send_json(message)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self._event('message_start', {'type': 'message_start', 'message': message})
+        self._event('content_block_start', {
+            'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}
+        })
+        for start in range(0, len(words), STREAM_FLUSH_TOKENS):
+            if start:
+                time.sleep(STREAM_FLUSH_TOKENS / settings.tokens_per_second)
+            text = ' '.join(words[start:start + STREAM_FLUSH_TOKENS]) + ' '
+            self._event('content_block_delta', {
+                'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text}
+            })
+        self._event('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        self._event('message_delta', {
+            'type': 'message_delta',
+            'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+            'usage': {'output_tokens': settings.output_tokens}
+        })
+        self._event('message_stop', {'type': 'message_stop'})
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _event(self, event, data):
+        chunk = f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode()
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.flush()
+
+class GitHubHandler(_Handler):
+    settings = GitHubSettings()
+
+    def do_GET(self):
+        time.sleep(self.settings.latency_seconds)
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts == ['user', 'repos']:
+            return self._repos(parse_qs(url.query))
+        if len(parts) >= 5 and parts[0] == 'repos' and parts[3] == 'contents':
+            return self._contents(parts[1], parts[2], '/'.join(parts[4:]))
+        self.send_json({'message': 'Not Found'}, 404)
+
+    def _repos(self, query):
+        per_page = int(query.get('per_page', ['30'])[0])
+        page = int(query.get('page', ['1'])[0])
+        start = (page - 1) * per_page
+        repos = [
+            {'name': f'repo-{i}', 'full_name': f'bench/repo-{i}', 'private': i % 3 == 0,
+             'html_url': f'https://github.com/bench/repo-{i}', 'description': f'Benchmark repository {i}'}
+            for i in range(start, min(start + per_page, self.settings.repo_count))
+        ]
+        headers = {}
+        if start + per_page < self.settings.repo_count:
+            next_url = f'http://{self.headers["Host"]}/user/repos?per_page={per_page}&page={page + 1}'
+            headers['Link'] = f'<{next_url}>; rel="next"'
+        self._send_cacheable(repos, headers)
+
+    def _contents(self, owner, repo, path):
+        line = f'# {owner}/{repo}/{path}\nprint("benchmark")\n'
+        text = (line * (self.settings.file_bytes // len(line) + 1))[:self.settings.file_bytes]
+        self._send_cacheable({
+            'name': path.rsplit('/', 1)[-1], 'path': path, 'size': len(text),
+            'encoding': 'base64', 'content': base64.b64encode(text.encode()).decode(),
+            'html_url': f'https://github.com/{owner}/{repo}/blob/main/{path}'
+        })
+
+    def _send_cacheable(self, payload, headers=None):
+        etag = '"' + hashlib.sha256(json.dumps(payload).encode()).hexdigest()[:20] + '"'
+        headers = {**(headers or {}), 'ETag': etag, 'X-RateLimit-Remaining': '5000'}
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_json(payload, headers=headers)
+
+def start_stub_anthropic(settings):
+    handler = type('AnthropicHandler', (AnthropicHandler,), {'settings': settings})
+    return StubServer(handler).start()
+
+def start_stub_github(settings):
+    handler = type('GitHubHandler', (GitHubHandler,), {'settings': settings})
+    return StubServer(handler).start()
@@ -0,0 +1,135 @@
+# bench/workload.py
+"""Synthetic sessions and uploads for the benchmark.
+
+Everything is generated from a seeded random.Random, so a scenario sends the
+same mix of messages and files on every run. Message lengths are skewed the
+way chat traffic is: mostly short questions, some pasted code, the odd long
+document. Uploads are real PDF, DOCX, PNG and text files so the extraction
+paths do their usual work.
+"""
+import io
+import struct
+import zlib
+
+WORDS = (
+    'the migration script database session history backup upload file python function '
+    'error request response latency cache index query table column worker thread process '
+    'memory token stream context summary attachment image document page parse extract '
+    'deploy container config timeout retry limit queue commit checkpoint snapshot restore'
+).split()
+
+CODE_SNIPPET = '''def handler(request):
+    session_id = request.args.get('session_id')
+    rows = fetch_rows(session_id, limit=50)
+    return jsonify([dict(row) for row in rows])
+'''
+
+# Kinds of action a virtual user takes, with the default weights
+DEFAULT_ACTIONS = {
+    'chat': 30,
+    'chat_stream': 25,
+    'upload': 6,
+    'upload_stream': 4,
+    'history': 15,
+    'search': 4,
+    'github': 4,
+    'admin_sessions': 4,
+    'admin_history': 4,
+    'admin_db_status': 4,
+}
+
+DEFAULT_UPLOADS = {
+    'pdf': 3,
+    'docx': 2,
+    'png': 2,
+    'text': 3,
+}
+
+def words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+def chat_message(rng):
+    """A user message: mostly short, sometimes with code, occasionally long"""
+    roll = rng.random()
+    if roll < 0.6:
+        return words(rng, rng.randint(5, 30)) + '?'
+    if roll < 0.85:
+        return f"{words(rng, rng.randint(10, 40))}\n\n```python\n{CODE_SNIPPET * rng.randint(1, 5)}```"
+    return '\n\n'.join(words(rng, rng.randint(60, 120)) for _ in range(rng.randint(5, 20)))
+
+def assistant_message(rng):
+    return '\n\n'.join(words(rng, rng.randint(40, 100)) for _ in range(rng.randint(1, 6)))
+
+def make_pdf(pages):
+    """A minimal PDF with one line of Helvetica text per page"""
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        ('<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            ' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages))), len(pages)
+        )).encode(),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for i, text in enumerate(pages):
+        stream = f'BT /F1 10 Tf 36 750 Td ({text}) Tj ET'.encode()
+        objects.append((
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+            f'/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>'
+        ).encode())
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(out)
+
+def make_docx(paragraphs):
+    from docx import Document
+    document = Document()
+    for text in paragraphs:
+        document.add_paragraph(text)
+    out = io.BytesIO()
+    document.save(out)
+    return out.getvalue()
+
+def make_png(rng, width, height):
+    """An RGB PNG of noise; compresses about as badly as a photo"""
+    rows = [b'\x00' + rng.randbytes(width * 3) for _ in range(height)]
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) + chunk(b'IEND', b''))
+
+def upload_file(rng, weights, index):
+    """Return (filename, data, mimetype) for an upload drawn from weights"""
+    kind = rng.choices(list(weights), list(weights.values()))[0]
+    if kind == 'pdf':
+        pages = [words(rng, 14) for _ in range(rng.choice((2, 10, 40)))]
+        return f'report-{index}.pdf', make_pdf(pages), 'application/pdf'
+    if kind == 'docx':
+        paragraphs = [words(rng, rng.randint(20, 80)) for _ in range(rng.choice((5, 30, 120)))]
+        return (f'notes-{index}.docx', make_docx(paragraphs),
+                'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+    if kind == 'png':
+        size = rng.choice((200, 480, 900))
+        return f'screenshot-{index}.png', make_png(rng, size, size * 3 // 4), 'image/png'
+    ext = rng.choice(('py', 'md', 'csv'))
+    if ext == 'py':
+        text = CODE_SNIPPET * rng.randint(5, 200)
+    elif ext == 'csv':
+        text = '\n'.join(','.join(words(rng, 1) for _ in range(6)) for _ in range(rng.randint(50, 2000)))
+    else:
+        text = '\n\n'.join(words(rng, 50) for _ in range(rng.randint(5, 100)))
+    return f'file-{index}.{ext}', text.encode(), 'text/plain'
+
+def next_action(rng, weights):
+    return rng.choices(list(weights), list(weights.values()))[0]
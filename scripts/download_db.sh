@@ -1,15 +1,16 @@
 # scripts/download_db.sh
 #!/bin/bash
 
-# Check if bucket is configured
-if [ -z "$GCS_BUCKET_NAME" ]; then
+# Check if backups are configured
+if [ -z "$GCS_BUCKET_NAME" ] && [ "$BACKUP_STORAGE" != "local" ]; then
     echo "GCS_BUCKET_NAME not set. Skipping database download."
     exit 0
 fi
 
-# Download database from Cloud Storage
-echo "Downloading database from gs://$GCS_BUCKET_NAME/chat_history.db..."
-gsutil cp gs://$GCS_BUCKET_NAME/chat_history.db /app/data/chat_history.db 2>/dev/null || echo "No existing database found in Cloud Storage. Starting fresh."
+# Restore database from the latest backup manifest
+echo "Restoring database from backup storage..."
+cd /app
+python -c "from app.config import Config; Config.init_directories(); from app.cloud_storage import download_database; download_database()" || { echo "Database restore failed"; exit 1; }
 
 # Set proper permissions
 chmod 644 /app/data/chat_history.db
\ No newline at end of file
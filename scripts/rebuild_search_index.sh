@@ -0,0 +1,8 @@
+# scripts/rebuild_search_index.sh
+#!/bin/bash
+
+# Rebuild the full-text search index from the conversations table. New
+# databases and ones restored from older backups are indexed by migration 7
+# at startup; run this if the index is ever out of step with the messages.
+cd /app
+python -c "from app.config import Config; Config.init_directories(); from app.database import init_db; init_db(); from app.search import rebuild_search_index; rebuild_search_index()"
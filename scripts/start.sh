@@ -1,6 +1,9 @@
 #!/bin/bash
 # scripts/start.sh
 
+# Workers time their startup from here (see app/startup.py)
+export STARTUP_STARTED_AT=$(date +%s.%N)
+
 echo "Starting Claude Chat Application..."
 
 # Create necessary directories
@@ -13,28 +16,30 @@ if [ -n "$GOOGLE_APPLICATION_CREDENTIALS" ]; then
     gcloud auth activate-service-account --key-file=$GOOGLE_APPLICATION_CREDENTIALS || echo "Service account activation failed"
 fi
 
-# Download database from Cloud Storage on startup
-if [ -n "$GCS_BUCKET_NAME" ]; then
-    echo "Downloading database from gs://$GCS_BUCKET_NAME/"
-    gsutil cp gs://$GCS_BUCKET_NAME/chat_history.db /tmp/data/chat_history.db 2>/dev/null || echo "No existing database found, starting fresh"
+# Restore the database from the latest backup (chunked manifest, or the legacy
+# single-file backup for buckets written by older versions).
+# STARTUP_RESTORE=background (default): start the server now; workers restore
+# in the background and report ready on /health/ready once it's done.
+# STARTUP_RESTORE=blocking: restore here, before the server starts.
+export STARTUP_RESTORE=${STARTUP_RESTORE:-background}
+if [ "$STARTUP_RESTORE" = "blocking" ] && { [ -n "$GCS_BUCKET_NAME" ] || [ "$BACKUP_STORAGE" = "local" ]; }; then
+    echo "Restoring database from backup storage..."
+    # With no backup the database starts fresh; if one exists but can't be
+    # restored, keep backups off so the fresh database doesn't replace it
+    if ! python -c "from app.config import Config; Config.init_directories(); from app.cloud_storage import download_database; download_database()"; then
+        echo "Database restore failed; starting with backups disabled"
+        export BACKUP_SCHEDULER_ENABLED=false
+    fi
 fi
 
-# NEW: Graceful shutdown function
+# Graceful shutdown: the app's workers run a bounded final backup as they exit,
+# so just forward the signal to the server and wait for it
 graceful_shutdown() {
-    echo "Received shutdown signal. Backing up database..."
+    echo "Received shutdown signal. Stopping server (workers flush a final backup)..."
     
-    if [ -n "$GCS_BUCKET_NAME" ]; then
-        # Backup database before shutdown
-        timestamp=$(date +%Y%m%d_%H%M%S)
-        gsutil cp /tmp/data/chat_history.db gs://$GCS_BUCKET_NAME/chat_history.db
-        gsutil cp /tmp/data/chat_history.db gs://$GCS_BUCKET_NAME/backups/chat_history_${timestamp}_shutdown.db
-        echo "Database backed up successfully"
-    fi
-    
-    # Gracefully terminate Gunicorn
-    if [ -n "$GUNICORN_PID" ]; then
-        echo "Terminating Gunicorn..."
-        kill -TERM "$GUNICORN_PID" 2>/dev/null || echo "Failed to terminate Gunicorn"
+    if [ -n "$SERVER_PID" ]; then
+        kill -TERM "$SERVER_PID" 2>/dev/null || echo "Failed to terminate server"
+        wait "$SERVER_PID"
     fi
     exit 0
 }
@@ -42,22 +47,46 @@ graceful_shutdown() {
 # Set up signal handlers
 trap graceful_shutdown SIGTERM SIGINT
 
-# Start Gunicorn server
-echo "Starting Gunicorn application server..."
-gunicorn \
-    --bind 0.0.0.0:$PORT \
-    --workers 2 \
-    --threads 2 \
-    --worker-class gthread \
-    --max-requests 1000 \
-    --timeout 300 \
-    --access-logfile - \
-    --error-logfile - \
-    --log-level info \
-    run:app &
-
-# Store Gunicorn PID for graceful shutdown
-GUNICORN_PID=$!
-
-# Wait for Gunicorn to finish
-wait $GUNICORN_PID
\ No newline at end of file
+# Workers write their metrics here and /metrics sums them; start empty so
+# counters from a previous container run don't carry over
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+# SERVER_MODE=wsgi (default): Gunicorn with threaded workers; every conversation
+# waiting on Claude holds a thread.
+# SERVER_MODE=asgi: Uvicorn running asgi:app; conversations wait in each
+# worker's event loop, bounded by ASYNC_LLM_MAX_CONCURRENCY and the
+# connection limit below.
+SERVER_MODE=${SERVER_MODE:-wsgi}
+
+if [ "$SERVER_MODE" = "asgi" ]; then
+    echo "Starting Uvicorn ASGI server..."
+    uvicorn asgi:app \
+        --host 0.0.0.0 \
+        --port $PORT \
+        --workers 2 \
+        --limit-concurrency ${ASYNC_MAX_CONNECTIONS:-1000} \
+        --timeout-keep-alive 5 \
+        --timeout-graceful-shutdown 8 \
+        --log-level info &
+else
+    echo "Starting Gunicorn application server..."
+    gunicorn \
+        --bind 0.0.0.0:$PORT \
+        --workers 2 \
+        --threads 2 \
+        --worker-class gthread \
+        --max-requests 1000 \
+        --timeout 300 \
+        --access-logfile - \
+        --error-logfile - \
+        --log-level info \
+        run:app &
+fi
+
+# Store the server PID for graceful shutdown
+SERVER_PID=$!
+
+# Wait for the server to finish
+wait $SERVER_PID
\ No newline at end of file